@@ -0,0 +1,32 @@
+"""
+user created_at
+
+Revision ID: 5f0d2a7c81e4
+Revises: e3a84b6f0c52
+Create Date: 2026-10-18 12:20:05.904417
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "5f0d2a7c81e4"
+down_revision: Union[str, None] = "e3a84b6f0c52"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Users registered before stay without a date.
+    op.add_column(
+        "user",
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("user", "created_at")
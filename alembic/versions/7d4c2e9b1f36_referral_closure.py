@@ -0,0 +1,88 @@
+"""
+referral closure
+
+Revision ID: 7d4c2e9b1f36
+Revises: 2b6e9d41a7f0
+Create Date: 2026-10-18 16:12:40.381925
+
+"""
+
+from typing import Sequence, Union
+
+import fastapi_users_db_sqlalchemy
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "7d4c2e9b1f36"
+down_revision: Union[str, None] = "2b6e9d41a7f0"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "referralclosure",
+        sa.Column(
+            "ancestor_id",
+            fastapi_users_db_sqlalchemy.generics.GUID(),
+            nullable=False,
+        ),
+        sa.Column(
+            "descendant_id",
+            fastapi_users_db_sqlalchemy.generics.GUID(),
+            nullable=False,
+        ),
+        sa.Column("depth", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["ancestor_id"],
+            ["user.id"],
+            ondelete="CASCADE",
+        ),
+        sa.ForeignKeyConstraint(
+            ["descendant_id"],
+            ["user.id"],
+            ondelete="CASCADE",
+        ),
+        sa.PrimaryKeyConstraint("ancestor_id", "descendant_id"),
+    )
+    # Existing referral chains are walked once to fill the closure.
+    op.execute(
+        """
+        INSERT INTO referralclosure (ancestor_id, descendant_id, depth)
+        WITH RECURSIVE chain (ancestor_id, descendant_id, depth) AS (
+            SELECT referrer_id, id, 1
+            FROM "user"
+            WHERE referrer_id IS NOT NULL
+            UNION ALL
+            SELECT "user".referrer_id, chain.descendant_id, chain.depth + 1
+            FROM chain
+            JOIN "user" ON "user".id = chain.ancestor_id
+            WHERE "user".referrer_id IS NOT NULL
+        )
+        SELECT ancestor_id, descendant_id, depth FROM chain
+        """,
+    )
+    op.create_index(
+        "ix_referralclosure_ancestor_id_depth",
+        "referralclosure",
+        ["ancestor_id", "depth", "descendant_id"],
+    )
+    op.create_index(
+        "ix_referralclosure_descendant_id_depth",
+        "referralclosure",
+        ["descendant_id", "depth"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(
+        "ix_referralclosure_descendant_id_depth",
+        table_name="referralclosure",
+    )
+    op.drop_index(
+        "ix_referralclosure_ancestor_id_depth",
+        table_name="referralclosure",
+    )
+    op.drop_table("referralclosure")
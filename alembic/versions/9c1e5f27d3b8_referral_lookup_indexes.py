@@ -0,0 +1,64 @@
+"""
+referral lookup indexes
+
+Revision ID: 9c1e5f27d3b8
+Revises: 4a33e9a11571
+Create Date: 2026-10-18 10:12:41.318702
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "9c1e5f27d3b8"
+down_revision: Union[str, None] = "4a33e9a11571"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Build indexes without locking the tables for writes.
+    with op.get_context().autocommit_block():
+        op.create_index(
+            op.f("ix_referralcode_code"),
+            "referralcode",
+            ["code"],
+            unique=True,
+            postgresql_concurrently=True,
+        )
+        op.create_index(
+            "ix_referralcode_active_expiration_at",
+            "referralcode",
+            ["expiration_at"],
+            postgresql_where=sa.text("code IS NOT NULL"),
+            postgresql_concurrently=True,
+        )
+        op.create_index(
+            op.f("ix_user_referrer_id"),
+            "user",
+            ["referrer_id"],
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            op.f("ix_user_referrer_id"),
+            table_name="user",
+            postgresql_concurrently=True,
+        )
+        op.drop_index(
+            "ix_referralcode_active_expiration_at",
+            table_name="referralcode",
+            postgresql_concurrently=True,
+        )
+        op.drop_index(
+            op.f("ix_referralcode_code"),
+            table_name="referralcode",
+            postgresql_concurrently=True,
+        )
@@ -0,0 +1,87 @@
+"""
+mail outbox user idempotency key
+
+Revision ID: b5d8e2f4a913
+Revises: 7d4c2e9b1f36
+Create Date: 2026-10-18 17:24:05.518204
+
+"""
+
+from typing import Sequence, Union
+
+import fastapi_users_db_sqlalchemy
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "b5d8e2f4a913"
+down_revision: Union[str, None] = "7d4c2e9b1f36"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "mailoutbox",
+        sa.Column(
+            "user_id",
+            fastapi_users_db_sqlalchemy.generics.GUID(),
+            nullable=True,
+        ),
+    )
+    # Messages were only sent to users' own emails,
+    # ones of deleted users are dropped.
+    op.execute(
+        """
+        UPDATE mailoutbox SET user_id = "user".id
+        FROM "user" WHERE "user".email = mailoutbox.recipient
+        """,
+    )
+    op.execute("DELETE FROM mailoutbox WHERE user_id IS NULL")
+    op.alter_column("mailoutbox", "user_id", nullable=False)
+    op.create_foreign_key(
+        "mailoutbox_user_id_fkey",
+        "mailoutbox",
+        "user",
+        ["user_id"],
+        ["id"],
+        ondelete="CASCADE",
+    )
+    op.drop_constraint(
+        "mailoutbox_idempotency_key_key",
+        "mailoutbox",
+        type_="unique",
+    )
+    op.create_unique_constraint(
+        "uq_mailoutbox_user_id_idempotency_key",
+        "mailoutbox",
+        ["user_id", "idempotency_key"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_constraint(
+        "uq_mailoutbox_user_id_idempotency_key",
+        "mailoutbox",
+        type_="unique",
+    )
+    # Keys were unique among messages of a user only.
+    op.execute(
+        """
+        DELETE FROM mailoutbox WHERE id NOT IN (
+            SELECT min(id) FROM mailoutbox GROUP BY idempotency_key
+        )
+        """,
+    )
+    op.create_unique_constraint(
+        "mailoutbox_idempotency_key_key",
+        "mailoutbox",
+        ["idempotency_key"],
+    )
+    op.drop_constraint(
+        "mailoutbox_user_id_fkey",
+        "mailoutbox",
+        type_="foreignkey",
+    )
+    op.drop_column("mailoutbox", "user_id")
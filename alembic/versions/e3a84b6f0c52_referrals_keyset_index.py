@@ -0,0 +1,49 @@
+"""
+referrals keyset index
+
+Revision ID: e3a84b6f0c52
+Revises: 9c1e5f27d3b8
+Create Date: 2026-10-18 11:03:27.540913
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "e3a84b6f0c52"
+down_revision: Union[str, None] = "9c1e5f27d3b8"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Referrals are paginated by id within a referrer.
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_user_referrer_id_id",
+            "user",
+            ["referrer_id", "id"],
+            postgresql_concurrently=True,
+        )
+        op.drop_index(
+            "ix_user_referrer_id",
+            table_name="user",
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_user_referrer_id",
+            "user",
+            ["referrer_id"],
+            postgresql_concurrently=True,
+        )
+        op.drop_index(
+            "ix_user_referrer_id_id",
+            table_name="user",
+            postgresql_concurrently=True,
+        )
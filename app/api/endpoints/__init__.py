@@ -1,2 +1,3 @@
+from app.api.endpoints.metrics import router as metrics_router  # noqa
 from app.api.endpoints.referral import router as referral_router  # noqa
 from app.api.endpoints.user import router as user_router  # noqa
@@ -0,0 +1,12 @@
+"""Metrics endpoints."""
+from fastapi import APIRouter, Response
+
+from app.core.metrics import CONTENT_TYPE, render
+
+router = APIRouter()
+
+
+@router.get("/metrics", include_in_schema=False)
+async def get_metrics() -> Response:
+    """Return metrics of the worker in Prometheus text format."""
+    return Response(render(), media_type=CONTENT_TYPE)
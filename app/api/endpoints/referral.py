@@ -1,52 +1,116 @@
 """Referral code endpoints."""
+from datetime import date, datetime, timedelta
 from http import HTTPStatus
-from typing import List
+from time import perf_counter
+from typing import List, Optional
 from uuid import UUID
 
-from fastapi import APIRouter, BackgroundTasks, Depends, Response
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
 from sqlalchemy.ext.asyncio import AsyncSession
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, StreamingResponse
 
-from app.core.database import get_async_session
-from app.core.user import current_user
+from app.core.cache_codec import CachedReferralCode
+from app.core.config import settings
+from app.core.database import (get_async_read_session, get_async_session,
+                               get_read_session)
+from app.core.rate_limit import mail_rate_limit
+from app.core.redis import redis_command_seconds, referral_cache_lookups
+from app.core.user import current_superuser, current_user
 from app.crud import crud_referral, crud_user
 from app.models import ReferralCode, User
-from app.schemas import ReferralCodeCreate, ReferralCodeRead, UserRead
-from app.services.mail import send_referral_code
+from app.schemas import (ReferralCodeBulkCreate, ReferralCodeBulkRead,
+                         ReferralCodeCreate, ReferralCodeLookup,
+                         ReferralCodeRead, ReferralRead, ReferralStatsRead,
+                         ReferralTreeCountRead, ReferralTreeRead)
+from app.services.mail import MailQueueFull, send_referral_code
+from app.services.referral import dump_referrals, dump_referrals_ndjson
 from app.validators import check_referral_code_exists
 
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
 router = APIRouter()
 
 
 @router.post(
     "/",
     response_model=ReferralCodeRead,
-    dependencies=[Depends(current_user)],
 )
 async def create_referral_code(
     referral_code_lifetime: ReferralCodeCreate,
     session: AsyncSession = Depends(get_async_session),
     user: User = Depends(current_user),
-) -> ReferralCode:
+) -> CachedReferralCode:
     """Create or update and then return a ReferralCode obj."""
-    if code_obj := await crud_referral.get_by_user(user, session): # noqa
-        return await crud_referral.update(
-            code_obj,
-            referral_code_lifetime.lifetime,
-            session,
-        )
-    else:
-        return await crud_referral.create(
-            user,
-            referral_code_lifetime.lifetime,
+    return await crud_referral.upsert(
+        user,
+        referral_code_lifetime.lifetime,
+        session,
+    )
+
+
+@router.post(
+    "/bulk",
+    response_model=ReferralCodeBulkRead,
+    dependencies=[Depends(current_superuser)],
+)
+async def create_referral_codes(
+    bulk: ReferralCodeBulkCreate,
+    session: AsyncSession = Depends(get_async_session),
+) -> ReferralCodeBulkRead:
+    """
+    Create or rotate ReferralCode objs of many users.
+
+    one statement and one redis pipeline per batch
+    codes are prefixed by a campaign
+    unknown user ids are skipped
+    """
+    user_ids = list(dict.fromkeys(bulk.user_ids))
+    batch_size = settings.referral_bulk_batch_size
+    issued = 0
+    start = perf_counter()
+    for offset in range(0, len(user_ids), batch_size):
+        code_objs = await crud_referral.upsert_many(
+            user_ids[offset:offset + batch_size],
+            bulk.lifetime,
             session,
+            bulk.campaign,
         )
+        issued += len(code_objs)
+    seconds = perf_counter() - start
+    return ReferralCodeBulkRead(
+        requested=len(user_ids),
+        issued=issued,
+        seconds=seconds,
+        rows_per_second=issued / seconds if seconds else 0,
+    )
+
+
+@router.post(
+    "/lookup",
+    response_model=List[ReferralCodeRead],
+    dependencies=[Depends(current_superuser)],
+)
+async def lookup_referral_codes(
+    lookup: ReferralCodeLookup,
+    session: AsyncSession = Depends(get_async_read_session),
+) -> List[CachedReferralCode]:
+    """
+    Return ReferralCode objs of many referral codes.
+
+    from redis cache in one round-trip
+    and the rest from postgres database in one query
+    unknown codes are skipped
+    """
+    code_objs = await crud_referral.get_many_by_referral_codes(
+        lookup.codes,
+        session,
+    )
+    return list(code_objs.values())
 
 
 @router.delete(
     "/",
     response_model=ReferralCodeRead,
-    dependencies=[Depends(current_user)],
 )
 async def delete_referral_code(
     user: User = Depends(current_user),
@@ -60,37 +124,240 @@ async def delete_referral_code(
 
 @router.post(
     "/mail-referral-code",
-    dependencies=[Depends(current_user)],
+    dependencies=[Depends(mail_rate_limit)],
 )
 async def mail_referral_code(
-    task: BackgroundTasks,
     user: User = Depends(current_user),
     session: AsyncSession = Depends(get_async_session),
+    idempotency_key: Optional[str] = Header(None, max_length=255),
 ) -> Response:
-    """Send a referral code to user's mail."""
+    """
+    Queue a referral code to be sent to user's mail.
+
+    a repeated Idempotency-Key of the user doesn't send it again
+    """
     code_obj = await check_referral_code_exists(user, session)
-    task.add_task(
-        send_referral_code,
-        code_obj.code,
-        user.email,
-    )
+    try:
+        await send_referral_code(
+            code_obj.code,
+            user.id,
+            user.email,
+            session,
+            idempotency_key,
+        )
+    except MailQueueFull:
+        raise HTTPException(
+            status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+            detail="Mail queue is full, try again later.",
+        )
     return JSONResponse(
-        content={"message": f"Referral code has been sent to {user.email}."},
+        content={
+            "message": f"Referral code has been queued to {user.email}.",
+        },
         status_code=HTTPStatus.OK,
     )
 
 
+@router.get(
+    "/cache/stats",
+    dependencies=[Depends(current_superuser)],
+)
+async def get_referral_cache_stats() -> dict:
+    """
+    Return counters of redis cache.
+
+    hit, miss and negative hit counters of lookups
+    count and total time of redis round-trips by command
+    """
+    return {
+        "lookups": referral_cache_lookups.snapshot(),
+        "commands": redis_command_seconds.snapshot(),
+    }
+
+
+@router.get(
+    "/{referrer_id}/stats",
+    response_model=ReferralStatsRead,
+    dependencies=[Depends(current_user)],
+)
+async def get_referral_stats(
+    referrer_id: UUID,
+    session: AsyncSession = Depends(get_async_read_session),
+) -> ReferralStatsRead:
+    """
+    Return referral statistics by referrer_id.
+
+    referrals in total and by day for the last referral_stats_days days
+    status of the referral code
+    """
+    today = date.today()
+    days = [
+        today - timedelta(days=days_ago)
+        for days_ago in range(settings.referral_stats_days)
+    ]
+    total, daily = await crud_user.get_referral_stats_by_referrer_id(
+        referrer_id,
+        days,
+    )
+    code_obj = await crud_referral.get_by_referrer_id(referrer_id, session)
+    stats = ReferralStatsRead(
+        referrer_id=referrer_id,
+        referrals_count=total,
+        daily_referrals=daily,
+        code_status="missing",
+    )
+    if code_obj is not None:
+        stats.code_expiration_at = code_obj.expiration_at
+        stats.code_status = (
+            "expired" if code_obj.expiration_at < datetime.now() else "active"
+        )
+    return stats
+
+
+@router.get(
+    "/{user_id}/ancestors",
+    response_model=List[ReferralTreeRead],
+    dependencies=[Depends(current_user)],
+)
+async def get_referral_ancestors(
+    user_id: UUID,
+    max_depth: int = Query(
+        settings.referral_tree_max_depth,
+        gt=0,
+        le=settings.referral_tree_max_depth,
+    ),
+    session: AsyncSession = Depends(get_async_read_session),
+):
+    """
+    Return referrers up the chain of a user.
+
+    the referrer of the user first and so on up to max_depth
+    """
+    ancestors = await crud_user.get_ancestors(user_id, max_depth, session)
+    return Response(
+        dump_referrals(crud_user.referral_tree_fields, ancestors),
+        media_type="application/json",
+    )
+
+
+@router.get(
+    "/{user_id}/descendants",
+    response_model=List[ReferralTreeRead],
+    dependencies=[Depends(current_user)],
+)
+async def get_referral_descendants(
+    user_id: UUID,
+    max_depth: int = Query(
+        settings.referral_tree_max_depth,
+        gt=0,
+        le=settings.referral_tree_max_depth,
+    ),
+    limit: int = Query(
+        settings.referral_page_size,
+        gt=0,
+        le=settings.referral_max_page_size,
+    ),
+    session: AsyncSession = Depends(get_async_read_session),
+):
+    """
+    Return referrals down the tree of a user.
+
+    first limit referrals ordered by depth and id up to max_depth
+    """
+    descendants = await crud_user.get_descendants(
+        user_id,
+        max_depth,
+        limit,
+        session,
+    )
+    return Response(
+        dump_referrals(crud_user.referral_tree_fields, descendants),
+        media_type="application/json",
+    )
+
+
+@router.get(
+    "/{user_id}/descendants/count",
+    response_model=ReferralTreeCountRead,
+    dependencies=[Depends(current_user)],
+)
+async def count_referral_descendants(
+    user_id: UUID,
+    max_depth: int = Query(
+        settings.referral_tree_max_depth,
+        gt=0,
+        le=settings.referral_tree_max_depth,
+    ),
+    session: AsyncSession = Depends(get_async_read_session),
+) -> ReferralTreeCountRead:
+    """Return a number of referrals down the tree of a user by depth."""
+    total, by_depth = await crud_user.count_descendants(
+        user_id,
+        max_depth,
+        session,
+    )
+    return ReferralTreeCountRead(
+        user_id=user_id,
+        total=total,
+        by_depth=by_depth,
+    )
+
+
 @router.get(
     "/{referrer_id}",
-    response_model=List[UserRead],
+    response_model=List[ReferralRead],
     dependencies=[Depends(current_user)],
 )
 async def get_referrals(
     referrer_id: UUID,
-    session: AsyncSession = Depends(get_async_session),
+    after: Optional[UUID] = None,
+    limit: int = Query(
+        settings.referral_page_size,
+        gt=0,
+        le=settings.referral_max_page_size,
+    ),
+    accept: Optional[str] = Header(None),
+    session: AsyncSession = Depends(get_async_read_session),
 ):
-    """Return all referrals by referrer_id."""
-    return await crud_user.get_referrals_by_referrer_id(
+    """
+    Return referrals by referrer_id.
+
+    a page of referrals ordered by id and following the after id
+    X-Next-Cursor header holds the after id of the next page
+    all referrals as NDJSON stream if it is accepted
+    rows are serialized without ORM objs and the response model
+    """
+    if accept is not None and NDJSON_MEDIA_TYPE in accept:
+        return StreamingResponse(
+            stream_referrals(referrer_id),
+            media_type=NDJSON_MEDIA_TYPE,
+        )
+    referrals = await crud_user.get_referrals_by_referrer_id(
         referrer_id,
         session,
+        after=after,
+        limit=limit + 1,
+    )
+    response = Response(
+        dump_referrals(crud_user.referral_fields, referrals[:limit]),
+        media_type="application/json",
     )
+    if len(referrals) > limit:
+        response.headers["X-Next-Cursor"] = str(referrals[limit - 1].id)
+    return response
+
+
+async def stream_referrals(referrer_id: UUID):
+    """
+    Yield referrals by referrer_id as NDJSON.
+
+    with its own session on a replica as the request one is closed
+    before the response is streamed
+    """
+    async with get_read_session() as session:
+        async for batch in crud_user.stream_referrals_by_referrer_id(
+            referrer_id,
+            session,
+            settings.referral_stream_batch_size,
+        ):
+            yield dump_referrals_ndjson(crud_user.referral_fields, batch)
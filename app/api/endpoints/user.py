@@ -1,7 +1,13 @@
 """User endpoints."""
-from fastapi import APIRouter
+from http import HTTPStatus
 
-from app.core.user import auth_backend, fastapi_users
+from fastapi import APIRouter, Depends, HTTPException, Response
+
+from app.core.config import settings
+from app.core.rate_limit import login_rate_limit, register_rate_limit
+from app.core.redis import revoke_user_tokens_redis
+from app.core.user import auth_backend, current_user, fastapi_users
+from app.models import User
 from app.schemas import UserCreate, UserRead
 
 router = APIRouter()
@@ -10,9 +16,27 @@ router.include_router(
     fastapi_users.get_auth_router(auth_backend),
     prefix="/auth/jwt",
     tags=["auth"],
+    dependencies=[Depends(login_rate_limit)],
 )
 router.include_router(
     fastapi_users.get_register_router(UserRead, UserCreate),
     prefix="/auth",
     tags=["auth"],
+    dependencies=[Depends(register_rate_limit)],
+)
+
+
+@router.post(
+    "/auth/jwt/logout-all",
+    status_code=HTTPStatus.NO_CONTENT,
+    tags=["auth"],
 )
+async def logout_all(user: User = Depends(current_user)) -> Response:
+    """Revoke all tokens of the user."""
+    if not settings.jwt_redis_enabled:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail="Tokens can't be revoked.",
+        )
+    await revoke_user_tokens_redis(user.id)
+    return Response(status_code=HTTPStatus.NO_CONTENT)
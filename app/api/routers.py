@@ -4,11 +4,13 @@ Include routers from other modules.
 charityproject_router: for /charity_project endpoints
 donation_router: for /donation endpoints
 user_router: for /auth and /user endpoints
+metrics_router: for /metrics endpoint
 """
 
 from fastapi import APIRouter
 
-from app.api.endpoints import referral_router, user_router
+from app.api.endpoints import metrics_router, referral_router, user_router
+from app.core.config import settings
 
 main_router = APIRouter()
 
@@ -18,3 +20,6 @@ main_router.include_router(
     prefix="/referral",
     tags=["Referral links"],
 )
+
+if settings.metrics_enabled:
+    main_router.include_router(metrics_router, tags=["metrics"])
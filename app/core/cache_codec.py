@@ -0,0 +1,101 @@
+"""
+Compact binary codec for ReferralCode objs stored in redis cache.
+
+Layout of an entry (network byte order):
+version: 1 byte, bumped on every layout change
+flags: 1 byte, marks which nullable columns are present
+referrer_id: 16 bytes of UUID
+created_at: 8 bytes, microseconds since epoch
+expiration_at: 8 bytes, microseconds since epoch
+code: the rest of the payload, utf-8
+"""
+import struct
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
+from uuid import UUID
+
+CODEC_VERSION = 1
+
+_HEADER = struct.Struct("!BB16sqq")
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+_HAS_CODE = 0b001
+_HAS_CREATED_AT = 0b010
+_HAS_EXPIRATION_AT = 0b100
+
+
+class CachedReferralCode(NamedTuple):
+    """
+    Lightweight read model of a ReferralCode obj.
+
+    Is returned instead of a detached ORM obj
+    and is accepted by ReferralCodeRead.
+    """
+
+    referrer_id: UUID
+    code: Optional[str] = None
+    created_at: Optional[datetime] = None
+    expiration_at: Optional[datetime] = None
+
+    @classmethod
+    def from_model(cls, db_obj) -> "CachedReferralCode":
+        """Build a read model from a ReferralCode obj."""
+        return cls(
+            db_obj.referrer_id,
+            db_obj.code,
+            db_obj.created_at,
+            db_obj.expiration_at,
+        )
+
+
+def _to_micros(value: Optional[datetime]) -> int:
+    """Convert a naive datetime to microseconds since epoch."""
+    if value is None:
+        return 0
+    return (value - _EPOCH) // _MICROSECOND
+
+
+def _from_micros(value: int) -> datetime:
+    """Convert microseconds since epoch to a naive datetime."""
+    return _EPOCH + timedelta(microseconds=value)
+
+
+def encode_referral(db_obj) -> bytes:
+    """Encode a ReferralCode obj or its read model to bytes."""
+    flags = 0
+    code = b""
+    if db_obj.code is not None:
+        flags |= _HAS_CODE
+        code = db_obj.code.encode()
+    if db_obj.created_at is not None:
+        flags |= _HAS_CREATED_AT
+    if db_obj.expiration_at is not None:
+        flags |= _HAS_EXPIRATION_AT
+    return _HEADER.pack(
+        CODEC_VERSION,
+        flags,
+        db_obj.referrer_id.bytes,
+        _to_micros(db_obj.created_at),
+        _to_micros(db_obj.expiration_at),
+    ) + code
+
+
+def decode_referral(payload: bytes) -> Optional[CachedReferralCode]:
+    """
+    Decode bytes to a read model of a ReferralCode obj.
+
+    Return None for a payload written with another codec version
+    so the caller falls back to the database.
+    """
+    if len(payload) < _HEADER.size or payload[0] != CODEC_VERSION:
+        return None
+    _, flags, referrer_id, created_at, expiration_at = _HEADER.unpack_from(
+        payload,
+    )
+    return CachedReferralCode(
+        UUID(bytes=referrer_id),
+        payload[_HEADER.size:].decode() if flags & _HAS_CODE else None,
+        _from_micros(created_at) if flags & _HAS_CREATED_AT else None,
+        _from_micros(expiration_at) if flags & _HAS_EXPIRATION_AT else None,
+    )
@@ -1,5 +1,5 @@
 """Settings for a FastAPI app."""
-from typing import Optional
+from typing import Dict, List, Literal, Optional, Tuple
 
 from pydantic import EmailStr, SecretStr
 from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -23,22 +23,120 @@ class Settings(BaseSettings):
     db_password: SecretStr
     db_host: str
     db_port: int
+    db_pool_size: int = 10
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30
+    db_pool_pre_ping: bool = True
+    db_pool_recycle: int = 30 * 60
+    db_statement_cache_size: int = 100
+    db_replica_urls: List[str] = []
+    db_replica_max_lag: Optional[float] = 5
+    db_replica_check_interval: float = 5
+    db_replica_check_timeout: float = 2
+    db_slow_query_threshold: Optional[float] = None
 
     redis_name: str
     redis_username: str
     redis_password: SecretStr
     redis_host: str
     redis_port: int
+    redis_max_connections: int = 50
+    redis_pool_timeout: float = 5
+    redis_socket_timeout: float = 5
+    redis_socket_connect_timeout: float = 5
+    redis_health_check_interval: int = 30
 
     first_superuser_email: Optional[EmailStr] = None
     first_superuser_password: Optional[str] = None
 
+    jwt_lifetime_seconds: int = 60 * 60
+    jwt_redis_enabled: bool = False
+
+    password_hash_scheme: Literal["bcrypt", "pbkdf2_sha256", "argon2"] = (
+        "bcrypt"
+    )
+    password_hash_rounds: Optional[int] = None
+    password_hash_workers: int = 4
+
+    metrics_enabled: bool = False
+
+    profiling_enabled: bool = False
+    profiling_sample_rate: float = 0
+    profiling_header: str = "X-Profile"
+    profiling_dir: str = "profiles"
+    profiling_top: int = 50
+
+    rate_limit_enabled: bool = True
+    rate_limits: Dict[str, Tuple[float, int]] = {
+        "register": (0.2, 10),
+        "login": (1, 20),
+        "mail": (1 / 60, 3),
+    }
+    rate_limit_client_ip_header: Optional[str] = None
+
+    user_cache_enabled: bool = False
+    user_cache_ttl: int = 5 * 60
+    user_local_cache_enabled: bool = False
+    user_local_cache_size: int = 10_000
+    user_local_cache_ttl: float = 5
+
     referral_link_length: int = 16
+    referral_code_strategy: Literal["urlsafe", "base62", "crockford"] = (
+        "urlsafe"
+    )
+    referral_code_prefix: str = ""
+    referral_code_max_retries: int = 3
+    referral_code_check_enabled: bool = False
+    referral_code_pool_enabled: bool = False
+    referral_code_pool_size: int = 1000
+    referral_code_pool_refill_at: int = 250
+
+    referral_cache_grace: int = 60
+    referral_cache_max_ttl: int = 24 * 60 * 60
+    referral_cache_negative_ttl: int = 30
+
+    referral_local_cache_enabled: bool = False
+    referral_local_cache_size: int = 10_000
+    referral_local_cache_ttl: float = 5
+
+    referral_single_flight_enabled: bool = True
+    referral_cache_lock_enabled: bool = False
+    referral_cache_lock_timeout: float = 2
+    referral_cache_lock_poll_interval: float = 0.02
+    referral_cache_stale_window: int = 10
+
+    referral_page_size: int = 100
+    referral_max_page_size: int = 1000
+    referral_stream_batch_size: int = 1000
+
+    referral_stats_days: int = 30
+
+    referral_tree_closure_enabled: bool = True
+    referral_tree_max_depth: int = 100
+
+    referral_bulk_batch_size: int = 1000
+    referral_bulk_max_users: int = 100_000
+    referral_lookup_max_codes: int = 1000
 
     mail_host: Optional[str] = None
     mail_username: Optional[EmailStr] = None
     mail_password: Optional[str] = None
     mail_port: Optional[str] = None
+    mail_use_tls: bool = True
+    mail_timeout: float = 30
+    mail_workers: int = 4
+    mail_queue_size: int = 10_000
+    mail_batch_size: int = 50
+    mail_max_retries: int = 3
+    mail_retry_backoff: float = 1
+    mail_stop_timeout: float = 10
+
+    mail_outbox_enabled: bool = False
+    mail_outbox_batch_size: int = 100
+    mail_outbox_poll_interval: float = 1
+    mail_outbox_lease: int = 5 * 60
+    mail_outbox_max_attempts: int = 5
+    mail_outbox_backoff: float = 30
 
     @property
     def postgres_connection_url(self) -> URL:
@@ -1,11 +1,76 @@
-"""Settings for database connection and sessions creation."""
-from typing import AsyncGenerator
+"""
+Settings for database connection and sessions creation.
 
-from sqlalchemy.ext.asyncio import (AsyncSession, async_sessionmaker,
-                                    create_async_engine)
+Connections are kept in a bounded pool sized in settings,
+checked before use and replaced after the recycle time.
+Objs stay loaded after commit so no reload round-trips are issued.
+Read sessions go to replicas in turn, skipping failed or lagging ones,
+and to the primary if there are no healthy replicas.
+Statements slower than a threshold are logged
+and statements of profiled requests are recorded.
+"""
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from itertools import count
+from time import perf_counter
+from typing import AsyncGenerator, List, Union
+
+from sqlalchemy import URL, Engine, event, exc, make_url, text
+from sqlalchemy.ext.asyncio import (AsyncEngine, AsyncSession,
+                                    async_sessionmaker, create_async_engine)
 from sqlalchemy.orm import declarative_base, declared_attr
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from app.core.config import settings
+from app.core.metrics import Counter, Gauge, Histogram
+from app.core.profiling import record_query
+
+logger = logging.getLogger(__name__)
+
+# Seconds the replica is behind, zero if it has replayed all it received.
+REPLICA_LAG_QUERY = text(
+    """
+    SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE coalesce(
+            extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0
+        )
+    END
+    """,
+)
+
+db_pool_connect_seconds = Histogram(
+    "db_pool_connect_seconds",
+    "Time to check out a connection from the database pool.",
+)
+db_pool_timeouts = Counter(
+    "db_pool_timeouts_total",
+    "Checkouts from the database pool failed on the pool timeout.",
+)
+
+
+def time_statement(conn, cursor, statement, parameters, context, executemany):
+    """Note the time a statement is sent to the database."""
+    context.statement_start = perf_counter()
+
+
+def log_statement(conn, cursor, statement, parameters, context, executemany):
+    """
+    Log a slow statement and record it to the current request profile.
+
+    without its parameters which may hold secrets
+    """
+    seconds = perf_counter() - context.statement_start
+    threshold = settings.db_slow_query_threshold
+    if threshold is not None and seconds >= threshold:
+        logger.warning("Slow query took %.3f s: %s", seconds, statement)
+    record_query(statement, seconds)
+
+
+if settings.db_slow_query_threshold is not None or settings.profiling_enabled:
+    event.listen(Engine, "before_cursor_execute", time_statement)
+    event.listen(Engine, "after_cursor_execute", log_statement)
 
 
 class PreBase:
@@ -24,12 +89,245 @@ class PreBase:
 
 Base = declarative_base(cls=PreBase)
 
-engine = create_async_engine(settings.postgres_connection_url)
 
-AsyncSessionLocal = async_sessionmaker(engine, class_=AsyncSession)
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """
+    Connection pool timing checkouts.
+
+    waiting for a free connection
+    opening a new one and checking it before use
+    """
+
+    def connect(self):
+        """Check out a connection and time it."""
+        start = perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            db_pool_timeouts.inc()
+            raise
+        finally:
+            db_pool_connect_seconds.observe(perf_counter() - start)
+
+
+def create_pooled_engine(url: Union[str, URL]) -> AsyncEngine:
+    """Create an engine with the pool and statement cache from settings."""
+    return create_async_engine(
+        make_url(url).update_query_dict(
+            {
+                "prepared_statement_cache_size": str(
+                    settings.db_statement_cache_size,
+                ),
+            },
+        ),
+        poolclass=TimedQueuePool,
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_timeout=settings.db_pool_timeout,
+        pool_pre_ping=settings.db_pool_pre_ping,
+        pool_recycle=settings.db_pool_recycle,
+        connect_args={
+            "statement_cache_size": settings.db_statement_cache_size,
+        },
+    )
+
+
+class ReplicaRouter:
+    """
+    Pick engines of read sessions.
+
+    healthy replicas in turn
+    the primary if no replica is healthy
+    """
+
+    def __init__(self, engines: List[AsyncEngine], primary: AsyncEngine):
+        """Init for ReplicaRouter class."""
+        self.engines = engines
+        self.primary = primary
+        self._healthy = list(engines)
+        self._turn = count()
+
+    def get_engine(self) -> AsyncEngine:
+        """Return the engine of the next healthy replica."""
+        healthy = self._healthy
+        if not healthy:
+            return self.primary
+        return healthy[next(self._turn) % len(healthy)]
+
+    async def _is_healthy(self, engine: AsyncEngine) -> bool:
+        """Check a replica answers and doesn't lag too far behind."""
+        try:
+            async with engine.connect() as connection:
+                if settings.db_replica_max_lag is None:
+                    await connection.execute(text("SELECT 1"))
+                    return True
+                lag = await connection.scalar(REPLICA_LAG_QUERY)
+        except (exc.SQLAlchemyError, OSError) as error:
+            logger.warning(
+                "Replica %s is unavailable: %s",
+                engine.url.render_as_string(),
+                error,
+            )
+            return False
+        if lag > settings.db_replica_max_lag:
+            logger.warning(
+                "Replica %s lags %.1f s behind.",
+                engine.url.render_as_string(),
+                lag,
+            )
+            return False
+        return True
+
+    async def check(self) -> None:
+        """Check all replicas and route reads to healthy ones."""
+        healthy = await asyncio.gather(
+            *(
+                asyncio.wait_for(
+                    self._is_healthy(engine),
+                    settings.db_replica_check_timeout,
+                )
+                for engine in self.engines
+            ),
+            return_exceptions=True,
+        )
+        for engine, is_healthy in zip(self.engines, healthy):
+            if isinstance(is_healthy, asyncio.TimeoutError):
+                logger.warning(
+                    "Replica %s is not checked in time.",
+                    engine.url.render_as_string(),
+                )
+        self._healthy = [
+            engine
+            for engine, is_healthy in zip(self.engines, healthy)
+            if is_healthy is True
+        ]
+
+    async def run_checks(self) -> None:
+        """Check replicas periodically."""
+        while True:
+            await self.check()
+            await asyncio.sleep(settings.db_replica_check_interval)
+
+    async def dispose(self) -> None:
+        """Close connections of all replicas."""
+        for engine in self.engines:
+            await engine.dispose()
+
+
+engine = create_pooled_engine(settings.postgres_connection_url)
+
+replica_router = ReplicaRouter(
+    [create_pooled_engine(url) for url in settings.db_replica_urls],
+    engine,
+)
+
+pooled_engines = {
+    ("primary",): engine,
+    **{
+        (f"replica_{number}",): replica
+        for number, replica in enumerate(replica_router.engines)
+    },
+}
+
+db_pool_size = Gauge(
+    "db_pool_size",
+    "Connections kept in database pools by engine.",
+    ("engine",),
+    callback=lambda: {
+        labels: pooled.pool.size() for labels, pooled in pooled_engines.items()
+    },
+)
+db_pool_checked_out = Gauge(
+    "db_pool_checked_out",
+    "Database connections in use by engine.",
+    ("engine",),
+    callback=lambda: {
+        labels: pooled.pool.checkedout()
+        for labels, pooled in pooled_engines.items()
+    },
+)
+db_pool_overflow = Gauge(
+    "db_pool_overflow",
+    "Database connections open over the pool size by engine.",
+    ("engine",),
+    callback=lambda: {
+        labels: max(pooled.pool.overflow(), 0)
+        for labels, pooled in pooled_engines.items()
+    },
+)
+
+db_session_seconds = Histogram(
+    "db_session_seconds",
+    "Time of session commits and refreshes by operation.",
+    ("operation",),
+)
+
+
+class TimedAsyncSession(AsyncSession):
+    """Async session timing commits and refreshes."""
+
+    async def commit(self) -> None:
+        """Commit the transaction and time it."""
+        with db_session_seconds.time("commit"):
+            await super().commit()
+
+    async def refresh(
+        self,
+        instance,
+        attribute_names=None,
+        with_for_update=None,
+    ) -> None:
+        """Refresh attributes of an obj and time it."""
+        with db_session_seconds.time("refresh"):
+            await super().refresh(instance, attribute_names, with_for_update)
+
+
+AsyncSessionLocal = async_sessionmaker(
+    engine,
+    class_=TimedAsyncSession,
+    expire_on_commit=False,
+)
+
+AsyncReadSessionLocal = async_sessionmaker(
+    class_=TimedAsyncSession,
+    expire_on_commit=False,
+)
+
+
+def get_read_session() -> AsyncSession:
+    """Create async db session on a replica."""
+    return AsyncReadSessionLocal(bind=replica_router.get_engine())
 
 
 async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
     """Create async db session."""
     async with AsyncSessionLocal() as session:
         yield session
+
+
+async def get_async_read_session() -> AsyncGenerator[AsyncSession, None]:
+    """
+    Create async db session on a replica.
+
+    for read-only endpoints
+    which may see writes of the last moments missing
+    """
+    async with get_read_session() as session:
+        yield session
+
+
+@asynccontextmanager
+async def on_primary(
+    session: AsyncSession,
+) -> AsyncGenerator[AsyncSession, None]:
+    """
+    Use a session on the primary.
+
+    the given one if it is bound to the primary or a new one
+    for reads written to a cache, a lagging replica would cache stale rows
+    """
+    if session.bind is engine:
+        yield session
+        return
+    async with AsyncSessionLocal() as primary:
+        yield primary
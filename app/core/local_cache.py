@@ -0,0 +1,46 @@
+"""In-process cache kept by every worker in front of redis cache."""
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Hashable, Optional
+
+
+class LocalCache:
+    """Bounded LRU cache which entries expire after ttl seconds."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        """Init for LocalCache class."""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return a fresh value by key and mark it as recently used."""
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Set a value by key evicting the least recently used one."""
+        self._data[key] = (value, monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, *keys: Hashable) -> None:
+        """Drop values by keys."""
+        for key in keys:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Drop all values."""
+        self._data.clear()
+
+    def __len__(self) -> int:
+        """Return a number of stored values."""
+        return len(self._data)
@@ -0,0 +1,243 @@
+"""
+In-process metrics of the app.
+
+Counter: monotonic value split by label values
+Gauge: current value set directly or read from a callback
+a callback of a gauge with labels returns values keyed by label values
+Histogram: distribution of observed values over buckets
+registry: every metric created in the app
+render: the registry in Prometheus text exposition format
+"""
+from bisect import bisect_left
+from collections import defaultdict
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+registry = []
+
+
+def _format_labels(
+    labelnames: Sequence[str],
+    labelvalues: Sequence[str],
+) -> str:
+    """Format label pairs of a sample."""
+    if not labelnames:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value)
+            .replace("\\", "\\\\")
+            .replace("\n", "\\n")
+            .replace('"', '\\"'),
+        )
+        for name, value in zip(labelnames, labelvalues)
+    )
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    """Format a value of a sample."""
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def _render_header(metric, metric_type: str) -> List[str]:
+    """Return HELP and TYPE lines of a metric."""
+    documentation = (
+        metric.documentation.replace("\\", "\\\\").replace("\n", "\\n")
+    )
+    return [
+        f"# HELP {metric.name} {documentation}",
+        f"# TYPE {metric.name} {metric_type}",
+    ]
+
+
+class Counter:
+    """Monotonic counter split by label values."""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+    ):
+        """Init for Counter class and register it."""
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Tuple[str, ...], float] = defaultdict(int)
+        registry.append(self)
+
+    def inc(self, *labelvalues: str, amount: float = 1) -> None:
+        """Increase a counter for certain label values."""
+        self.values[labelvalues] += amount
+
+    def snapshot(self) -> Dict[str, float]:
+        """Return current values keyed by joined label values."""
+        return {
+            ",".join(labelvalues): value
+            for labelvalues, value in self.values.items()
+        }
+
+    def render(self) -> List[str]:
+        """Return lines of the counter in text exposition format."""
+        return _render_header(self, "counter") + [
+            f"{self.name}{_format_labels(self.labelnames, labelvalues)} "
+            f"{_format_value(value)}"
+            for labelvalues, value in list(self.values.items())
+        ]
+
+
+class Gauge:
+    """Current value split by label values or read from a callback."""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        callback: Optional[
+            Callable[[], Union[float, Dict[Tuple[str, ...], float]]]
+        ] = None,
+    ):
+        """Init for Gauge class and register it."""
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self.values: Dict[Tuple[str, ...], float] = defaultdict(int)
+        registry.append(self)
+
+    def set(self, value: float, *labelvalues: str) -> None:
+        """Set a gauge for certain label values."""
+        self.values[labelvalues] = value
+
+    def _collect(self) -> Dict[Tuple[str, ...], float]:
+        """Return current values keyed by label values."""
+        if self.callback is None:
+            return dict(self.values)
+        if self.labelnames:
+            return self.callback()
+        return {(): self.callback()}
+
+    def snapshot(self) -> Dict[str, float]:
+        """Return current values keyed by joined label values."""
+        return {
+            ",".join(labelvalues): value
+            for labelvalues, value in self._collect().items()
+        }
+
+    def render(self) -> List[str]:
+        """Return lines of the gauge in text exposition format."""
+        return _render_header(self, "gauge") + [
+            f"{self.name}{_format_labels(self.labelnames, labelvalues)} "
+            f"{_format_value(value)}"
+            for labelvalues, value in self._collect().items()
+        ]
+
+
+class Histogram:
+    """Distribution of observed values split by label values."""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        """Init for Histogram class and register it."""
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.counts: Dict[Tuple[str, ...], List[int]] = {}
+        self.sums: Dict[Tuple[str, ...], float] = defaultdict(float)
+        registry.append(self)
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        """Add an observed value for certain label values."""
+        counts = self.counts.get(labelvalues)
+        if counts is None:
+            counts = self.counts[labelvalues] = [0] * (len(self.buckets) + 1)
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[labelvalues] += value
+
+    def time(self, *labelvalues: str) -> "Timer":
+        """Return a context manager observing its duration."""
+        return Timer(self, labelvalues)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """Return count and sum keyed by joined label values."""
+        return {
+            ",".join(labelvalues): {
+                "count": sum(counts),
+                "sum": self.sums[labelvalues],
+            }
+            for labelvalues, counts in self.counts.items()
+        }
+
+    def render(self) -> List[str]:
+        """
+        Return lines of the histogram in text exposition format.
+
+        cumulative counts by upper bound of buckets, sum and count
+        """
+        lines = _render_header(self, "histogram")
+        labelnames = self.labelnames + ("le",)
+        for labelvalues, counts in list(self.counts.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = _format_labels(
+                    labelnames,
+                    labelvalues + (_format_value(bound),),
+                )
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(
+                f"{self.name}_sum{labels} "
+                f"{_format_value(self.sums[labelvalues])}",
+            )
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Timer:
+    """Context manager observing its duration in a histogram."""
+
+    __slots__ = ("histogram", "labelvalues", "start")
+
+    def __init__(self, histogram: Histogram, labelvalues: Tuple[str, ...]):
+        """Init for Timer class."""
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self) -> "Timer":
+        """Start timing."""
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        """Observe the time passed."""
+        self.histogram.observe(
+            perf_counter() - self.start,
+            *self.labelvalues,
+        )
+
+
+def render() -> str:
+    """Return every metric of the registry in text exposition format."""
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,131 @@
+"""
+ASGI middlewares of the app.
+
+MetricsMiddleware: times requests by method, route and status
+ProfilingMiddleware: profiles sampled requests or ones asked by superusers
+"""
+import asyncio
+import logging
+from random import random
+from time import perf_counter
+
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.core.config import settings
+from app.core.metrics import Histogram
+from app.core.profiling import RequestProfile
+from app.core.user import is_superuser_token
+
+logger = logging.getLogger(__name__)
+
+http_request_seconds = Histogram(
+    "http_request_seconds",
+    "Time to send a whole response by method, route and status.",
+    ("method", "route", "status"),
+)
+
+
+class MetricsMiddleware:
+    """
+    Time requests until their responses are sent.
+
+    routes are labeled by their path templates
+    so ids in paths don't make new label values
+    requests matching no route are labeled as unmatched
+    """
+
+    def __init__(self, app: ASGIApp):
+        """Init for MetricsMiddleware class."""
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        """Time an http request."""
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = perf_counter()
+        status = "500"
+
+        async def send_timed(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            route = scope.get("route")
+            http_request_seconds.observe(
+                perf_counter() - start,
+                scope["method"],
+                route.path if route is not None else "unmatched",
+                status,
+            )
+
+
+class ProfilingMiddleware:
+    """
+    Profile a share of requests or ones with the profiling header.
+
+    the header is only honored with an access token of a superuser
+    requests are skipped while another one is profiled
+    the profile is dumped to files named in X-Profile-Id header
+    after the response is sent
+    """
+
+    def __init__(self, app: ASGIApp):
+        """Init for ProfilingMiddleware class."""
+        self.app = app
+
+    async def _should_profile(self, scope: Scope) -> bool:
+        """Check whether a request is to be profiled."""
+        if RequestProfile.running:
+            return False
+        headers = Headers(scope=scope)
+        if settings.profiling_header in headers:
+            scheme, _, token = headers.get("authorization", "").partition(" ")
+            return (
+                scheme.lower() == "bearer"
+                and bool(token)
+                and await is_superuser_token(token)
+            )
+        return random() < settings.profiling_sample_rate
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        """Profile an http request."""
+        if (
+            scope["type"] != "http"
+            or not await self._should_profile(scope)
+            or RequestProfile.running
+        ):
+            await self.app(scope, receive, send)
+            return
+        profile = RequestProfile(scope["method"], scope["path"])
+
+        async def send_profiled(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                message["headers"] = [
+                    *message.get("headers", ()),
+                    (b"x-profile-id", profile.name.encode()),
+                ]
+            await send(message)
+
+        try:
+            with profile:
+                await self.app(scope, receive, send_profiled)
+        finally:
+            try:
+                await asyncio.to_thread(
+                    profile.dump,
+                    settings.profiling_dir,
+                    settings.profiling_top,
+                )
+            except OSError as error:
+                logger.warning(
+                    "Profile %s is not dumped: %s",
+                    profile.name,
+                    error,
+                )
@@ -0,0 +1,92 @@
+"""
+Password hashing off the event loop.
+
+Hashes are computed in a bounded thread pool, bcrypt and pbkdf2
+release the GIL so other requests are served meanwhile.
+The scheme and rounds are set in settings, hashes of other schemes
+or rounds are still verified and are to be replaced on login.
+argon2 scheme requires argon2-cffi to be installed.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from fastapi_users.password import PasswordHelper
+from passlib.context import CryptContext
+
+from app.core.config import settings
+from app.core.metrics import Histogram
+
+PASSWORD_SCHEMES = ("bcrypt", "pbkdf2_sha256", "argon2")
+
+password_hash_seconds = Histogram(
+    "password_hash_seconds",
+    "Time to hash or verify a password with waiting for a worker.",
+    ("operation",),
+)
+
+
+def build_password_context(
+    scheme: str,
+    rounds: Optional[int] = None,
+) -> CryptContext:
+    """
+    Return a context hashing by a scheme.
+
+    other schemes are deprecated
+    hashes of other rounds need an update if rounds are set
+    """
+    policy = {}
+    if rounds is not None:
+        for option in ("default_rounds", "min_rounds", "max_rounds"):
+            policy[f"{scheme}__{option}"] = rounds
+    return CryptContext(
+        schemes=[
+            scheme,
+            *(name for name in PASSWORD_SCHEMES if name != scheme),
+        ],
+        deprecated="auto",
+        **policy,
+    )
+
+
+password_helper = PasswordHelper(
+    build_password_context(
+        settings.password_hash_scheme,
+        settings.password_hash_rounds,
+    ),
+)
+
+_executor = ThreadPoolExecutor(
+    max_workers=settings.password_hash_workers,
+    thread_name_prefix="password",
+)
+
+
+async def hash_password(password: str) -> str:
+    """Hash a password in the pool."""
+    with password_hash_seconds.time("hash"):
+        return await asyncio.get_running_loop().run_in_executor(
+            _executor,
+            password_helper.hash,
+            password,
+        )
+
+
+async def verify_and_update_password(
+    password: str,
+    hashed_password: str,
+) -> Tuple[bool, Optional[str]]:
+    """
+    Verify a password in the pool.
+
+    return whether it is valid and a new hash
+    if the current one is made by outdated scheme or rounds
+    """
+    with password_hash_seconds.time("verify"):
+        return await asyncio.get_running_loop().run_in_executor(
+            _executor,
+            password_helper.verify_and_update,
+            password,
+            hashed_password,
+        )
@@ -0,0 +1,88 @@
+"""
+Profiles of single requests for offline analysis.
+
+A profile records calls with cProfile and SQL statements
+executed in the context of the request with their time.
+It is dumped to the profiling directory as:
+NAME.prof: call profile to be loaded with pstats or snakeviz
+NAME.txt: SQL statements by time and the top calls by cumulative time
+One request is profiled at a time in a worker as cProfile is per thread,
+calls of other requests served meanwhile get into the profile as well.
+"""
+import cProfile
+import io
+import os
+import pstats
+import re
+from contextvars import ContextVar
+from datetime import datetime
+from time import perf_counter
+from typing import List, Optional, Tuple
+from uuid import uuid4
+
+_current_profile: ContextVar[Optional["RequestProfile"]] = ContextVar(
+    "current_profile",
+    default=None,
+)
+
+
+class RequestProfile:
+    """Call profile and SQL statements of one request."""
+
+    running = False
+
+    def __init__(self, method: str, path: str):
+        """Init for RequestProfile class."""
+        slug = re.sub(r"[^A-Za-z0-9]+", "_", path).strip("_")[:64] or "root"
+        self.name = (
+            f"{datetime.now():%Y%m%dT%H%M%S}-{method}-{slug}-"
+            f"{uuid4().hex[:8]}"
+        )
+        self.method = method
+        self.path = path
+        self.status = None
+        self.seconds = 0.0
+        self.queries: List[Tuple[float, str]] = []
+        self._profiler = cProfile.Profile()
+
+    def __enter__(self) -> "RequestProfile":
+        """Start recording calls and SQL statements."""
+        RequestProfile.running = True
+        self._token = _current_profile.set(self)
+        self._start = perf_counter()
+        self._profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        """Stop recording."""
+        self._profiler.disable()
+        self.seconds = perf_counter() - self._start
+        _current_profile.reset(self._token)
+        RequestProfile.running = False
+
+    def dump(self, directory: str, top: int) -> None:
+        """Write the call profile and the report to the directory."""
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, self.name)
+        self._profiler.dump_stats(path + ".prof")
+        stats = io.StringIO()
+        pstats.Stats(self._profiler, stream=stats).sort_stats(
+            "cumulative",
+        ).print_stats(top)
+        query_seconds = sum(seconds for seconds, _ in self.queries)
+        with open(path + ".txt", "w") as report:
+            report.write(
+                f"{self.method} {self.path} {self.status} "
+                f"{self.seconds * 1000:.1f} ms, "
+                f"{len(self.queries)} queries {query_seconds * 1000:.1f} ms\n",
+            )
+            for seconds, statement in sorted(self.queries, reverse=True):
+                report.write(f"\n-- {seconds * 1000:.2f} ms\n{statement}\n")
+            report.write("\n" + stats.getvalue())
+
+
+def record_query(statement: str, seconds: float) -> None:
+    """Add an SQL statement to the profile of the current request."""
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.queries.append((seconds, statement))
@@ -0,0 +1,91 @@
+"""
+Rate limits of routes by client ip or by user.
+
+Each route has a token bucket per client
+of a size of its burst refilled at its rate in requests per second,
+set by name in settings.rate_limits, a route without limits is not limited.
+A request without a token is rejected with 429 Too Many Requests.
+Requests are let through if redis is unavailable.
+"""
+import logging
+from http import HTTPStatus
+from math import ceil
+
+import redis.asyncio as redis
+from fastapi import Depends, HTTPException, Request
+
+from app.core.config import settings
+from app.core.metrics import Counter
+from app.core.redis import take_rate_limit_token
+from app.core.user import current_user
+from app.models import User
+
+logger = logging.getLogger(__name__)
+
+rate_limit_requests = Counter(
+    "rate_limit_requests_total",
+    "Requests checked by rate limits by route and result.",
+    ("name", "result"),
+)
+
+
+def get_client_ip(request: Request) -> str:
+    """
+    Return an ip address of a client.
+
+    taken from the first address of the header set by a trusted proxy
+    if settings.rate_limit_client_ip_header is set
+    """
+    header = settings.rate_limit_client_ip_header
+    if header and (forwarded := request.headers.get(header)):
+        return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+class RateLimit:
+    """Dependency limiting requests to a route by client ip."""
+
+    def __init__(self, name: str):
+        """Init for RateLimit class."""
+        self.name = name
+
+    async def check(self, client_key: str) -> None:
+        """Take a token of a client or raise 429 with Retry-After."""
+        limit = settings.rate_limits.get(self.name)
+        if not settings.rate_limit_enabled or limit is None:
+            return
+        try:
+            retry_after = await take_rate_limit_token(
+                self.name,
+                client_key,
+                *limit,
+            )
+        except redis.RedisError as error:
+            logger.warning("Rate limit %s is skipped: %s", self.name, error)
+            rate_limit_requests.inc(self.name, "skipped")
+            return
+        if retry_after:
+            rate_limit_requests.inc(self.name, "rejected")
+            raise HTTPException(
+                status_code=HTTPStatus.TOO_MANY_REQUESTS,
+                detail="Too many requests.",
+                headers={"Retry-After": str(ceil(retry_after))},
+            )
+        rate_limit_requests.inc(self.name, "allowed")
+
+    async def __call__(self, request: Request) -> None:
+        """Limit requests of a client ip."""
+        await self.check(get_client_ip(request))
+
+
+class UserRateLimit(RateLimit):
+    """Dependency limiting requests to a route by user."""
+
+    async def __call__(self, user: User = Depends(current_user)) -> None:
+        """Limit requests of a user."""
+        await self.check(str(user.id))
+
+
+register_rate_limit = RateLimit("register")
+login_rate_limit = RateLimit("login")
+mail_rate_limit = UserRateLimit("mail")
@@ -1,38 +1,522 @@
-"""Settings for redis connection and interaction with it."""
-import pickle
+"""
+Settings for redis connection and interaction with it.
+
+A ReferralCode obj is cached once under the referrer key,
+the referral code key only points to the referrer_id.
+An empty value under either key caches a missing ReferralCode obj.
+Entries expire with the ReferralCode obj plus a grace period.
+Found entries may be kept in an in-process cache of the worker,
+deleted entries are dropped from it in every worker via pub/sub.
+Optionally a short lock lets one worker load a missing entry
+or refresh an entry about to expire while the others wait or use it.
+Referral counters of a referrer are kept in a hash by day and in total.
+Users resolved from access tokens are cached as JSON snapshots
+and optionally in an in-process cache, dropped on every user change.
+Tokens of the redis JWT strategy are valid while their id is kept
+and their version matches the token version of the user.
+Rate limits are token buckets kept in a hash per route and client,
+taken from and refilled by one script call.
+Connections are taken from a bounded pool,
+every round-trip is timed by command.
+"""
+import asyncio
+import json
+import logging
+from datetime import date, datetime
+from time import monotonic, perf_counter
+from typing import Dict, List, Optional, Sequence, Tuple
+from uuid import UUID
 
 import redis.asyncio as redis
+from redis.asyncio.client import Pipeline
 
+from app.core.cache_codec import decode_referral, encode_referral
 from app.core.config import settings
+from app.core.local_cache import LocalCache
+from app.core.metrics import Counter, Gauge, Histogram
+
+REFERRAL_KEY = "referral_{}"
+REFERRAL_CODE_KEY = "referral_code_{}"
+REFERRAL_LOCK_KEY = "referral_lock_{}_{}"
+REFERRAL_STATS_KEY = "referral_stats_{}"
+REFERRAL_STATS_TOTAL = "total"
+REFERRAL_STATS_SINCE = "since"
+REFERRAL_STATS_BUILD_TTL = 60
+CACHE_INVALIDATION_CHANNEL = "cache_invalidation"
+REFERRAL_MISSING = object()
+USER_KEY = "user_{}"
+TOKEN_KEY = "token_{}"
+USER_TOKEN_VERSION_KEY = "user_token_version_{}"
+RATE_LIMIT_KEY = "rate_limit_{}_{}"
+
+logger = logging.getLogger(__name__)
+
+_EMPTY = b""
+
+referral_cache_lookups = Counter(
+    "referral_cache_lookups_total",
+    "ReferralCode lookups in redis cache by result.",
+    ("result",),
+)
+
+redis_command_seconds = Histogram(
+    "redis_command_seconds",
+    "Time of redis round-trips by command.",
+    ("command",),
+)
+
+
+class InstrumentedPipeline(Pipeline):
+    """Redis pipeline timing its round-trip."""
+
+    async def execute(self, raise_on_error: bool = True):
+        """Execute queued commands and time them."""
+        start = perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            redis_command_seconds.observe(
+                perf_counter() - start,
+                "MULTI" if self.is_transaction else "PIPELINE",
+            )
+
+
+class InstrumentedRedis(redis.Redis):
+    """Redis client timing its round-trips."""
+
+    async def execute_command(self, *args, **options):
+        """Execute a command and time it."""
+        start = perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            redis_command_seconds.observe(
+                perf_counter() - start,
+                str(args[0]).upper(),
+            )
+
+    def pipeline(
+        self,
+        transaction: bool = True,
+        shard_hint: Optional[str] = None,
+    ) -> InstrumentedPipeline:
+        """Return a pipeline timing its round-trip."""
+        return InstrumentedPipeline(
+            self.connection_pool,
+            self.response_callbacks,
+            transaction,
+            shard_hint,
+        )
+
+
+class CountingConnectionPool(redis.BlockingConnectionPool):
+    """
+    Blocking connection pool counting its connections.
+
+    created: connections made by the pool
+    in_use: connections handed out and not released yet
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Init for CountingConnectionPool class."""
+        super().__init__(*args, **kwargs)
+        self.created = 0
+        self.in_use = 0
+
+    def reset(self):
+        """Drop connections and their counts."""
+        super().reset()
+        self.created = 0
+        self.in_use = 0
+
+    def make_connection(self):
+        """Make a new connection and count it."""
+        self.created += 1
+        return super().make_connection()
+
+    async def ensure_connection(self, connection):
+        """
+        Check a connection being handed out and count it in use.
 
-redis_client = redis.Redis.from_url(
+        the pool releases it if the check fails
+        """
+        self.in_use += 1
+        await super().ensure_connection(connection)
+
+    async def release(self, connection):
+        """Release a connection back to the pool."""
+        await super().release(connection)
+        self.in_use -= 1
+
+
+redis_pool = CountingConnectionPool.from_url(
     settings.redis_connection_url.render_as_string(),
+    max_connections=settings.redis_max_connections,
+    timeout=settings.redis_pool_timeout,
+    socket_timeout=settings.redis_socket_timeout,
+    socket_connect_timeout=settings.redis_socket_connect_timeout,
+    health_check_interval=settings.redis_health_check_interval,
+)
+redis_client = InstrumentedRedis(connection_pool=redis_pool)
+
+redis_pool_in_use = Gauge(
+    "redis_pool_in_use",
+    "Redis connections in use.",
+    callback=lambda: redis_pool.in_use,
+)
+redis_pool_available = Gauge(
+    "redis_pool_available",
+    "Open redis connections waiting in the pool.",
+    callback=lambda: redis_pool.created - redis_pool.in_use,
+)
+
+referral_cache_set_seconds = Histogram(
+    "referral_cache_set_seconds",
+    "Time to set ReferralCode objs to redis cache.",
+)
+
+user_cache_lookups = Counter(
+    "user_cache_lookups_total",
+    "User lookups by access token in redis cache by result.",
+    ("result",),
+)
+
+referral_local_cache = (
+    LocalCache(
+        settings.referral_local_cache_size,
+        settings.referral_local_cache_ttl,
+    )
+    if settings.referral_local_cache_enabled
+    else None
+)
+
+user_local_cache = (
+    LocalCache(
+        settings.user_local_cache_size,
+        settings.user_local_cache_ttl,
+    )
+    if settings.user_local_cache_enabled
+    else None
+)
+
+local_caches = [
+    cache for cache in (referral_local_cache, user_local_cache)
+    if cache is not None
+]
+
+# Get an entry with its remaining time to live in milliseconds.
+_get_referral = redis_client.register_script(
+    """
+    local payload = redis.call('GET', KEYS[1])
+    if not payload then
+        return false
+    end
+    return {payload, redis.call('PTTL', KEYS[1])}
+    """,
+)
+
+
+# Count a referral only in counters which are built or being built,
+# a missing hash is left to be counted in postgres database
+# as well as a referral registered before the build started.
+_incr_referral_stats = redis_client.register_script(
+    """
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return 0
+    end
+    local since = redis.call('HGET', KEYS[1], ARGV[3])
+    if since and tonumber(ARGV[4]) < tonumber(since) then
+        return 0
+    end
+    redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+    redis.call('HINCRBY', KEYS[1], ARGV[2], 1)
+    return 1
+    """,
+)
+
+# Start building counters unless they exist,
+# the hash expires if the build is never finished.
+_open_referral_stats = redis_client.register_script(
+    """
+    if redis.call('EXISTS', KEYS[1]) == 1 then
+        return 0
+    end
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    return 1
+    """,
+)
+
+# Add counted referrals to increments made during the build
+# unless the hash is replaced meanwhile.
+_close_referral_stats = redis_client.register_script(
+    """
+    if redis.call('HGET', KEYS[1], ARGV[1]) ~= ARGV[2] then
+        return 0
+    end
+    for i = 3, #ARGV, 2 do
+        redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    redis.call('PERSIST', KEYS[1])
+    return 1
+    """,
+)
+
+# Refill a token bucket by the time passed and take a token from it.
+# Return 0 if a token is taken or milliseconds until the next one.
+_take_rate_limit_token = redis_client.register_script(
+    """
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+    local tokens = tonumber(bucket[1]) or burst
+    local updated_at = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+    local retry_after = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        retry_after = math.ceil((1 - tokens) / rate * 1000)
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return retry_after
+    """,
 )
 
 
-async def get_referral_redis(field):
+async def open_redis():
+    """Check the connection to redis on startup."""
+    await redis_client.ping()
+
+
+async def close_redis():
+    """Close the client and connections of the pool on shutdown."""
+    await redis_client.aclose(close_connection_pool=True)
+
+
+def _get_referral_key(field_name, value) -> str:
+    """Return a key of a ReferralCode obj in redis cache."""
+    key = REFERRAL_CODE_KEY if field_name == "code" else REFERRAL_KEY
+    return key.format(value)
+
+
+def _get_pointed_key(pointer: Optional[bytes]) -> Optional[str]:
+    """Return a key of an entry a referral code points to."""
+    if pointer is None or pointer == _EMPTY:
+        return None
+    return REFERRAL_KEY.format(pointer.decode())
+
+
+async def _get_referral_entry(field_name, key):
     """
-    Get a ReferralCode obj from redis cache.
+    Get an entry and its time to live.
+
+    a referral code pointer is read first and the entry it points to next
+    so a script is passed every key it touches
+    """
+    if field_name == "code":
+        pointer = await redis_client.get(key)
+        if pointer == _EMPTY:
+            return _EMPTY, -1
+        key = _get_pointed_key(pointer)
+        if key is None:
+            return None
+    return await _get_referral(keys=[key])
+
+
+async def _get_referral_entries(field_name, keys: Sequence[str]) -> List:
+    """
+    Get entries without their time to live.
+
+    in one round-trip
+    or two for referral codes: pointers first and entries they point to next
+    """
+    values = await redis_client.mget(keys)
+    if field_name == "code":
+        pointed_keys = [
+            key for key in map(_get_pointed_key, values) if key is not None
+        ]
+        payloads = iter(
+            await redis_client.mget(pointed_keys) if pointed_keys else (),
+        )
+        values = [
+            value if _get_pointed_key(value) is None else next(payloads)
+            for value in values
+        ]
+    return [None if value is None else (value, -1) for value in values]
+
+
+def _decode_referral_entry(field_name, value, entry):
+    """
+    Decode an entry with its time to live.
+
+    return None if there is no entry, its codec version is outdated
+    or a pointer is left from a replaced code
+    return REFERRAL_MISSING if a missing ReferralCode obj is cached
+    """
+    payload, ttl = (None, None) if entry is None else entry
+    if payload == _EMPTY:
+        referral_cache_lookups.inc("negative_hit")
+        return REFERRAL_MISSING, ttl
+    code_obj = None if payload is None else decode_referral(payload)
+    if code_obj is None or getattr(code_obj, field_name) != value:
+        referral_cache_lookups.inc("miss")
+        return None, ttl
+    referral_cache_lookups.inc("hit")
+    return code_obj, ttl
+
+
+async def get_referral_redis(field_name, value, on_stale=None):
+    """
+    Get a ReferralCode read model from redis cache.
 
     by referrer_id
     or
     by referral code
+    return None if there is no entry, its codec version is outdated
+    or a pointer is left from a replaced code
+    return REFERRAL_MISSING if a missing ReferralCode obj is cached
+    call on_stale() if the entry is about to expire
+    and this worker has taken the lock to refresh it
     """
-    await redis_client.get(
-        f"referral_{field}",
+    key = _get_referral_key(field_name, value)
+    if referral_local_cache is not None:
+        if code_obj := referral_local_cache.get(key):
+            referral_cache_lookups.inc("local_hit")
+            return code_obj
+    code_obj, ttl = _decode_referral_entry(
+        field_name,
+        value,
+        await _get_referral_entry(field_name, key),
+    )
+    if code_obj is None or code_obj is REFERRAL_MISSING:
+        return code_obj
+    if (
+        on_stale is not None
+        and settings.referral_cache_lock_enabled
+        and 0 <= ttl < settings.referral_cache_stale_window * 1000
+        and await acquire_referral_lock(field_name, value)
+    ):
+        referral_cache_lookups.inc("stale_hit")
+        on_stale()
+    elif referral_local_cache is not None:
+        referral_local_cache.set(key, code_obj)
+    return code_obj
+
+
+async def get_referrals_redis(field_name, values: Sequence) -> List:
+    """
+    Get ReferralCode read models from redis cache in one round-trip.
+
+    by referrer_ids
+    or
+    by referral codes in two round-trips
+    an item per value: a read model, None or REFERRAL_MISSING
+    as returned by get_referral_redis
+    """
+    keys = [_get_referral_key(field_name, value) for value in values]
+    code_objs = [None] * len(keys)
+    pending = []
+    for index, key in enumerate(keys):
+        if referral_local_cache is not None and (
+            code_obj := referral_local_cache.get(key)
+        ):
+            referral_cache_lookups.inc("local_hit")
+            code_objs[index] = code_obj
+        else:
+            pending.append(index)
+    if not pending:
+        return code_objs
+    entries = await _get_referral_entries(
+        field_name,
+        [keys[index] for index in pending],
+    )
+    for index, entry in zip(pending, entries):
+        code_obj, _ = _decode_referral_entry(field_name, values[index], entry)
+        code_objs[index] = code_obj
+        if referral_local_cache is not None and code_obj not in (
+            None,
+            REFERRAL_MISSING,
+        ):
+            referral_local_cache.set(keys[index], code_obj)
+    return code_objs
+
+
+async def wait_referral_redis(field_name, value):
+    """
+    Wait for a ReferralCode obj to appear in redis cache.
+
+    while another worker holds the lock to load it
+    return None if the lock expires first
+    """
+    deadline = monotonic() + settings.referral_cache_lock_timeout
+    while monotonic() < deadline:
+        await asyncio.sleep(settings.referral_cache_lock_poll_interval)
+        if code_obj := await get_referral_redis(field_name, value):
+            return code_obj
+    return None
+
+
+async def acquire_referral_lock(field_name, value) -> bool:
+    """Take a short lock to load a ReferralCode obj to redis cache."""
+    return bool(
+        await redis_client.set(
+            REFERRAL_LOCK_KEY.format(field_name, value),
+            1,
+            nx=True,
+            px=int(settings.referral_cache_lock_timeout * 1000),
+        ),
     )
 
 
+async def release_referral_lock(field_name, value):
+    """Release a lock to load a ReferralCode obj to redis cache."""
+    await redis_client.delete(REFERRAL_LOCK_KEY.format(field_name, value))
+
+
 async def delete_referral_redis(db_obj):
     """
     Delete a ReferralCode obj from redis cache.
 
     by referrer_id
     by referral code
+    from in-process caches of all workers
+    """
+    keys = (
+        REFERRAL_KEY.format(db_obj.referrer_id),
+        REFERRAL_CODE_KEY.format(db_obj.code),
+    )
+    if referral_local_cache is None:
+        await redis_client.delete(*keys)
+        return
+    referral_local_cache.pop(*keys)
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.delete(*keys)
+        pipe.publish(CACHE_INVALIDATION_CHANNEL, " ".join(keys))
+        await pipe.execute()
+
+
+def get_referral_ttl(db_obj) -> int:
+    """
+    Return seconds a ReferralCode obj is kept in redis cache.
+
+    until its expiration plus a grace period
+    not longer than the cache ceiling
+    an expired obj is kept as long as a missing one
     """
-    await redis_client.delete(
-        f"referral_{db_obj.referrer_id}",
-        f"referral_{db_obj.code}",
+    if db_obj.expiration_at is None:
+        return settings.referral_cache_max_ttl
+    remaining = (db_obj.expiration_at - datetime.now()).total_seconds()
+    return max(
+        settings.referral_cache_negative_ttl,
+        min(
+            settings.referral_cache_max_ttl,
+            int(remaining) + settings.referral_cache_grace,
+        ),
     )
 
 
@@ -40,12 +524,341 @@ async def set_referral_redis(db_obj):
     """
     Set a ReferralCode obj to redis cache.
 
+    entry by referrer_id
+    pointer to referrer_id by referral code
+    both expire with the obj
+    """
+    await set_referral_redis_many((db_obj,), invalidate=False)
+
+
+async def set_referral_redis_many(
+    db_objs: Sequence,
+    replaced_codes: Sequence[Optional[str]] = (),
+    invalidate: bool = True,
+):
+    """
+    Set ReferralCode objs to redis cache in one pipeline.
+
+    entries by referrer_id
+    pointers to referrer_id by referral code
+    both expire with the objs
+    pointers of replaced codes are deleted
+    entries of changed objs are dropped from in-process caches
+    of all workers
+    """
+    with referral_cache_set_seconds.time():
+        stale_keys = [
+            REFERRAL_CODE_KEY.format(code)
+            for code, db_obj in zip(replaced_codes, db_objs)
+            if code is not None and code != db_obj.code
+        ]
+        async with redis_client.pipeline(transaction=False) as pipe:
+            if stale_keys:
+                pipe.delete(*stale_keys)
+            for db_obj in db_objs:
+                ttl = get_referral_ttl(db_obj)
+                pipe.set(
+                    REFERRAL_KEY.format(db_obj.referrer_id),
+                    encode_referral(db_obj),
+                    ex=ttl,
+                )
+                pipe.set(
+                    REFERRAL_CODE_KEY.format(db_obj.code),
+                    str(db_obj.referrer_id),
+                    ex=ttl,
+                )
+            if referral_local_cache is not None and invalidate and db_objs:
+                keys = stale_keys + [
+                    REFERRAL_KEY.format(db_obj.referrer_id)
+                    for db_obj in db_objs
+                ]
+                referral_local_cache.pop(*keys)
+                pipe.publish(CACHE_INVALIDATION_CHANNEL, " ".join(keys))
+            await pipe.execute()
+
+
+async def set_missing_referral_redis(field_name, value):
+    """
+    Cache a missing ReferralCode obj for a short time.
+
     by referrer_id
+    or
     by referral code
     """
-    await redis_client.mset(
-        {
-            f"referral_{db_obj.referrer_id}": pickle.dumps(db_obj),
-            f"referral_{db_obj.code}": pickle.dumps(db_obj),
-        },
+    await redis_client.set(
+        _get_referral_key(field_name, value),
+        _EMPTY,
+        ex=settings.referral_cache_negative_ttl,
+    )
+
+
+async def set_missing_referrals_redis(field_name, values: Sequence):
+    """
+    Cache missing ReferralCode objs for a short time in one pipeline.
+
+    by referrer_ids
+    or
+    by referral codes
+    """
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for value in values:
+            pipe.set(
+                _get_referral_key(field_name, value),
+                _EMPTY,
+                ex=settings.referral_cache_negative_ttl,
+            )
+        await pipe.execute()
+
+
+async def incr_referral_stats_redis(referrer_id, registered_at: datetime):
+    """
+    Count a new referral of a referrer in total and by day.
+
+    only if counters of the referrer are built
+    or being built since before the registration
+    otherwise they are counted on the next read
+    """
+    await _incr_referral_stats(
+        keys=[REFERRAL_STATS_KEY.format(referrer_id)],
+        args=[
+            REFERRAL_STATS_TOTAL,
+            registered_at.date().isoformat(),
+            REFERRAL_STATS_SINCE,
+            registered_at.timestamp(),
+        ],
+    )
+
+
+async def get_referral_stats_redis(
+    referrer_id,
+    days: Sequence[date],
+) -> Optional[Tuple[int, Dict[date, int]]]:
+    """
+    Get referral counters of a referrer.
+
+    in total and for certain days
+    return None if counters are not built yet
+    """
+    since, total, *counts = await redis_client.hmget(
+        REFERRAL_STATS_KEY.format(referrer_id),
+        REFERRAL_STATS_SINCE,
+        REFERRAL_STATS_TOTAL,
+        *(day.isoformat() for day in days),
+    )
+    if since is not None or total is None:
+        return None
+    return int(total), {
+        day: int(count or 0) for day, count in zip(days, counts)
+    }
+
+
+def _dump_referral_stats(total: int, daily: Dict[date, int]) -> dict:
+    """Return fields of a counters hash."""
+    return {
+        REFERRAL_STATS_TOTAL: total,
+        **{day.isoformat(): count for day, count in daily.items()},
+    }
+
+
+async def open_referral_stats_redis(referrer_id, since: datetime) -> bool:
+    """
+    Start building referral counters of a referrer.
+
+    unless they are built or being built already
+    referrals registered since then are counted in redis
+    return whether the build is started
+    """
+    return bool(
+        await _open_referral_stats(
+            keys=[REFERRAL_STATS_KEY.format(referrer_id)],
+            args=[
+                REFERRAL_STATS_SINCE,
+                since.timestamp(),
+                REFERRAL_STATS_BUILD_TTL,
+            ],
+        ),
+    )
+
+
+async def close_referral_stats_redis(
+    referrer_id,
+    since: datetime,
+    total: int,
+    daily: Dict[date, int],
+):
+    """
+    Finish building referral counters of a referrer.
+
+    referrals registered before the build started
+    are added in total and by day
+    """
+    await _close_referral_stats(
+        keys=[REFERRAL_STATS_KEY.format(referrer_id)],
+        args=[
+            REFERRAL_STATS_SINCE,
+            since.timestamp(),
+            *(
+                item
+                for pair in _dump_referral_stats(total, daily).items()
+                for item in pair
+            ),
+        ],
+    )
+
+
+async def set_referral_stats_redis(
+    stats: Dict[UUID, Tuple[int, Dict[date, int]]],
+):
+    """
+    Replace referral counters of referrers in total and by day.
+
+    referrals counted after they are counted in postgres database
+    are lost until the next replacement
+    """
+    async with redis_client.pipeline(transaction=True) as pipe:
+        for referrer_id, (total, daily) in stats.items():
+            key = REFERRAL_STATS_KEY.format(referrer_id)
+            pipe.delete(key)
+            pipe.hset(key, mapping=_dump_referral_stats(total, daily))
+        await pipe.execute()
+
+
+async def get_user_redis(user_id) -> Optional[dict]:
+    """
+    Get a user snapshot from redis cache.
+
+    from the in-process cache first if it is enabled
+    return None if there is no snapshot
+    """
+    key = USER_KEY.format(user_id)
+    if user_local_cache is not None:
+        if data := user_local_cache.get(key):
+            user_cache_lookups.inc("local_hit")
+            return data
+    payload = await redis_client.get(key)
+    if payload is None:
+        user_cache_lookups.inc("miss")
+        return None
+    user_cache_lookups.inc("hit")
+    data = json.loads(payload)
+    if user_local_cache is not None:
+        user_local_cache.set(key, data)
+    return data
+
+
+async def set_user_redis(user_id, data: dict):
+    """Set a user snapshot to redis cache."""
+    await redis_client.set(
+        USER_KEY.format(user_id),
+        json.dumps(data, default=str),
+        ex=settings.user_cache_ttl,
     )
+
+
+async def delete_user_redis(user_id):
+    """
+    Delete a user snapshot from redis cache.
+
+    from in-process caches of all workers
+    """
+    key = USER_KEY.format(user_id)
+    if user_local_cache is None:
+        await redis_client.delete(key)
+        return
+    user_local_cache.pop(key)
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.delete(key)
+        pipe.publish(CACHE_INVALIDATION_CHANNEL, key)
+        await pipe.execute()
+
+
+async def add_token_redis(token_id: str, user_id, lifetime: int) -> int:
+    """
+    Keep a token id for its lifetime.
+
+    return the token version of the user
+    which is kept as long as its newest token
+    """
+    version_key = USER_TOKEN_VERSION_KEY.format(user_id)
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.set(TOKEN_KEY.format(token_id), str(user_id), ex=lifetime)
+        pipe.get(version_key)
+        pipe.expire(version_key, lifetime)
+        _, version, _ = await pipe.execute()
+    return int(version or 0)
+
+
+async def check_token_redis(token_id: str, user_id, version: int) -> bool:
+    """Check a token id is kept and its version is current."""
+    owner, current_version = await redis_client.mget(
+        TOKEN_KEY.format(token_id),
+        USER_TOKEN_VERSION_KEY.format(user_id),
+    )
+    return (
+        owner is not None
+        and owner.decode() == str(user_id)
+        and int(current_version or 0) == version
+    )
+
+
+async def delete_token_redis(token_id: str):
+    """Revoke a token."""
+    await redis_client.delete(TOKEN_KEY.format(token_id))
+
+
+async def revoke_user_tokens_redis(user_id):
+    """Revoke all tokens of a user by increasing its token version."""
+    async with redis_client.pipeline(transaction=True) as pipe:
+        version_key = USER_TOKEN_VERSION_KEY.format(user_id)
+        pipe.incr(version_key)
+        pipe.expire(version_key, settings.jwt_lifetime_seconds)
+        await pipe.execute()
+
+
+async def take_rate_limit_token(
+    name: str,
+    client_key: str,
+    rate: float,
+    burst: int,
+) -> float:
+    """
+    Take a token from a bucket of a route and a client.
+
+    the bucket holds up to burst tokens and gains rate tokens per second
+    return 0 if a token is taken or seconds until the next one
+    """
+    retry_after = await _take_rate_limit_token(
+        keys=[RATE_LIMIT_KEY.format(name, client_key)],
+        args=[rate, burst],
+    )
+    return retry_after / 1000
+
+
+async def listen_cache_invalidations():
+    """
+    Drop entries deleted by any worker from in-process caches.
+
+    poll the channel as a blocking read would hit the socket timeout
+    resubscribe after a lost connection
+    and clear the caches as messages could be missed meanwhile
+    """
+    while True:
+        try:
+            async with redis_client.pubsub() as pubsub:
+                await pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+                for cache in local_caches:
+                    cache.clear()
+                while True:
+                    message = await pubsub.get_message(
+                        ignore_subscribe_messages=True,
+                        timeout=settings.redis_socket_timeout,
+                    )
+                    if message is not None:
+                        keys = message["data"].decode().split()
+                        for cache in local_caches:
+                            cache.pop(*keys)
+        except (redis.ConnectionError, redis.TimeoutError):
+            logger.warning("Cache invalidation channel is lost.")
+            for cache in local_caches:
+                cache.clear()
+            await asyncio.sleep(1)
@@ -1,34 +1,233 @@
 """Initialization and settigs for FastAPI Users."""
-from typing import Optional, Union
-from uuid import UUID
+import json
+import logging
+from datetime import datetime
+from typing import Any, Dict, Optional, Union
+from uuid import UUID, uuid4
 
+import jwt
+import redis.asyncio as redis
 from fastapi import Depends, Request
+from fastapi.security import OAuth2PasswordRequestForm
 from fastapi_users import (BaseUserManager, FastAPIUsers,
-                           InvalidPasswordException, UUIDIDMixin, models,
-                           schemas)
+                           InvalidPasswordException, UUIDIDMixin, exceptions,
+                           models, schemas)
 from fastapi_users.authentication import (AuthenticationBackend,
                                           BearerTransport, JWTStrategy)
+from fastapi_users.jwt import decode_jwt, generate_jwt
 from fastapi_users_db_sqlalchemy import SQLAlchemyUserDatabase
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import make_transient_to_detached
 
 from app.core.config import settings
-from app.core.database import get_async_session
+from app.core.database import AsyncSessionLocal, get_async_session
+from app.core.password import (hash_password, password_helper,
+                               verify_and_update_password)
+from app.core.redis import (add_token_redis, check_token_redis,
+                            delete_token_redis, delete_user_redis,
+                            get_user_redis, incr_referral_stats_redis,
+                            revoke_user_tokens_redis, set_user_redis)
+from app.crud import crud_user
 from app.models import User
 from app.schemas import ReferrerIdUserCreate, UserCreate
 from app.validators import check_referral_code_exists_and_valid
 
+logger = logging.getLogger(__name__)
+
+
+class ReferralUserDatabase(SQLAlchemyUserDatabase):
+    """SQLAlchemyUserDatabase keeping the referral closure of new users."""
+
+    async def create(self, create_dict: Dict[str, Any]) -> User:
+        """
+        OVERRIDE to add a user to the referral tree.
+
+        in the same transaction as the user is created
+        """
+        user = self.user_table(**create_dict)
+        self.session.add(user)
+        if user.referrer_id is not None:
+            await self.session.flush()
+            await crud_user.add_to_referral_tree(
+                user.id,
+                user.referrer_id,
+                self.session,
+            )
+        await self.session.commit()
+        await self.session.refresh(user)
+        return user
+
 
 async def get_user_db(session: AsyncSession = Depends(get_async_session)):
-    """Create a db session with SQLAlchemyUserDatabase adapted."""
-    yield SQLAlchemyUserDatabase(session, User)
+    """Create a db session with ReferralUserDatabase adapted."""
+    yield ReferralUserDatabase(session, User)
 
 
 bearer_transport = BearerTransport(tokenUrl="auth/jwt/login")
 
+USER_SNAPSHOT_FIELDS = tuple(
+    column.key
+    for column in User.__table__.columns
+    if column.key != "hashed_password"
+)
+
+
+def dump_user(user: User) -> Dict[str, Any]:
+    """Take a snapshot of a User obj without its password hash."""
+    return {field: getattr(user, field) for field in USER_SNAPSHOT_FIELDS}
+
+
+def load_user(data: Dict[str, Any]) -> User:
+    """
+    Build a User obj from its snapshot.
+
+    detached from any session as if it was loaded and the session closed
+    so an update of it is saved as UPDATE
+    its password hash is loaded as None, not being in the snapshot,
+    so no column is left to be loaded from the database
+    """
+    values = dict(data, hashed_password=None)
+    values["id"] = UUID(values["id"])
+    if values["referrer_id"] is not None:
+        values["referrer_id"] = UUID(values["referrer_id"])
+    if values["created_at"] is not None:
+        values["created_at"] = datetime.fromisoformat(values["created_at"])
+    user = User(**values)
+    make_transient_to_detached(user)
+    return user
+
+
+class CachedJWTStrategy(JWTStrategy):
+    """
+    JWT strategy resolving users from redis cache.
+
+    a user is loaded from postgres database on a cache miss only
+    its snapshot is dropped on changes made by the user manager,
+    changes made elsewhere are seen after the cache ttl
+    """
+
+    async def read_token(
+        self,
+        token: Optional[str],
+        user_manager: BaseUserManager[models.UP, models.ID],
+    ) -> Optional[models.UP]:
+        """Return a user of a valid token."""
+        if token is None:
+            return None
+        try:
+            user_id = decode_jwt(
+                token,
+                self.decode_key,
+                self.token_audience,
+                algorithms=[self.algorithm],
+            ).get("sub")
+        except jwt.PyJWTError:
+            return None
+        if user_id is None:
+            return None
+        if data := await get_user_redis(user_id):
+            return load_user(data)
+        try:
+            user = await user_manager.get(user_manager.parse_id(user_id))
+        except (exceptions.UserNotExists, exceptions.InvalidID):
+            return None
+        await set_user_redis(user.id, dump_user(user))
+        return user
+
+
+class RedisJWTStrategy(JWTStrategy):
+    """
+    JWT strategy with tokens kept in redis.
+
+    a token carries its id, the token version of the user
+    and a snapshot of the user to authorize without postgres database
+    a token is valid while its id is kept in redis
+    and its version is current
+    logout revokes one token, a new token version revokes all of them
+    the user is built from the snapshot with every column loaded
+    but its password hash
+    """
+
+    USER_CLAIMS = tuple(
+        field for field in USER_SNAPSHOT_FIELDS if field != "id"
+    )
+
+    async def write_token(self, user: models.UP) -> str:
+        """Return a new token of the user and keep its id."""
+        token_id = uuid4().hex
+        version = await add_token_redis(
+            token_id,
+            user.id,
+            self.lifetime_seconds,
+        )
+        data = {
+            "sub": str(user.id),
+            "aud": self.token_audience,
+            "jti": token_id,
+            "ver": version,
+        }
+        snapshot = {claim: getattr(user, claim) for claim in self.USER_CLAIMS}
+        data.update(json.loads(json.dumps(snapshot, default=str)))
+        return generate_jwt(
+            data,
+            self.encode_key,
+            self.lifetime_seconds,
+            algorithm=self.algorithm,
+        )
+
+    def _decode(self, token: str) -> Optional[Dict[str, Any]]:
+        """Return claims of a token with a valid signature."""
+        try:
+            data = decode_jwt(
+                token,
+                self.decode_key,
+                self.token_audience,
+                algorithms=[self.algorithm],
+            )
+        except jwt.PyJWTError:
+            return None
+        if any(
+            claim not in data
+            for claim in ("sub", "jti", "ver", *self.USER_CLAIMS)
+        ):
+            return None
+        return data
+
+    async def read_token(
+        self,
+        token: Optional[str],
+        user_manager: BaseUserManager[models.UP, models.ID],
+    ) -> Optional[models.UP]:
+        """Return a user of a valid and not revoked token."""
+        if token is None or (data := self._decode(token)) is None:
+            return None
+        if not await check_token_redis(data["jti"], data["sub"], data["ver"]):
+            return None
+        return load_user(
+            {
+                "id": data["sub"],
+                **{claim: data[claim] for claim in self.USER_CLAIMS},
+            },
+        )
+
+    async def destroy_token(self, token: str, user: models.UP) -> None:
+        """Revoke a token."""
+        if (data := self._decode(token)) is not None:
+            await delete_token_redis(data["jti"])
+
 
 def get_jwt_strategy() -> JWTStrategy:
     """Set JWT strategy for FastAPI Users."""
-    return JWTStrategy(secret=settings.secret, lifetime_seconds=3600)
+    if settings.jwt_redis_enabled:
+        strategy_class = RedisJWTStrategy
+    elif settings.user_cache_enabled:
+        strategy_class = CachedJWTStrategy
+    else:
+        strategy_class = JWTStrategy
+    return strategy_class(
+        secret=settings.secret,
+        lifetime_seconds=settings.jwt_lifetime_seconds,
+    )
 
 
 auth_backend = AuthenticationBackend(
@@ -53,7 +252,7 @@ class UserManager(UUIDIDMixin, BaseUserManager[User, UUID]):
         """
         OVERRIDE to process referral code on user creation.
 
-        Create a user in database.
+        Create a user in database with the password hashed in the pool.
         """
         referral_code = user_create.__dict__.get("referral_code")
         if referral_code is not None:
@@ -68,7 +267,49 @@ class UserManager(UUIDIDMixin, BaseUserManager[User, UUID]):
             create_dict["referrer_id"] = code_obj.referrer_id
             user_create = ReferrerIdUserCreate(**create_dict)
 
-        return await super().create(user_create, safe, request)
+        await self.validate_password(user_create.password, user_create)
+        if await self.user_db.get_by_email(user_create.email) is not None:
+            raise exceptions.UserAlreadyExists()
+        user_dict = (
+            user_create.create_update_dict()
+            if safe
+            else user_create.create_update_dict_superuser()
+        )
+        user_dict["hashed_password"] = await hash_password(
+            user_dict.pop("password"),
+        )
+        created_user = await self.user_db.create(user_dict)
+        await self.on_after_register(created_user, request)
+        return created_user
+
+    async def authenticate(
+        self,
+        credentials: OAuth2PasswordRequestForm,
+    ) -> Optional[User]:
+        """
+        OVERRIDE to verify a password in the pool.
+
+        a password is hashed for an unknown email as well
+        so its response takes as long
+        a hash of outdated scheme or rounds is replaced
+        """
+        try:
+            user = await self.get_by_email(credentials.username)
+        except exceptions.UserNotExists:
+            await hash_password(credentials.password)
+            return None
+        verified, updated_password_hash = await verify_and_update_password(
+            credentials.password,
+            user.hashed_password,
+        )
+        if not verified:
+            return None
+        if updated_password_hash is not None:
+            await self.user_db.update(
+                user,
+                {"hashed_password": updated_password_hash},
+            )
+        return user
 
     async def validate_password(
         self,
@@ -89,12 +330,55 @@ class UserManager(UUIDIDMixin, BaseUserManager[User, UUID]):
         self, user: User, request: Optional[Request] = None,
     ):
         """Actions after User registrations."""
+        if user.referrer_id is not None:
+            try:
+                await incr_referral_stats_redis(
+                    user.referrer_id,
+                    user.created_at,
+                )
+            except redis.RedisError as error:
+                logger.warning(
+                    "Referral of user %s is not counted: %s", user.id, error,
+                )
         print(f"User {user.id} has registered.") # noqa
 
+    async def on_after_update(
+        self,
+        user: User,
+        update_dict: Dict[str, Any],
+        request: Optional[Request] = None,
+    ):
+        """
+        Drop a cached snapshot of the user after its update.
+
+        revoke its tokens as their claims may be outdated
+        """
+        await delete_user_redis(user.id)
+        await revoke_user_tokens_redis(user.id)
+
+    async def on_after_verify(
+        self, user: User, request: Optional[Request] = None,
+    ):
+        """Drop a cached snapshot of the user after its verification."""
+        await delete_user_redis(user.id)
+
+    async def on_after_delete(
+        self, user: User, request: Optional[Request] = None,
+    ):
+        """Drop a cached snapshot and tokens of the user after its deletion."""
+        await delete_user_redis(user.id)
+        await revoke_user_tokens_redis(user.id)
+
+    async def on_after_reset_password(
+        self, user: User, request: Optional[Request] = None,
+    ):
+        """Revoke tokens of the user after its password reset."""
+        await revoke_user_tokens_redis(user.id)
+
 
 async def get_user_manager(user_db=Depends(get_user_db)):
     """Get user manager and bind int to db session."""
-    yield UserManager(user_db)
+    yield UserManager(user_db, password_helper)
 
 
 fastapi_users = FastAPIUsers[User, UUID](
@@ -104,3 +388,17 @@ fastapi_users = FastAPIUsers[User, UUID](
 
 current_user = fastapi_users.current_user(active=True)
 current_superuser = fastapi_users.current_user(active=True, superuser=True)
+
+
+async def is_superuser_token(token: str) -> bool:
+    """
+    Check that an access token belongs to an active superuser.
+
+    outside of request dependencies
+    """
+    async with AsyncSessionLocal() as session:
+        user = await get_jwt_strategy().read_token(
+            token,
+            UserManager(ReferralUserDatabase(session, User)),
+        )
+    return user is not None and user.is_active and user.is_superuser
@@ -1,3 +1,4 @@
 """crud/init."""
+from .mail import crud_mail_outbox  # noqa
 from .referral import crud_referral  # noqa
 from .user import crud_user  # noqa
@@ -0,0 +1,136 @@
+"""CRUD class description for MailOutbox model."""
+from datetime import datetime, timedelta
+from typing import Sequence, Type
+from uuid import UUID
+
+from sqlalchemy import Row, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.crud.referral import ModelType
+from app.models import MailOutbox
+
+
+class CRUDMailOutbox:
+    """CRUD class for MailOutbox model."""
+
+    def __init__(self, model: Type[ModelType]):
+        """Init for CRUDMailOutbox class."""
+        self.model = model
+
+    async def add(
+        self,
+        user_id: UUID,
+        idempotency_key: str,
+        recipient: str,
+        subject: str,
+        body: str,
+        session: AsyncSession,
+    ) -> None:
+        """
+        Add a message to the outbox.
+
+        skip it if a message of the user
+        with the same idempotency key exists
+        """
+        await session.execute(
+            insert(self.model)
+            .values(
+                user_id=user_id,
+                idempotency_key=idempotency_key,
+                recipient=recipient,
+                subject=subject,
+                body=body,
+            )
+            .on_conflict_do_nothing(
+                index_elements=["user_id", "idempotency_key"],
+            ),
+        )
+        await session.commit()
+
+    async def claim(
+        self,
+        batch_size: int,
+        session: AsyncSession,
+    ) -> Sequence[Row]:
+        """
+        Claim pending messages due to be sent.
+
+        as rows of id, recipient, subject, body and attempts
+        rows locked by other workers are skipped
+        claimed messages are hidden from other workers for the lease time
+        so messages of a crashed worker are claimed again afterwards
+        """
+        now = datetime.now()
+        due = (
+            select(self.model.id)
+            .where(
+                self.model.status == "pending",
+                self.model.next_attempt_at <= now,
+            )
+            .order_by(self.model.next_attempt_at)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        claimed = await session.execute(
+            update(self.model)
+            .where(self.model.id.in_(due.scalar_subquery()))
+            .values(
+                attempts=self.model.attempts + 1,
+                next_attempt_at=now + timedelta(
+                    seconds=settings.mail_outbox_lease,
+                ),
+            )
+            .returning(
+                self.model.id,
+                self.model.recipient,
+                self.model.subject,
+                self.model.body,
+                self.model.attempts,
+            ),
+        )
+        await session.commit()
+        return claimed.all()
+
+    async def mark_sent(
+        self,
+        ids: Sequence[int],
+        session: AsyncSession,
+    ) -> None:
+        """Mark messages as sent."""
+        await session.execute(
+            update(self.model)
+            .where(self.model.id.in_(ids))
+            .values(status="sent", sent_at=datetime.now(), last_error=None),
+        )
+        await session.commit()
+
+    async def mark_failed(
+        self,
+        message: Row,
+        error: Exception,
+        session: AsyncSession,
+    ) -> None:
+        """
+        Mark a message as failed.
+
+        schedule the next attempt with exponential backoff
+        or move it to dead letters after the last attempt
+        """
+        values = {"last_error": repr(error)}
+        if message.attempts >= settings.mail_outbox_max_attempts:
+            values["status"] = "dead"
+        else:
+            values["next_attempt_at"] = datetime.now() + timedelta(
+                seconds=settings.mail_outbox_backoff * 2 ** message.attempts,
+            )
+        await session.execute(
+            update(self.model)
+            .where(self.model.id == message.id)
+            .values(**values),
+        )
+        await session.commit()
+
+
+crud_mail_outbox = CRUDMailOutbox(MailOutbox)
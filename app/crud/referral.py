@@ -1,19 +1,59 @@
 """CRUD class description for ReferralCode model."""
-import pickle
+import asyncio
 from datetime import datetime
-from typing import Optional, Type, TypeVar
+from functools import partial
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional, Sequence, Type, TypeVar
+from uuid import UUID
 
-from sqlalchemy import select
+from sqlalchemy import Executable, Result, delete, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.core.database import Base
-from app.core.redis import (delete_referral_redis, get_referral_redis,
-                            set_referral_redis)
+from app.core.cache_codec import CachedReferralCode
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal, Base, on_primary
+from app.core.metrics import Counter, Histogram
+from app.core.redis import (REFERRAL_MISSING, acquire_referral_lock,
+                            delete_referral_redis, get_referral_redis,
+                            get_referrals_redis, release_referral_lock,
+                            set_missing_referral_redis,
+                            set_missing_referrals_redis, set_referral_redis,
+                            set_referral_redis_many, wait_referral_redis)
+from app.core.single_flight import SingleFlight
 from app.models import ReferralCode, User
-from app.services.referral import calculate_end_date, generate_referral_code
+from app.services.referral import (calculate_end_date, check_referral_code,
+                                   generate_referral_code,
+                                   normalize_referral_code)
 
 ModelType = TypeVar("ModelType", bound=Base)
 
+CODE_INDEX = "ix_referralcode_code"
+UNIQUE_VIOLATION = "23505"
+# asyncpg binds at most 32767 parameters per statement,
+# an upserted row takes 4 of them and 1 more to read a code it replaces
+UPSERT_MAX_ROWS = 32767 // 5
+
+referral_code_conflicts = Counter(
+    "referral_code_conflicts_total",
+    "Referral code writes retried as a generated code was taken.",
+)
+referral_lookup_seconds = Histogram(
+    "referral_lookup_seconds",
+    "Time to get a ReferralCode obj by the source it is found in.",
+    ("source",),
+)
+
+
+def _is_code_conflict(error: IntegrityError) -> bool:
+    """Return whether an error is raised as a generated code is taken."""
+    return (
+        getattr(error.orig, "sqlstate", None) == UNIQUE_VIOLATION
+        and getattr(error.orig.__cause__, "constraint_name", None)
+        == CODE_INDEX
+    )
+
 
 class CRUDReferral:
     """CRUD class for Referral model."""
@@ -21,134 +61,423 @@ class CRUDReferral:
     def __init__(self, model: Type[ModelType]):
         """Init for CRUDReferral class."""
         self.model = model
+        self._single_flight = SingleFlight()
+        self._background_tasks = set()
 
     async def get_redis_by_field(
         self,
         session: AsyncSession,
         model_field,
         value,
-    ):
+    ) -> Optional[CachedReferralCode]:
         """
-        Get certain ReferralCode model obj.
+        Get a read model of certain ReferralCode model obj.
 
         from redis cache or postgres database
         by referral code or user
         update or set it to redis cache
+        refresh it in background if it is about to expire
+        concurrent misses of the same obj share one database query
+        timed by the source it is found in
         """
-        if referral_code := await get_referral_redis(value):
-            return pickle.loads(referral_code)
-        db_obj = await session.execute(
-            select(self.model).where(
-                model_field == value,
-            ),
+        start = perf_counter()
+        referral_code = await get_referral_redis(
+            model_field.key,
+            value,
+            on_stale=partial(self.refresh_redis_by_field, model_field, value),
+        )
+        if referral_code is not None:
+            referral_lookup_seconds.observe(perf_counter() - start, "cache")
+            if referral_code is REFERRAL_MISSING:
+                return None
+            return referral_code
+        try:
+            if not settings.referral_single_flight_enabled:
+                return await self.get_db_by_field(session, model_field, value)
+            return await self._single_flight.do(
+                (model_field.key, value),
+                self.get_db_by_field,
+                session,
+                model_field,
+                value,
+            )
+        finally:
+            referral_lookup_seconds.observe(perf_counter() - start, "db")
+
+    async def get_db_by_field(
+        self,
+        session: AsyncSession,
+        model_field,
+        value,
+    ) -> Optional[CachedReferralCode]:
+        """
+        Get a read model of certain ReferralCode model obj.
+
+        from postgres database
+        unless another worker holds the lock and loads it to redis cache
+        """
+        locked = False
+        if settings.referral_cache_lock_enabled:
+            locked = await acquire_referral_lock(model_field.key, value)
+            if not locked:
+                referral_code = await wait_referral_redis(
+                    model_field.key,
+                    value,
+                )
+                if referral_code is REFERRAL_MISSING:
+                    return None
+                if referral_code is not None:
+                    return referral_code
+        try:
+            return await self.load_redis_by_field(session, model_field, value)
+        finally:
+            if locked:
+                await release_referral_lock(model_field.key, value)
+
+    async def load_redis_by_field(
+        self,
+        session: AsyncSession,
+        model_field,
+        value,
+    ) -> Optional[CachedReferralCode]:
+        """
+        Get a read model of certain ReferralCode model obj.
+
+        from the primary postgres database
+        set it to redis cache
+        cache a missing obj as well
+        """
+        async with on_primary(session) as primary:
+            db_obj = await primary.execute(
+                select(self.model).where(
+                    model_field == value,
+                ),
+            )
+            db_obj = db_obj.scalars().first()
+        if db_obj is None:
+            await set_missing_referral_redis(model_field.key, value)
+            return None
+        await set_referral_redis(db_obj)
+        return CachedReferralCode.from_model(db_obj)
+
+    async def get_many_redis_by_field(
+        self,
+        session: AsyncSession,
+        model_field,
+        values: Sequence,
+    ) -> Dict[Any, CachedReferralCode]:
+        """
+        Get read models of certain ReferralCode model objs.
+
+        from redis cache in one round-trip
+        and the rest from the primary postgres database in one query
+        by referral codes or referrer ids
+        set them to redis cache and cache missing objs as well
+        keyed by the value they are found by
+        """
+        values = list(dict.fromkeys(values))
+        code_objs = {}
+        misses = []
+        cached = await get_referrals_redis(model_field.key, values)
+        for value, code_obj in zip(values, cached):
+            if code_obj is None:
+                misses.append(value)
+            elif code_obj is not REFERRAL_MISSING:
+                code_objs[value] = code_obj
+        if not misses:
+            return code_objs
+        async with on_primary(session) as primary:
+            rows = await primary.execute(
+                select(
+                    self.model.referrer_id,
+                    self.model.code,
+                    self.model.created_at,
+                    self.model.expiration_at,
+                ).where(model_field.in_(misses)),
+            )
+            loaded = [CachedReferralCode(*row) for row in rows]
+        for code_obj in loaded:
+            code_objs[getattr(code_obj, model_field.key)] = code_obj
+        await set_referral_redis_many(loaded, invalidate=False)
+        await set_missing_referrals_redis(
+            model_field.key,
+            [value for value in misses if value not in code_objs],
         )
-        db_obj = db_obj.scalars().first()
-        if db_obj:
-            await set_referral_redis(db_obj)
-        return db_obj
+        return code_objs
+
+    def refresh_redis_by_field(self, model_field, value) -> None:
+        """
+        Reload certain ReferralCode model obj to redis cache in background.
+
+        with its own session on the primary
+        release the lock taken for it afterwards
+        """
+        async def refresh():
+            try:
+                async with AsyncSessionLocal() as session:
+                    await self.load_redis_by_field(session, model_field, value)
+            finally:
+                await release_referral_lock(model_field.key, value)
+
+        task = asyncio.create_task(refresh())
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
 
     async def get_by_user(
         self,
         user: User,
         session: AsyncSession,
-    ) -> Optional[ModelType]:
+    ) -> Optional[CachedReferralCode]:
         """
-        Get certain ReferralCode model obj.
+        Get a read model of certain ReferralCode model obj.
 
         from redis cache or postgres database
         by user
         update or set it to redis cache
         """
+        return await self.get_by_referrer_id(user.id, session)
+
+    async def get_by_referrer_id(
+        self,
+        referrer_id: UUID,
+        session: AsyncSession,
+    ) -> Optional[CachedReferralCode]:
+        """
+        Get a read model of certain ReferralCode model obj.
+
+        from redis cache or postgres database
+        by referrer id
+        update or set it to redis cache
+        """
         return await self.get_redis_by_field(
-            session, self.model.referrer_id, user.id,
+            session, self.model.referrer_id, referrer_id,
         )
 
     async def get_by_referral_code(
         self,
         code: str,
         session: AsyncSession,
-    ) -> Optional[ModelType]:
+    ) -> Optional[CachedReferralCode]:
         """
-        Get certain ReferralCode model obj.
+        Get a read model of certain ReferralCode model obj.
 
         from redis cache or postgres database
         by referral code
         update or set it to redis cache
+        normalized as it is generated
+        a code failing the check is not looked up
         """
+        code = normalize_referral_code(code)
+        if not check_referral_code(code):
+            return None
         return await self.get_redis_by_field(
             session,
             self.model.code,
             code,
         )
 
-    async def update(
+    def _upsert_statement(
         self,
-        db_obj: ModelType,
+        referrer_ids: Sequence[UUID],
         lifetime: int,
+        campaign: Optional[str] = None,
+    ) -> Executable:
+        """
+        Build an INSERT ... ON CONFLICT statement of new referral codes.
+
+        for certain users with certain lifetime
+        returns new rows and codes they replace
+        read in a CTE which sees rows as they were before the statement
+        """
+        created_time = datetime.now()
+        expiration_time = calculate_end_date(created_time, lifetime)
+        replaced = (
+            select(self.model.referrer_id, self.model.code)
+            .where(self.model.referrer_id.in_(referrer_ids))
+            .cte("replaced")
+        )
+        statement = insert(self.model).values(
+            [
+                {
+                    "referrer_id": referrer_id,
+                    "code": generate_referral_code(campaign),
+                    "created_at": created_time,
+                    "expiration_at": expiration_time,
+                }
+                for referrer_id in referrer_ids
+            ],
+        )
+        upserted = (
+            statement.on_conflict_do_update(
+                index_elements=[self.model.referrer_id],
+                set_={
+                    "code": statement.excluded.code,
+                    "created_at": statement.excluded.created_at,
+                    "expiration_at": statement.excluded.expiration_at,
+                },
+            )
+            .returning(
+                self.model.referrer_id,
+                self.model.code,
+                self.model.created_at,
+                self.model.expiration_at,
+            )
+            .cte("upserted")
+        )
+        return select(upserted, replaced.c.code).outerjoin(
+            replaced,
+            replaced.c.referrer_id == upserted.c.referrer_id,
+        )
+
+    async def get_many_by_referral_codes(
+        self,
+        codes: Sequence[str],
         session: AsyncSession,
-    ) -> ModelType:
+    ) -> Dict[str, CachedReferralCode]:
         """
-        Update certain ReferralCode model obj.
+        Get read models of certain ReferralCode model objs.
 
-        with certain lifetime
-        update result in redis cache
+        from redis cache or postgres database
+        by referral codes
+        update or set them to redis cache
+        normalized as they are generated
+        codes failing the check are not looked up
         """
-        await delete_referral_redis(db_obj)
-        db_obj.created_at = datetime.now()
-        db_obj.code = generate_referral_code()
-        db_obj.expiration_at = calculate_end_date(db_obj.created_at, lifetime)
-        session.add(db_obj)
-        await session.commit()
-        await session.refresh(db_obj)
-        await set_referral_redis(db_obj)
-        return db_obj
+        codes = [normalize_referral_code(code) for code in codes]
+        return await self.get_many_redis_by_field(
+            session,
+            self.model.code,
+            [code for code in codes if check_referral_code(code)],
+        )
 
-    async def create(
+    async def upsert(
         self,
         user: User,
         lifetime: int,
         session: AsyncSession,
-    ) -> ModelType:
+    ) -> CachedReferralCode:
         """
-        Create ReferralCode model obj.
+        Create or replace ReferralCode model obj of certain user.
 
+        in one INSERT ... ON CONFLICT statement
         with certain lifetime
-        for certain user
-        adds result to redis cache
+        replace it in redis cache in one pipeline
         """
-        created_time = datetime.now()
-        obj_data = {
-            "referrer_id": user.id,
-            "code": generate_referral_code(),
-            "created_at": created_time,
-            "expiration_at": calculate_end_date(
-                created_time,
-                lifetime,
-            ),
-        }
-        db_obj = self.model(**obj_data)
-        session.add(db_obj)
-        await session.commit()
-        await session.refresh(db_obj)
-        await set_referral_redis(db_obj)
-        return db_obj
+        referrer_id = user.id
+        row = await self._write_codes(
+            session,
+            lambda: self._upsert_statement((referrer_id,), lifetime),
+        )
+        *code_obj, replaced_code = row.one()
+        code_obj = CachedReferralCode(*code_obj)
+        await set_referral_redis_many((code_obj,), (replaced_code,))
+        return code_obj
+
+    async def upsert_many(
+        self,
+        referrer_ids: Sequence[UUID],
+        lifetime: int,
+        session: AsyncSession,
+        campaign: Optional[str] = None,
+    ) -> List[CachedReferralCode]:
+        """
+        Create or replace ReferralCode model objs of certain users.
+
+        in one INSERT ... ON CONFLICT statement
+        per chunk of users fitting the parameter limit
+        with certain lifetime
+        with codes prefixed by a campaign
+        users missing from postgres database are skipped
+        replace them in redis cache in one pipeline per chunk
+        """
+        code_objs = []
+        for offset in range(0, len(referrer_ids), UPSERT_MAX_ROWS):
+            existing_ids = await session.execute(
+                select(User.id).where(
+                    User.id.in_(
+                        referrer_ids[offset:offset + UPSERT_MAX_ROWS],
+                    ),
+                ),
+            )
+            existing_ids = existing_ids.scalars().all()
+            if not existing_ids:
+                continue
+            rows = await self._write_codes(
+                session,
+                partial(
+                    self._upsert_statement,
+                    existing_ids,
+                    lifetime,
+                    campaign,
+                ),
+            )
+            chunk = []
+            replaced_codes = []
+            for *code_obj, replaced_code in rows:
+                chunk.append(CachedReferralCode(*code_obj))
+                replaced_codes.append(replaced_code)
+            await set_referral_redis_many(chunk, replaced_codes)
+            code_objs.extend(chunk)
+        return code_objs
+
+    async def _write_codes(
+        self,
+        session: AsyncSession,
+        build_statement: Callable[[], Executable],
+    ) -> Result:
+        """
+        Execute a statement writing new referral codes and commit.
+
+        build it again with new codes
+        if one of them is already taken by the unique index
+        other integrity errors are raised at once
+        """
+        for attempt in range(settings.referral_code_max_retries + 1):
+            try:
+                result = await session.execute(build_statement())
+                await session.commit()
+            except IntegrityError as error:
+                await session.rollback()
+                if not _is_code_conflict(error):
+                    raise
+                referral_code_conflicts.inc()
+                if attempt == settings.referral_code_max_retries:
+                    raise
+            else:
+                return result
 
     async def remove(
         self,
-        db_obj: ModelType,
+        code_obj: CachedReferralCode,
         session: AsyncSession,
-    ) -> ModelType:
+    ) -> CachedReferralCode:
         """
         Remove certain ReferralCode model obj.
 
+        by its read model
         from postgres database
         from redis cache
+        the code deleted from postgres database is dropped from redis cache
+        as the read model may hold a code replaced meanwhile
         """
-        await delete_referral_redis(db_obj)
-        await session.delete(db_obj)
+        await delete_referral_redis(code_obj)
+        removed = await session.execute(
+            delete(self.model)
+            .where(self.model.referrer_id == code_obj.referrer_id)
+            .returning(
+                self.model.referrer_id,
+                self.model.code,
+                self.model.created_at,
+                self.model.expiration_at,
+            ),
+        )
+        removed = removed.first()
         await session.commit()
-        await delete_referral_redis(db_obj)
-        return db_obj
+        if removed is None:
+            return code_obj
+        removed = CachedReferralCode(*removed)
+        await delete_referral_redis(removed)
+        return removed
 
 
 crud_referral = CRUDReferral(ReferralCode)
@@ -1,12 +1,22 @@
 """CRUD class description for User model."""
-from typing import Optional, Type
+from datetime import date, datetime
+from typing import AsyncIterator, Dict, Optional, Sequence, Tuple, Type, Union
 from uuid import UUID
 
-from sqlalchemy import select
+from fastapi_users_db_sqlalchemy.generics import GUID
+from sqlalchemy import (CTE, Date, Integer, Row, Subquery, cast, func, insert,
+                        literal, literal_column, or_, select, union_all)
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal
+from app.core.redis import (close_referral_stats_redis,
+                            get_referral_stats_redis,
+                            open_referral_stats_redis)
 from app.crud.referral import ModelType
-from app.models import User
+from app.models import ReferralClosure, User
+from app.schemas import ReferralRead
 
 
 class CRUDUser:
@@ -15,17 +25,327 @@ class CRUDUser:
     def __init__(self, model: Type[ModelType]):
         """Init for CRUDUser class."""
         self.model = model
+        self.referral_fields = tuple(ReferralRead.model_fields)
+        self.referral_columns = tuple(
+            getattr(model, field) for field in self.referral_fields
+        )
+        self.referral_tree_fields = self.referral_fields + ("depth",)
 
     async def get_referrals_by_referrer_id(
         self,
         referrer_id: UUID,
         session: AsyncSession,
-    ) -> Optional[ModelType]:
-        """Get referrals from model by referrer id."""
-        referrals = await session.execute(
-            select(self.model).where(self.model.referrer_id == referrer_id),
+        after: Optional[UUID] = None,
+        limit: Optional[int] = None,
+    ) -> Sequence[Row]:
+        """
+        Get referrals from model by referrer id.
+
+        as rows of referral_columns
+        ordered by id
+        a page of limit referrals with id greater than after
+        """
+        query = (
+            select(*self.referral_columns)
+            .where(self.model.referrer_id == referrer_id)
+            .order_by(self.model.id)
+        )
+        if after is not None:
+            query = query.where(self.model.id > after)
+        if limit is not None:
+            query = query.limit(limit)
+        referrals = await session.execute(query)
+        return referrals.all()
+
+    async def stream_referrals_by_referrer_id(
+        self,
+        referrer_id: UUID,
+        session: AsyncSession,
+        batch_size: int,
+    ) -> AsyncIterator[Sequence[Row]]:
+        """
+        Stream referrals from model by referrer id.
+
+        as rows of referral_columns
+        in batches of batch_size referrals
+        through a server side cursor
+        """
+        referrals = await session.stream(
+            select(*self.referral_columns)
+            .where(self.model.referrer_id == referrer_id)
+            .order_by(self.model.id)
+            .execution_options(yield_per=batch_size),
+        )
+        async for batch in referrals.partitions():
+            yield batch
+
+    async def count_referrals_by_referrer_id(
+        self,
+        referrer_id: UUID,
+        session: AsyncSession,
+        before: Optional[datetime] = None,
+    ) -> Tuple[int, Dict[date, int]]:
+        """
+        Count referrals from model by referrer id.
+
+        in total and by registration day
+        only registered before a moment if it is set
+        """
+        day = cast(self.model.created_at, Date)
+        query = select(day, func.count()).where(
+            self.model.referrer_id == referrer_id,
+        )
+        if before is not None:
+            query = query.where(
+                or_(
+                    self.model.created_at.is_(None),
+                    self.model.created_at < before,
+                ),
+            )
+        counts = await session.execute(query.group_by(day))
+        total, daily = 0, {}
+        for registered_on, count in counts:
+            total += count
+            if registered_on is not None:
+                daily[registered_on] = count
+        return total, daily
+
+    async def stream_referral_counts(
+        self,
+        session: AsyncSession,
+        batch_size: int,
+    ) -> AsyncIterator[Sequence[Row]]:
+        """
+        Stream referral counts of all referrers.
+
+        as rows of referrer id, registration day and count
+        ordered by referrer id
+        in batches of batch_size rows
+        """
+        day = cast(self.model.created_at, Date)
+        counts = await session.stream(
+            select(self.model.referrer_id, day, func.count())
+            .where(self.model.referrer_id.is_not(None))
+            .group_by(self.model.referrer_id, day)
+            .order_by(self.model.referrer_id)
+            .execution_options(yield_per=batch_size),
+        )
+        async for batch in counts.partitions():
+            yield batch
+
+    async def get_referral_stats_by_referrer_id(
+        self,
+        referrer_id: UUID,
+        days: Sequence[date],
+    ) -> Tuple[int, Dict[date, int]]:
+        """
+        Get referral counters of a referrer.
+
+        in total and for certain days
+        from redis cache
+        or count them in the primary database and set to redis cache
+        as a lagging replica would miss the latest referrals
+        the cache is started before counting
+        so referrals registered meanwhile are counted in redis
+        """
+        if stats := await get_referral_stats_redis(referrer_id, days):
+            return stats
+        since = datetime.now()
+        building = await open_referral_stats_redis(referrer_id, since)
+        async with AsyncSessionLocal() as session:
+            total, daily = await self.count_referrals_by_referrer_id(
+                referrer_id,
+                session,
+                since if building else None,
+            )
+        if building:
+            await close_referral_stats_redis(referrer_id, since, total, daily)
+        return total, {day: daily.get(day, 0) for day in days}
+
+    async def add_to_referral_tree(
+        self,
+        user_id: UUID,
+        referrer_id: UUID,
+        session: AsyncSession,
+    ) -> None:
+        """
+        Add a new user to the referral closure under its referrer.
+
+        the referrer and every referrer up its chain
+        become ancestors of the user one level deeper
+        """
+        await session.execute(
+            insert(ReferralClosure).from_select(
+                ["ancestor_id", "descendant_id", "depth"],
+                union_all(
+                    select(
+                        literal(referrer_id, GUID),
+                        literal(user_id, GUID),
+                        literal_column("1", Integer),
+                    ),
+                    select(
+                        ReferralClosure.ancestor_id,
+                        literal(user_id, GUID),
+                        ReferralClosure.depth + 1,
+                    ).where(ReferralClosure.descendant_id == referrer_id),
+                ),
+            ),
+        )
+
+    def _ancestors(
+        self,
+        user_id: UUID,
+        max_depth: int,
+        closure: bool,
+    ) -> Union[Subquery, CTE]:
+        """
+        Select ids and depths of referrers up the chain of a user.
+
+        from the referral closure
+        or walking the chain with a recursive CTE
+        """
+        if closure:
+            return (
+                select(
+                    ReferralClosure.ancestor_id.label("id"),
+                    ReferralClosure.depth,
+                )
+                .where(
+                    ReferralClosure.descendant_id == user_id,
+                    ReferralClosure.depth <= max_depth,
+                )
+                .subquery()
+            )
+        chain = (
+            select(
+                self.model.referrer_id.label("id"),
+                literal_column("1", Integer).label("depth"),
+            )
+            .where(
+                self.model.id == user_id,
+                self.model.referrer_id.is_not(None),
+            )
+            .cte("ancestors", recursive=True)
+        )
+        referrer = aliased(self.model)
+        return chain.union_all(
+            select(referrer.referrer_id, chain.c.depth + 1)
+            .join_from(chain, referrer, referrer.id == chain.c.id)
+            .where(
+                referrer.referrer_id.is_not(None),
+                chain.c.depth < max_depth,
+            ),
+        )
+
+    def _descendants(
+        self,
+        user_id: UUID,
+        max_depth: int,
+        closure: bool,
+    ) -> Union[Subquery, CTE]:
+        """
+        Select ids and depths of referrals down the tree of a user.
+
+        from the referral closure
+        or walking the tree with a recursive CTE
+        """
+        if closure:
+            return (
+                select(
+                    ReferralClosure.descendant_id.label("id"),
+                    ReferralClosure.depth,
+                )
+                .where(
+                    ReferralClosure.ancestor_id == user_id,
+                    ReferralClosure.depth <= max_depth,
+                )
+                .subquery()
+            )
+        tree = (
+            select(self.model.id, literal_column("1", Integer).label("depth"))
+            .where(self.model.referrer_id == user_id)
+            .cte("descendants", recursive=True)
+        )
+        referral = aliased(self.model)
+        return tree.union_all(
+            select(referral.id, tree.c.depth + 1)
+            .join_from(tree, referral, referral.referrer_id == tree.c.id)
+            .where(tree.c.depth < max_depth),
+        )
+
+    async def get_ancestors(
+        self,
+        user_id: UUID,
+        max_depth: int,
+        session: AsyncSession,
+        closure: Optional[bool] = None,
+    ) -> Sequence[Row]:
+        """
+        Get referrers up the chain of a user.
+
+        as rows of referral_columns and depth
+        ordered by depth up to max_depth
+        from the referral closure if closure or it is enabled
+        """
+        if closure is None:
+            closure = settings.referral_tree_closure_enabled
+        ancestors = self._ancestors(user_id, max_depth, closure)
+        rows = await session.execute(
+            select(*self.referral_columns, ancestors.c.depth)
+            .join(ancestors, self.model.id == ancestors.c.id)
+            .order_by(ancestors.c.depth),
+        )
+        return rows.all()
+
+    async def get_descendants(
+        self,
+        user_id: UUID,
+        max_depth: int,
+        limit: int,
+        session: AsyncSession,
+        closure: Optional[bool] = None,
+    ) -> Sequence[Row]:
+        """
+        Get referrals down the tree of a user.
+
+        as rows of referral_columns and depth
+        first limit ones ordered by depth and id up to max_depth
+        from the referral closure if closure or it is enabled
+        """
+        if closure is None:
+            closure = settings.referral_tree_closure_enabled
+        descendants = self._descendants(user_id, max_depth, closure)
+        rows = await session.execute(
+            select(*self.referral_columns, descendants.c.depth)
+            .join(descendants, self.model.id == descendants.c.id)
+            .order_by(descendants.c.depth, descendants.c.id)
+            .limit(limit),
+        )
+        return rows.all()
+
+    async def count_descendants(
+        self,
+        user_id: UUID,
+        max_depth: int,
+        session: AsyncSession,
+        closure: Optional[bool] = None,
+    ) -> Tuple[int, Dict[int, int]]:
+        """
+        Count referrals down the tree of a user.
+
+        in total and by depth up to max_depth
+        from the referral closure if closure or it is enabled
+        """
+        if closure is None:
+            closure = settings.referral_tree_closure_enabled
+        descendants = self._descendants(user_id, max_depth, closure)
+        counts = await session.execute(
+            select(descendants.c.depth, func.count())
+            .group_by(descendants.c.depth)
+            .order_by(descendants.c.depth),
         )
-        return referrals.scalars().all()
+        by_depth = dict(counts.all())
+        return sum(by_depth.values()), by_depth
 
 
 crud_user = CRUDUser(User)
@@ -0,0 +1,131 @@
+"""
+Create or rotate referral codes of many users at once.
+
+Codes are written with one INSERT ... ON CONFLICT statement
+and set to redis cache with one pipeline per batch.
+User ids are read one per line from a file or stdin,
+or all users are taken from the user table.
+
+Run from the project root:
+python -m app.jobs.issue_referral_codes --all-users [--lifetime N]
+python -m app.jobs.issue_referral_codes --file ids.txt [--batch-size N]
+"""
+import argparse
+import asyncio
+import logging
+import sys
+from time import perf_counter
+from typing import AsyncIterator, List, Optional
+from uuid import UUID
+
+from sqlalchemy import select
+
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal, engine
+from app.core.redis import close_redis
+from app.crud import crud_referral
+from app.models import User
+
+logger = logging.getLogger(__name__)
+
+
+async def read_user_ids(path: str, batch_size: int) -> AsyncIterator[List]:
+    """Yield batches of user ids read from a file or stdin."""
+    batch = []
+    with open(path) if path != "-" else sys.stdin as lines:
+        for line in lines:
+            if line := line.strip():
+                batch.append(UUID(line))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+async def stream_user_ids(batch_size: int) -> AsyncIterator[List]:
+    """Yield batches of ids of all users."""
+    async with AsyncSessionLocal() as session:
+        users = await session.stream_scalars(
+            select(User.id)
+            .order_by(User.id)
+            .execution_options(yield_per=batch_size),
+        )
+        async for batch in users.partitions():
+            yield batch
+
+
+async def issue_referral_codes(
+    user_ids: AsyncIterator[List],
+    lifetime: int,
+    campaign: Optional[str] = None,
+) -> int:
+    """
+    Create or rotate referral codes of users.
+
+    one statement and one redis pipeline per batch of user ids
+    codes are prefixed by a campaign
+    return a number of issued codes
+    """
+    issued = 0
+    start = perf_counter()
+    async with AsyncSessionLocal() as session:
+        async for batch in user_ids:
+            code_objs = await crud_referral.upsert_many(
+                batch,
+                lifetime,
+                session,
+                campaign,
+            )
+            issued += len(code_objs)
+            logger.info(
+                "%s codes issued, %.0f rows/s.",
+                issued,
+                issued / (perf_counter() - start),
+            )
+    return issued
+
+
+async def main():
+    """Issue codes and report a rate."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument(
+        "--file",
+        help="file with a user id per line, - for stdin",
+    )
+    source.add_argument("--all-users", action="store_true")
+    parser.add_argument("--lifetime", type=int, default=30)
+    parser.add_argument("--campaign", help="prefix of issued codes")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=settings.referral_bulk_batch_size,
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.all_users:
+        user_ids = stream_user_ids(args.batch_size)
+    else:
+        user_ids = read_user_ids(args.file, args.batch_size)
+    start = perf_counter()
+    try:
+        issued = await issue_referral_codes(
+            user_ids,
+            args.lifetime,
+            args.campaign,
+        )
+    finally:
+        await engine.dispose()
+        await close_redis()
+    seconds = perf_counter() - start
+    logger.info(
+        "%s referral codes are issued in %.1f s, %.0f rows/s.",
+        issued,
+        seconds,
+        issued / seconds if seconds else 0,
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,85 @@
+"""
+Deliver messages from the mail outbox.
+
+Claims batches of pending messages and sends them through
+the pooled mail queue, mail_workers SMTP sessions at most.
+A message is sent at least once: a crash between sending
+and marking it sent makes it claimed again after the lease.
+
+Run from the project root:
+python -m app.jobs.mail_worker
+"""
+import asyncio
+import logging
+import signal
+
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal, engine
+from app.crud import crud_mail_outbox
+from app.services.mail import build_message, mail_queue
+
+logger = logging.getLogger(__name__)
+
+
+async def dispatch_batch() -> int:
+    """Send a batch of claimed messages and return its size."""
+    async with AsyncSessionLocal() as session:
+        messages = await crud_mail_outbox.claim(
+            settings.mail_outbox_batch_size,
+            session,
+        )
+        results = await asyncio.gather(
+            *(
+                mail_queue.send(
+                    build_message(
+                        message.recipient,
+                        message.subject,
+                        message.body,
+                    ),
+                )
+                for message in messages
+            ),
+            return_exceptions=True,
+        )
+        sent = [
+            message.id
+            for message, error in zip(messages, results)
+            if error is None
+        ]
+        if sent:
+            await crud_mail_outbox.mark_sent(sent, session)
+        for message, error in zip(messages, results):
+            if error is not None:
+                await crud_mail_outbox.mark_failed(message, error, session)
+    return len(messages)
+
+
+async def main():
+    """Dispatch messages until SIGTERM or SIGINT."""
+    logging.basicConfig(level=logging.INFO)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+
+    await mail_queue.start()
+    logger.info("Mail worker is started.")
+    try:
+        while not stop.is_set():
+            if await dispatch_batch():
+                continue
+            try:
+                await asyncio.wait_for(
+                    stop.wait(),
+                    settings.mail_outbox_poll_interval,
+                )
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        await mail_queue.stop()
+        await engine.dispose()
+    logger.info("Mail worker is stopped.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
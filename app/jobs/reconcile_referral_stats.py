@@ -0,0 +1,65 @@
+"""
+Rebuild referral counters in redis cache from the user table.
+
+Counters are incremented on every registration by a referral code
+and may drift if redis loses data or a registration fails afterwards.
+
+Run from the project root:
+python -m app.jobs.reconcile_referral_stats [--batch-size N]
+"""
+import argparse
+import asyncio
+import logging
+
+from app.core.database import AsyncSessionLocal, engine
+from app.core.redis import close_redis, set_referral_stats_redis
+from app.crud import crud_user
+
+logger = logging.getLogger(__name__)
+
+
+async def reconcile_referral_stats(batch_size: int) -> int:
+    """
+    Replace referral counters of all referrers.
+
+    one redis pipeline per batch of counted rows
+    return a number of referrers
+    """
+    referrers = 0
+    stats = {}
+    async with AsyncSessionLocal() as session:
+        async for batch in crud_user.stream_referral_counts(
+            session,
+            batch_size,
+        ):
+            for referrer_id, registered_on, count in batch:
+                total, daily = stats.setdefault(referrer_id, [0, {}])
+                stats[referrer_id][0] = total + count
+                if registered_on is not None:
+                    daily[registered_on] = count
+            # Rows are ordered by referrer, only the last one may continue.
+            last_id = batch[-1][0]
+            last = stats.pop(last_id)
+            await set_referral_stats_redis(stats)
+            referrers += len(stats)
+            stats = {last_id: last}
+    await set_referral_stats_redis(stats)
+    return referrers + len(stats)
+
+
+async def main():
+    """Rebuild counters and report a number of referrers."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        referrers = await reconcile_referral_stats(args.batch_size)
+    finally:
+        await engine.dispose()
+        await close_redis()
+    logger.info("Referral counters of %s referrers are rebuilt.", referrers)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
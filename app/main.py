@@ -2,20 +2,55 @@
 Describe FastAPI app entry point actions.
 
 startup: called on strting of a project
+shutdown: called on stopping of a project
 """
+import asyncio
 
 from fastapi import FastAPI
 
 from app.api.routers import main_router
 from app.core.config import settings
+from app.core.database import replica_router
 from app.core.init_db import create_first_superuser
+from app.core.middleware import MetricsMiddleware, ProfilingMiddleware
+from app.core.redis import (close_redis, listen_cache_invalidations,
+                            local_caches, open_redis)
+from app.services.mail import mail_queue
 
 app = FastAPI(title=settings.app_title)
 
 app.include_router(main_router)
 
+if settings.profiling_enabled:
+    app.add_middleware(ProfilingMiddleware)
+if settings.metrics_enabled:
+    app.add_middleware(MetricsMiddleware)
+
 
 @app.on_event("startup")
 async def startup():
     """Describe actions on startup of the app."""
+    await open_redis()
     await create_first_superuser()
+    await mail_queue.start()
+    if local_caches:
+        app.state.cache_invalidation_listener = asyncio.create_task(
+            listen_cache_invalidations(),
+        )
+    if replica_router.engines:
+        await replica_router.check()
+        app.state.replica_checks = asyncio.create_task(
+            replica_router.run_checks(),
+        )
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Describe actions on shutdown of the app."""
+    await mail_queue.stop()
+    if local_caches:
+        app.state.cache_invalidation_listener.cancel()
+    await close_redis()
+    if replica_router.engines:
+        app.state.replica_checks.cancel()
+        await replica_router.dispose()
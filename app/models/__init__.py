@@ -1,3 +1,5 @@
 """models/init."""
+from app.models.mail import MailOutbox  # noqa
 from app.models.referral import ReferralCode  # noqa
+from app.models.referral_closure import ReferralClosure  # noqa
 from app.models.user import User  # noqa
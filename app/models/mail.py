@@ -0,0 +1,49 @@
+"""Describes SQLAlchemy mail outbox model."""
+from datetime import datetime
+from typing import Optional
+from uuid import UUID
+
+from fastapi_users_db_sqlalchemy.generics import GUID
+from sqlalchemy import ForeignKey, Index, String, UniqueConstraint, text
+from sqlalchemy.orm import Mapped, mapped_column
+
+from app.core.database import Base
+
+
+class MailOutbox(Base):
+    """
+    Contains mail outbox model description.
+
+    status: pending until sent, dead after the last failed attempt
+    idempotency_key: unique among messages of the user
+    next_attempt_at: when a pending message may be claimed by a worker
+    """
+
+    __table_args__ = (
+        UniqueConstraint(
+            "user_id",
+            "idempotency_key",
+            name="uq_mailoutbox_user_id_idempotency_key",
+        ),
+        Index(
+            "ix_mailoutbox_pending_next_attempt_at",
+            "next_attempt_at",
+            postgresql_where=text("status = 'pending'"),
+        ),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[UUID] = mapped_column(
+        GUID,
+        ForeignKey("user.id", ondelete="CASCADE"),
+    )
+    idempotency_key: Mapped[str] = mapped_column(String(255))
+    recipient: Mapped[str] = mapped_column(String(320))
+    subject: Mapped[str]
+    body: Mapped[str]
+    status: Mapped[str] = mapped_column(String(16), default="pending")
+    attempts: Mapped[int] = mapped_column(default=0)
+    last_error: Mapped[Optional[str]]
+    created_at: Mapped[datetime] = mapped_column(default=datetime.now)
+    next_attempt_at: Mapped[datetime] = mapped_column(default=datetime.now)
+    sent_at: Mapped[Optional[datetime]]
@@ -3,7 +3,7 @@ from datetime import datetime
 from typing import Optional
 from uuid import UUID
 
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index, text
 from sqlalchemy.orm import Mapped, mapped_column
 
 from app.core.database import Base
@@ -12,11 +12,19 @@ from app.core.database import Base
 class ReferralCode(Base):
     """Contains Referral code model description."""
 
+    __table_args__ = (
+        Index(
+            "ix_referralcode_active_expiration_at",
+            "expiration_at",
+            postgresql_where=text("code IS NOT NULL"),
+        ),
+    )
+
     referrer_id: Mapped[UUID] = mapped_column(
         ForeignKey("user.id"),
         primary_key=True,
     )
-    code: Mapped[Optional[str]]
+    code: Mapped[Optional[str]] = mapped_column(unique=True, index=True)
     created_at: Mapped[Optional[datetime]] = mapped_column(
         default=datetime.now,
     )
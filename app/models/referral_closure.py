@@ -0,0 +1,43 @@
+"""Describes SQLAlchemy referral closure model."""
+from uuid import UUID
+
+from fastapi_users_db_sqlalchemy.generics import GUID
+from sqlalchemy import ForeignKey, Index
+from sqlalchemy.orm import Mapped, mapped_column
+
+from app.core.database import Base
+
+
+class ReferralClosure(Base):
+    """
+    Contains referral closure model description.
+
+    a row for every referrer up the chain of a user
+    depth: 1 for the referrer, 2 for its referrer and so on
+    """
+
+    __table_args__ = (
+        Index(
+            "ix_referralclosure_ancestor_id_depth",
+            "ancestor_id",
+            "depth",
+            "descendant_id",
+        ),
+        Index(
+            "ix_referralclosure_descendant_id_depth",
+            "descendant_id",
+            "depth",
+        ),
+    )
+
+    ancestor_id: Mapped[UUID] = mapped_column(
+        GUID,
+        ForeignKey("user.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    descendant_id: Mapped[UUID] = mapped_column(
+        GUID,
+        ForeignKey("user.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    depth: Mapped[int]
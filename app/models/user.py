@@ -1,9 +1,10 @@
 """Describes SQLAlchemy User model."""
+from datetime import datetime
 from typing import Optional
 from uuid import UUID
 
 from fastapi_users_db_sqlalchemy import SQLAlchemyBaseUserTableUUID
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from app.core.database import Base
@@ -12,9 +13,16 @@ from app.core.database import Base
 class User(SQLAlchemyBaseUserTableUUID, Base):
     """Contains User model description."""
 
+    __table_args__ = (
+        Index("ix_user_referrer_id_id", "referrer_id", "id"),
+    )
+
     referrer_id: Mapped[Optional[UUID]] = mapped_column(
         ForeignKey("user.id"),
     )
+    created_at: Mapped[Optional[datetime]] = mapped_column(
+        default=datetime.now,
+    )
     referrer: Mapped[Optional["User"]] = relationship(
         back_populates="referrals",
         remote_side="User.id",
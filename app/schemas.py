@@ -1,11 +1,13 @@
 """Describes pydantic schemas."""
-from datetime import datetime
-from typing import Optional
+from datetime import date, datetime
+from typing import Dict, List, Literal, Optional
 from uuid import UUID
 
 from fastapi_users import schemas
 from pydantic import BaseModel, ConfigDict, Field
 
+from app.core.config import settings
+
 
 class ReferralCodeCreate(BaseModel):
     """Describes referral code create model schema."""
@@ -15,6 +17,36 @@ class ReferralCodeCreate(BaseModel):
     lifetime: int = Field(30, gt=0)
 
 
+class ReferralCodeBulkCreate(ReferralCodeCreate):
+    """Describes referral code bulk create model schema."""
+
+    user_ids: List[UUID] = Field(
+        min_length=1,
+        max_length=settings.referral_bulk_max_users,
+    )
+    campaign: Optional[str] = Field(None, pattern=r"^[A-Za-z0-9_]{1,32}$")
+
+
+class ReferralCodeBulkRead(BaseModel):
+    """Describes referral code bulk create result schema."""
+
+    requested: int
+    issued: int
+    seconds: float
+    rows_per_second: float
+
+
+class ReferralCodeLookup(BaseModel):
+    """Describes referral codes lookup model schema."""
+
+    model_config = ConfigDict(extra="forbid")
+
+    codes: List[str] = Field(
+        min_length=1,
+        max_length=settings.referral_lookup_max_codes,
+    )
+
+
 class ReferralCodeRead(BaseModel):
     """Describes referral code read model schema."""
 
@@ -32,6 +64,50 @@ class UserRead(schemas.BaseUser[UUID], ReferralCodeRead):
     pass
 
 
+class ReferralRead(BaseModel):
+    """
+    Describes referral read model schema.
+
+    Documents referral listings which are serialized
+    from selected columns without the schema.
+    """
+
+    id: UUID
+    email: str
+    is_active: bool
+    is_superuser: bool
+    is_verified: bool
+    referrer_id: Optional[UUID] = None
+
+
+class ReferralTreeRead(ReferralRead):
+    """
+    Describes referral tree read model schema.
+
+    depth: 1 for a direct referrer or referral and so on
+    """
+
+    depth: int
+
+
+class ReferralTreeCountRead(BaseModel):
+    """Describes referral tree count read model schema."""
+
+    user_id: UUID
+    total: int
+    by_depth: Dict[int, int]
+
+
+class ReferralStatsRead(BaseModel):
+    """Describes referral statistics read model schema."""
+
+    referrer_id: UUID
+    referrals_count: int
+    daily_referrals: Dict[date, int]
+    code_status: Literal["active", "expired", "missing"]
+    code_expiration_at: Optional[datetime] = None
+
+
 class UserCreate(schemas.BaseUserCreate):
     """Default fastapi_users.schemas Create class."""
 
@@ -1,31 +1,280 @@
-"""Describes services for mail processing."""
-from email.mime.text import MIMEText
-from smtplib import SMTP
+"""
+Describes services for mail processing.
+
+Messages are put to a bounded in-process queue
+and sent in batches by workers each reusing its own SMTP session.
+A failed batch is retried with exponential backoff.
+With the outbox enabled messages are stored in the database instead
+and the queue is run by the mail worker, see app.jobs.mail_worker.
+
+For local testing run a stand-in SMTP server:
+python -m aiosmtpd -n -l localhost:8025
+and set MAIL_HOST=localhost, MAIL_PORT=8025, MAIL_USE_TLS=false.
+"""
+import asyncio
+import logging
+from email.message import EmailMessage
+from smtplib import SMTP, SMTPException, SMTPServerDisconnected
 from ssl import create_default_context
+from time import perf_counter
+from typing import Dict, List, Optional
+from uuid import UUID, uuid4
+
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.core.config import settings
+from app.core.metrics import Counter, Gauge, Histogram
+from app.crud import crud_mail_outbox
 
+logger = logging.getLogger(__name__)
 
-def send_referral_code(
-    referral_code: str,
-    referrer_mail: str,
-):
-    """Send a referral code by mail."""
-    message = MIMEText("Your referral code: " + referral_code, "html")
-    message["From"] = settings.mail_username
-    message["To"] = referrer_mail
-    message["Subject"] = "Your referral code"
+mail_messages = Counter(
+    "mail_messages_total",
+    "Mail messages by delivery result.",
+    ("result",),
+)
+mail_send_seconds = Histogram(
+    "mail_send_seconds",
+    "Time to send a batch of mail messages over SMTP.",
+)
 
-    ctx = create_default_context()
 
-    try:
-        with SMTP(settings.mail_host, settings.mail_port) as server:
-            server.ehlo()
-            server.starttls(context=ctx)
+class MailQueueFull(Exception):
+    """Raised when the mail queue can't accept a message."""
+
+
+class MailSender:
+    """SMTP session kept open between messages."""
+
+    def __init__(self):
+        """Init for MailSender class."""
+        self._server: Optional[SMTP] = None
+
+    def _connect(self) -> SMTP:
+        """Open an SMTP session and log in."""
+        server = SMTP(
+            settings.mail_host,
+            settings.mail_port,
+            timeout=settings.mail_timeout,
+        )
+        server.ehlo()
+        if settings.mail_use_tls:
+            server.starttls(context=create_default_context())
             server.ehlo()
+        if settings.mail_password:
             server.login(settings.mail_username, settings.mail_password)
-            server.send_message(message)
-            server.quit()
-        return {"status": 200, "errors": None}
-    except Exception as error:
-        return {"status": 500, "errors": error}
+        return server
+
+    def send(
+        self,
+        messages: List[EmailMessage],
+        refused: Dict[int, Exception],
+    ) -> None:
+        """
+        Send messages over the open SMTP session.
+
+        reconnect once if the server has closed the session
+        remove every sent message from the list
+        so only unsent ones are retried
+        a message failed for any other reason than the connection
+        is removed as well and its error is put to refused by its id
+        """
+        reconnected = self._server is None
+        if self._server is None:
+            self._server = self._connect()
+        while messages:
+            try:
+                self._server.send_message(messages[0])
+            except SMTPServerDisconnected:
+                self.close()
+                if reconnected:
+                    raise
+                self._server = self._connect()
+                reconnected = True
+                continue
+            except Exception as error:
+                # SMTPException is an OSError, socket errors break the session.
+                if isinstance(error, OSError) and not isinstance(
+                    error,
+                    SMTPException,
+                ):
+                    raise
+                refused[id(messages[0])] = error
+            messages.pop(0)
+
+    def close(self) -> None:
+        """Close the SMTP session."""
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except (SMTPException, OSError):
+                self._server.close()
+            self._server = None
+
+
+class MailQueue:
+    """Bounded queue of messages sent by a pool of SMTP sessions."""
+
+    def __init__(self):
+        """Init for MailQueue class."""
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+
+    def qsize(self) -> int:
+        """Return a number of queued messages."""
+        return 0 if self._queue is None else self._queue.qsize()
+
+    async def start(self) -> None:
+        """Start workers each with its own SMTP session."""
+        self._queue = asyncio.Queue(settings.mail_queue_size)
+        self._workers = [
+            asyncio.create_task(self._work(MailSender()))
+            for _ in range(settings.mail_workers)
+        ]
+
+    async def stop(self) -> None:
+        """Wait for queued messages and stop workers."""
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(
+                self._queue.join(),
+                settings.mail_stop_timeout,
+            )
+        except asyncio.TimeoutError:
+            logger.warning(
+                "%s mail messages are dropped on stop.",
+                self._queue.qsize(),
+            )
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+    def submit(self, message: EmailMessage) -> None:
+        """Put a message to the queue or raise MailQueueFull."""
+        try:
+            self._queue.put_nowait((message, None))
+        except asyncio.QueueFull:
+            mail_messages.inc("rejected")
+            raise MailQueueFull from None
+
+    async def send(self, message: EmailMessage) -> None:
+        """
+        Put a message to the queue and wait until it is sent.
+
+        wait for free space in the queue
+        raise the error of the last attempt if it is not sent
+        """
+        sent = asyncio.get_running_loop().create_future()
+        await self._queue.put((message, sent))
+        await sent
+
+    async def _work(self, sender: MailSender) -> None:
+        """Send batches of queued messages."""
+        try:
+            while True:
+                batch = [await self._queue.get()]
+                while (
+                    len(batch) < settings.mail_batch_size
+                    and not self._queue.empty()
+                ):
+                    batch.append(self._queue.get_nowait())
+                try:
+                    await self._send_batch(sender, batch)
+                except Exception as error:
+                    logger.exception("Mail batch is failed: %s", error)
+                    for _, sent in batch:
+                        if sent is not None and not sent.done():
+                            sent.set_exception(error)
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+        finally:
+            await asyncio.to_thread(sender.close)
+
+    async def _send_batch(self, sender: MailSender, batch: list) -> None:
+        """
+        Send a batch retrying unsent messages with backoff.
+
+        messages failed for other reasons than the connection
+        are failed without retries
+        """
+        unsent = [message for message, _ in batch]
+        refused = {}
+        last_error = None
+        for attempt in range(settings.mail_max_retries + 1):
+            start = perf_counter()
+            try:
+                await asyncio.to_thread(sender.send, unsent, refused)
+            except (SMTPException, OSError) as error:
+                mail_send_seconds.observe(perf_counter() - start)
+                last_error = error
+                logger.warning("Mail batch is not sent: %s", error)
+                await asyncio.to_thread(sender.close)
+                if attempt < settings.mail_max_retries:
+                    await asyncio.sleep(
+                        settings.mail_retry_backoff * 2 ** attempt,
+                    )
+            else:
+                mail_send_seconds.observe(perf_counter() - start)
+                break
+        unsent = {id(message) for message in unsent}
+        for message, sent in batch:
+            error = refused.get(id(message))
+            if error is None and id(message) in unsent:
+                error = last_error
+            if error is not None:
+                mail_messages.inc("failed")
+                if sent is not None:
+                    sent.set_exception(error)
+            else:
+                mail_messages.inc("sent")
+                if sent is not None:
+                    sent.set_result(None)
+
+
+mail_queue = MailQueue()
+
+mail_queue_depth = Gauge(
+    "mail_queue_depth",
+    "Mail messages waiting in the queue.",
+    callback=mail_queue.qsize,
+)
+
+
+def build_message(recipient: str, subject: str, body: str) -> EmailMessage:
+    """Build an html message."""
+    message = EmailMessage()
+    message["From"] = settings.mail_username
+    message["To"] = recipient
+    message["Subject"] = subject
+    message.set_content(body, subtype="html")
+    return message
+
+
+async def send_referral_code(
+    referral_code: str,
+    referrer_id: UUID,
+    referrer_mail: str,
+    session: AsyncSession,
+    idempotency_key: Optional[str] = None,
+) -> None:
+    """
+    Send a referral code by mail.
+
+    through the outbox delivered by the mail worker if it is enabled
+    or through the in-process queue
+    """
+    subject = "Your referral code"
+    body = "Your referral code: " + referral_code
+    if settings.mail_outbox_enabled:
+        await crud_mail_outbox.add(
+            referrer_id,
+            idempotency_key or uuid4().hex,
+            referrer_mail,
+            subject,
+            body,
+            session,
+        )
+    else:
+        mail_queue.submit(build_message(referrer_mail, subject, body))
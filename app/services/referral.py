@@ -1,13 +1,281 @@
-"""Describes services for referral code generations."""
+"""
+Describes services for referral code generations and listings.
+
+Codes are generated by a strategy chosen in settings:
+urlsafe: random urlsafe text of referral_link_length bytes
+base62, crockford: referral_link_length random symbols
+of the alphabet and a check symbol to catch typos
+A campaign prefix is put before a code.
+Codes failing the check are rejected before they are looked up.
+"""
+import asyncio
+import json
+import logging
 import secrets
+from collections import deque
 from datetime import datetime, timedelta
+from string import ascii_letters, digits
+from typing import Callable, Dict, Iterable, Optional, Sequence, Tuple
+
+from sqlalchemy import select
 
 from app.core.config import settings
+from app.core.database import AsyncSessionLocal
+from app.core.metrics import Counter
+from app.models import ReferralCode
+
+logger = logging.getLogger(__name__)
+
+BASE62_ALPHABET = digits + ascii_letters
+CROCKFORD_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+_encoder = json.JSONEncoder(default=str, separators=(",", ":"))
+
+
+class UrlsafeCodeGenerator:
+    """Random urlsafe codes of certain bytes."""
+
+    def __init__(self, length: int):
+        """Init for UrlsafeCodeGenerator class."""
+        self.length = length
+
+    def __call__(self) -> str:
+        """Generate a code."""
+        return secrets.token_urlsafe(self.length)
+
+    def is_valid(self, code: str) -> bool:
+        """Check a code, any urlsafe text is valid."""
+        return bool(code)
+
+    def normalize(self, code: str) -> str:
+        """Return a code as it is, urlsafe codes are case-sensitive."""
+        return code
+
+
+class AlphabetCodeGenerator:
+    """
+    Random codes of certain symbols of an alphabet.
+
+    followed by a check symbol of Luhn mod N algorithm
+    every single mistyped symbol is caught for an alphabet of even size
+    as well as most swaps of adjacent symbols
+    typed codes of a case-insensitive alphabet are upper-cased
+    and symbols easy to confuse are read as aliases map them
+    """
+
+    def __init__(
+        self,
+        alphabet: str,
+        length: int,
+        case_sensitive: bool = True,
+        aliases: Optional[Dict[str, str]] = None,
+    ):
+        """Init for AlphabetCodeGenerator class."""
+        self.alphabet = alphabet
+        self.length = length
+        self._case_sensitive = case_sensitive
+        self._aliases = str.maketrans(aliases or {})
+        self._index = {symbol: index for index, symbol in enumerate(alphabet)}
+        self._space = len(alphabet) ** length
+
+    def _encode(self, number: int, length: int) -> str:
+        """Write a number with certain symbols of the alphabet."""
+        base = len(self.alphabet)
+        symbols = []
+        for _ in range(length):
+            number, index = divmod(number, base)
+            symbols.append(self.alphabet[index])
+        return "".join(reversed(symbols))
+
+    def _check_symbol(self, code: str) -> str:
+        """
+        Return a check symbol of a code.
+
+        every other symbol from the right is doubled
+        and its digits in the alphabet base are summed
+        """
+        base = len(self.alphabet)
+        total = 0
+        factor = 2
+        for symbol in reversed(code):
+            addend = factor * self._index[symbol]
+            total += addend // base + addend % base
+            factor = 3 - factor
+        return self.alphabet[-total % base]
+
+    def __call__(self) -> str:
+        """Generate a code."""
+        code = self._encode(secrets.randbelow(self._space), self.length)
+        return code + self._check_symbol(code)
+
+    def normalize(self, code: str) -> str:
+        """Return a typed code as it is generated."""
+        if not self._case_sensitive:
+            code = code.upper()
+        return code.translate(self._aliases)
+
+    def is_valid(self, code: str) -> bool:
+        """Check the length, the alphabet and the check symbol of a code."""
+        return (
+            len(code) == self.length + 1
+            and all(symbol in self._index for symbol in code)
+            and code[-1] == self._check_symbol(code[:-1])
+        )
+
+
+CODE_GENERATORS = {
+    "urlsafe": UrlsafeCodeGenerator,
+    "base62": lambda length: AlphabetCodeGenerator(BASE62_ALPHABET, length),
+    "crockford": lambda length: AlphabetCodeGenerator(
+        CROCKFORD_ALPHABET,
+        length,
+        case_sensitive=False,
+        aliases={"I": "1", "L": "1", "O": "0"},
+    ),
+}
+
+
+class ReferralCodePool:
+    """
+    Codes with a certain prefix generated ahead of time.
+
+    refilled in background once it runs low
+    codes already taken in postgres database are left out
+    a code is generated in place if the pool is empty
+    """
 
+    def __init__(
+        self,
+        generator: Callable[[], str],
+        size: int,
+        refill_at: int,
+        prefix: str = "",
+    ):
+        """Init for ReferralCodePool class."""
+        self._generator = generator
+        self._prefix = prefix
+        self._size = size
+        self._refill_at = refill_at
+        self._codes = deque()
+        self._refill_task: Optional[asyncio.Task] = None
 
-def generate_referral_code() -> str:
-    """Generate a valid and urlsafe referral code."""
-    return secrets.token_urlsafe(settings.referral_link_length)
+    def __len__(self) -> int:
+        """Return a number of pooled codes."""
+        return len(self._codes)
+
+    def take(self) -> str:
+        """Take a pooled code and start a refill if the pool runs low."""
+        if len(self._codes) <= self._refill_at and self._refill_task is None:
+            self._refill_task = asyncio.create_task(self.refill())
+            self._refill_task.add_done_callback(self._refilled)
+        if self._codes:
+            return self._codes.popleft()
+        return self._generate_one()
+
+    def _generate_one(self) -> str:
+        """Generate a code with the prefix."""
+        code = self._generator()
+        return f"{self._prefix}-{code}" if self._prefix else code
+
+    def _generate(self, count: int) -> set:
+        """Generate distinct codes with the prefix."""
+        codes = set()
+        while len(codes) < count:
+            codes.add(self._generate_one())
+        return codes
+
+    async def refill(self) -> None:
+        """Fill the pool up with codes not taken in postgres database."""
+        codes = await asyncio.to_thread(
+            self._generate,
+            self._size - len(self._codes),
+        )
+        async with AsyncSessionLocal() as session:
+            taken = await session.execute(
+                select(ReferralCode.code).where(ReferralCode.code.in_(codes)),
+            )
+            codes.difference_update(taken.scalars())
+        self._codes.extend(codes)
+
+    def _refilled(self, task: asyncio.Task) -> None:
+        """Allow the next refill and log a failed one."""
+        self._refill_task = None
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(
+                "Referral code pool is not refilled: %s",
+                task.exception(),
+            )
+
+
+referral_code_generator = CODE_GENERATORS[settings.referral_code_strategy](
+    settings.referral_link_length,
+)
+referral_code_pools: Dict[str, ReferralCodePool] = {}
+
+referral_code_checks = Counter(
+    "referral_code_checks_total",
+    "Referral codes checked before lookups by result.",
+    ("result",),
+)
+
+
+def get_referral_code_pool(prefix: str) -> ReferralCodePool:
+    """Return the pool of codes with a prefix, create it on first use."""
+    if prefix not in referral_code_pools:
+        referral_code_pools[prefix] = ReferralCodePool(
+            referral_code_generator,
+            settings.referral_code_pool_size,
+            settings.referral_code_pool_refill_at,
+            prefix,
+        )
+    return referral_code_pools[prefix]
+
+
+def generate_referral_code(campaign: Optional[str] = None) -> str:
+    """
+    Generate a valid and urlsafe referral code.
+
+    by the strategy from settings
+    from the pool if it is enabled
+    prefixed by a campaign
+    """
+    prefix = campaign or settings.referral_code_prefix
+    if settings.referral_code_pool_enabled:
+        return get_referral_code_pool(prefix).take()
+    code = referral_code_generator()
+    return f"{prefix}-{code}" if prefix else code
+
+
+def _split_prefix(code: str) -> Tuple[str, str]:
+    """
+    Split a referral code to its prefix with "-" and the generated part.
+
+    urlsafe codes may contain "-" so they are left whole
+    """
+    if isinstance(referral_code_generator, AlphabetCodeGenerator):
+        prefix, separator, code = code.rpartition("-")
+        return prefix + separator, code
+    return "", code
+
+
+def normalize_referral_code(code: str) -> str:
+    """Return a typed referral code as it is generated by settings."""
+    prefix, code = _split_prefix(code)
+    return prefix + referral_code_generator.normalize(code)
+
+
+def check_referral_code(code: str) -> bool:
+    """
+    Check a normalized referral code by the strategy from settings.
+
+    without its prefix
+    if the check is enabled, that is all live codes are of the strategy
+    """
+    if not settings.referral_code_check_enabled:
+        return True
+    valid = referral_code_generator.is_valid(_split_prefix(code)[1])
+    referral_code_checks.inc("valid" if valid else "invalid")
+    return valid
 
 
 def calculate_end_date(
@@ -15,3 +283,15 @@ def calculate_end_date(
 ) -> datetime:
     """Calculate an expiration date."""
     return start_date + timedelta(seconds=interval_in_days)
+
+
+def dump_referrals(fields: Sequence[str], rows: Iterable[tuple]) -> str:
+    """Serialize referral rows to a JSON array."""
+    return _encoder.encode([dict(zip(fields, row)) for row in rows])
+
+
+def dump_referrals_ndjson(fields: Sequence[str], rows: Iterable[tuple]) -> str:
+    """Serialize referral rows to NDJSON lines."""
+    return "".join(
+        _encoder.encode(dict(zip(fields, row))) + "\n" for row in rows
+    )
@@ -4,14 +4,15 @@ from datetime import datetime
 from fastapi import HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.core.cache_codec import CachedReferralCode
 from app.crud import crud_referral
-from app.models import ReferralCode, User
+from app.models import User
 
 
 async def check_referral_code_exists(
     user: User,
     session: AsyncSession,
-) -> ReferralCode:
+) -> CachedReferralCode:
     """Check if a referral code is in a database."""
     code_obj = await crud_referral.get_by_user(
         user,
@@ -27,7 +28,7 @@ async def check_referral_code_exists(
 async def check_referral_code_exists_and_valid(
     code: str,
     session: AsyncSession,
-) -> bool:
+) -> CachedReferralCode:
     """
     Check a referral code.
 
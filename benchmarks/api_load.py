@@ -0,0 +1,246 @@
+"""
+Drive the referral API through load scenarios on seeded data.
+
+register: registration with a seeded referral code
+lookup: batch lookup of seeded referral codes by a superuser
+listing: first page of referrals of a seeded referrer
+rotate: referral code rotation of a seeded referrer, run last
+as it makes the seeded codes outdated
+Every scenario sends a number of requests at fixed concurrency
+through httpx ASGI transport to the app in this process
+after a warm-up, rate limits are off, app errors count as errors.
+Results are printed as JSON: requests per second, p50/p95/p99 latency,
+errors, database statements and redis round-trips per request.
+A previous report given as --baseline is compared on stderr.
+
+Requires postgres and redis from docker compose, a migrated database
+and data seeded by benchmarks.seed.
+Run from the project root:
+python -m benchmarks.api_load [--requests N] [--concurrency N]
+python -m benchmarks.api_load --output new.json --baseline old.json
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+import uuid
+from typing import Callable, Dict, List
+
+import httpx
+from sqlalchemy import Engine, event, select
+
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal, engine
+from app.core.redis import close_redis, redis_command_seconds
+from app.core.user import get_jwt_strategy
+from app.main import app
+from app.models import ReferralCode, User
+from benchmarks.report import build_meta, compare_report, write_report
+from benchmarks.seed import SEED_DOMAIN, SEED_PASSWORD
+
+SCENARIOS = ("register", "lookup", "listing", "rotate")
+
+statements = {"count": 0}
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    """Count statements sent to any database."""
+    statements["count"] += 1
+
+
+def redis_round_trips() -> int:
+    """Return a number of redis round-trips made so far."""
+    return sum(
+        command["count"]
+        for command in redis_command_seconds.snapshot().values()
+    )
+
+
+async def load_fixture(size: int) -> dict:
+    """Load seeded referrers with codes and tokens and the superuser."""
+    async with AsyncSessionLocal() as session:
+        rows = await session.execute(
+            select(User, ReferralCode.code)
+            .join(ReferralCode, ReferralCode.referrer_id == User.id)
+            .where(
+                User.email.endswith(f"@{SEED_DOMAIN}"),
+                ReferralCode.code.is_not(None),
+            )
+            .order_by(User.id)
+            .limit(size),
+        )
+        referrers = rows.all()
+        superuser = await session.scalar(
+            select(User).where(
+                User.email.endswith(f"@{SEED_DOMAIN}"),
+                User.is_superuser,
+            ),
+        )
+    if not referrers or superuser is None:
+        raise SystemExit("Seed data first: python -m benchmarks.seed")
+    strategy = get_jwt_strategy()
+    return {
+        "referrers": [
+            (user.id, await strategy.write_token(user), code)
+            for user, code in referrers
+        ],
+        "superuser_token": await strategy.write_token(superuser),
+    }
+
+
+def build_requests(fixture: dict, args) -> Dict[str, Callable]:
+    """Return functions sending a request of each scenario."""
+    referrers = fixture["referrers"]
+    codes = [code for _, _, code in referrers]
+    superuser = {"Authorization": f"Bearer {fixture['superuser_token']}"}
+
+    def register(client: httpx.AsyncClient):
+        return client.post(
+            "/auth/register",
+            json={
+                "email": f"{uuid.uuid4().hex}@{SEED_DOMAIN}",
+                "password": SEED_PASSWORD,
+                "referral_code": random.choice(codes),
+            },
+        )
+
+    def lookup(client: httpx.AsyncClient):
+        return client.post(
+            "/referral/lookup",
+            json={"codes": random.sample(codes, min(args.batch, len(codes)))},
+            headers=superuser,
+        )
+
+    def listing(client: httpx.AsyncClient):
+        referrer_id, token, _ = random.choice(referrers)
+        return client.get(
+            f"/referral/{referrer_id}",
+            params={"limit": settings.referral_page_size},
+            headers={"Authorization": f"Bearer {token}"},
+        )
+
+    def rotate(client: httpx.AsyncClient):
+        _, token, _ = random.choice(referrers)
+        return client.post(
+            "/referral/",
+            json={"lifetime": 30},
+            headers={"Authorization": f"Bearer {token}"},
+        )
+
+    return {
+        "register": register,
+        "lookup": lookup,
+        "listing": listing,
+        "rotate": rotate,
+    }
+
+
+async def run_scenario(
+    client: httpx.AsyncClient,
+    send: Callable,
+    requests: int,
+    concurrency: int,
+) -> dict:
+    """Send requests at fixed concurrency and summarize them."""
+    latencies: List[float] = []
+    errors = []
+    pending = iter(range(requests))
+
+    async def worker():
+        for _ in pending:
+            start = time.perf_counter()
+            response = await send(client)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors.append(response.status_code)
+
+    statements["count"] = 0
+    round_trips = redis_round_trips()
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "requests": requests,
+        "errors": len(errors),
+        "rps": requests / seconds,
+        "p50_ms": percentiles[49] * 1000,
+        "p95_ms": percentiles[94] * 1000,
+        "p99_ms": percentiles[98] * 1000,
+        "db_statements_per_request": statements["count"] / requests,
+        "redis_round_trips_per_request": (
+            (redis_round_trips() - round_trips) / requests
+        ),
+    }
+
+
+async def main():
+    """Run scenarios and print results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--scenarios",
+        nargs="+",
+        choices=SCENARIOS,
+        default=list(SCENARIOS),
+    )
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--fixture-size", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the report to")
+    parser.add_argument("--baseline", help="report to compare with")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    settings.rate_limit_enabled = False
+    meta = build_meta(
+        requests=args.requests,
+        concurrency=args.concurrency,
+        batch=args.batch,
+        seed=args.seed,
+    )
+    results = {}
+    try:
+        fixture = await load_fixture(args.fixture_size)
+        meta["referrers"] = len(fixture["referrers"])
+        senders = build_requests(fixture, args)
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(
+                app=app,
+                raise_app_exceptions=False,
+            ),
+            base_url="http://bench",
+        ) as client:
+            for name in SCENARIOS:
+                if name not in args.scenarios:
+                    continue
+                await run_scenario(
+                    client,
+                    senders[name],
+                    args.warmup,
+                    args.concurrency,
+                )
+                results[name] = await run_scenario(
+                    client,
+                    senders[name],
+                    args.requests,
+                    args.concurrency,
+                )
+    finally:
+        await engine.dispose()
+        await close_redis()
+    write_report(meta, results, args.output)
+    if args.baseline:
+        compare_report(
+            results,
+            args.baseline,
+            ("rps", "p95_ms", "db_statements_per_request"),
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+"""
+Compare authenticated requests per second with and without user cache.
+
+A superuser is created and requests GET /referral/cache/stats,
+which reads no data, so the time is spent resolving the user.
+Requests run in the app process through httpx ASGI transport.
+Database queries are counted per request.
+
+Requires postgres and redis from docker compose and a migrated database.
+Run from the project root:
+python -m benchmarks.auth_resolution [--requests N] [--concurrency N]
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+import httpx
+from sqlalchemy import delete, event
+
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal, engine
+from app.core.redis import close_redis, delete_user_redis
+from app.core.user import get_jwt_strategy
+from app.main import app
+from app.models import User
+
+queries = {"count": 0}
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    """Count statements sent to the database."""
+    queries["count"] += 1
+
+
+async def run(client: httpx.AsyncClient, token: str, args) -> float:
+    """Send requests concurrently and return requests per second."""
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def request():
+        async with semaphore:
+            response = await client.get(
+                "/referral/cache/stats",
+                headers={"Authorization": f"Bearer {token}"},
+            )
+            response.raise_for_status()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(request() for _ in range(args.requests)))
+    return args.requests / (time.perf_counter() - start)
+
+
+async def main():
+    """Print requests per second and queries per request."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    user = User(
+        id=uuid.uuid4(),
+        email=f"{uuid.uuid4().hex}@bench.example",
+        hashed_password="bench",
+        is_superuser=True,
+    )
+    async with AsyncSessionLocal() as session:
+        session.add(user)
+        await session.commit()
+    token = await get_jwt_strategy().write_token(user)
+    transport = httpx.ASGITransport(app=app)
+    try:
+        async with httpx.AsyncClient(
+            transport=transport,
+            base_url="http://bench",
+        ) as client:
+            for cached in (False, True):
+                settings.user_cache_enabled = cached
+                await delete_user_redis(user.id)
+                queries["count"] = 0
+                rate = await run(client, token, args)
+                print(
+                    f"user_cache={cached!s:<6}requests/s={rate:<10.0f}"
+                    f"queries/request={queries['count'] / args.requests:.3f}",
+                )
+    finally:
+        await delete_user_redis(user.id)
+        async with AsyncSessionLocal() as session:
+            await session.execute(delete(User).where(User.id == user.id))
+            await session.commit()
+        await engine.dispose()
+        await close_redis()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
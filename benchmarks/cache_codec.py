@@ -0,0 +1,67 @@
+"""
+Compare redis cache payloads of a ReferralCode obj.
+
+pickle: the previous format, a pickled ORM obj
+codec: app.core.cache_codec format
+
+Run from the project root:
+python -m benchmarks.cache_codec [--number N]
+"""
+import argparse
+import pickle
+import timeit
+import uuid
+from datetime import datetime
+
+from app.core.cache_codec import decode_referral, encode_referral
+from app.models import ReferralCode
+from app.services.referral import calculate_end_date, generate_referral_code
+
+
+def build_referral_code() -> ReferralCode:
+    """Build a ReferralCode obj like the one CRUDReferral caches."""
+    created_at = datetime.now()
+    return ReferralCode(
+        referrer_id=uuid.uuid4(),
+        code=generate_referral_code(),
+        created_at=created_at,
+        expiration_at=calculate_end_date(created_at, 30),
+    )
+
+
+def measure(name: str, encode, decode, db_obj, number: int) -> dict:
+    """Measure payload size and encode/decode time in ns per entry."""
+    payload = encode(db_obj)
+    encode_time = timeit.timeit(lambda: encode(db_obj), number=number)
+    decode_time = timeit.timeit(lambda: decode(payload), number=number)
+    return {
+        "format": name,
+        "bytes": len(payload),
+        "encode_ns": encode_time / number * 1e9,
+        "decode_ns": decode_time / number * 1e9,
+    }
+
+
+def main():
+    """Print a comparison table."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=100_000)
+    args = parser.parse_args()
+
+    db_obj = build_referral_code()
+    results = [
+        measure("pickle", pickle.dumps, pickle.loads, db_obj, args.number),
+        measure(
+            "codec", encode_referral, decode_referral, db_obj, args.number,
+        ),
+    ]
+    print(f"{'format':<8}{'bytes':>8}{'encode ns':>12}{'decode ns':>12}")
+    for result in results:
+        print(
+            f"{result['format']:<8}{result['bytes']:>8}"
+            f"{result['encode_ns']:>12.0f}{result['decode_ns']:>12.0f}",
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Count database queries under a burst of identical referral code lookups.
+
+A referral code is created, dropped from redis cache
+and then looked up concurrently with each lookup in its own session,
+once without coalescing and once with the in-process single-flight.
+
+Requires postgres and redis from docker compose and a migrated database.
+Run from the project root:
+python -m benchmarks.cache_miss_burst [--concurrency N] [--lock]
+"""
+import argparse
+import asyncio
+import uuid
+
+from sqlalchemy import delete, event
+
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal, engine
+from app.core.redis import delete_referral_redis
+from app.crud import crud_referral
+from app.models import ReferralCode, User
+
+queries = {"select": 0}
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def count_select(conn, cursor, statement, parameters, context, executemany):
+    """Count SELECT statements sent to the database."""
+    if statement.lstrip().upper().startswith("SELECT"):
+        queries["select"] += 1
+
+
+async def lookup(code: str):
+    """Look up a referral code in its own session like a request does."""
+    async with AsyncSessionLocal() as session:
+        return await crud_referral.get_by_referral_code(code, session)
+
+
+async def burst(code_obj: ReferralCode, concurrency: int) -> int:
+    """Drop a code from redis cache and look it up concurrently."""
+    await delete_referral_redis(code_obj)
+    queries["select"] = 0
+    results = await asyncio.gather(
+        *(lookup(code_obj.code) for _ in range(concurrency)),
+    )
+    assert all(result is not None for result in results)
+    return queries["select"]
+
+
+async def main():
+    """Print database queries per burst with and without coalescing."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument(
+        "--lock",
+        action="store_true",
+        help="coalesce with redis lock as well",
+    )
+    args = parser.parse_args()
+    settings.referral_cache_lock_enabled = args.lock
+
+    async with AsyncSessionLocal() as session:
+        user = User(
+            id=uuid.uuid4(),
+            email=f"{uuid.uuid4().hex}@bench.example",
+            hashed_password="bench",
+        )
+        session.add(user)
+        await session.commit()
+        code_obj = await crud_referral.upsert(user, 3600, session)
+    try:
+        for single_flight in (False, True):
+            settings.referral_single_flight_enabled = single_flight
+            selects = await burst(code_obj, args.concurrency)
+            print(
+                f"single_flight={single_flight!s:<6}"
+                f"lookups={args.concurrency:<6}selects={selects}",
+            )
+    finally:
+        await delete_referral_redis(code_obj)
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                delete(ReferralCode).where(
+                    ReferralCode.referrer_id == user.id,
+                ),
+            )
+            await session.execute(delete(User).where(User.id == user.id))
+            await session.commit()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
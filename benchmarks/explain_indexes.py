@@ -0,0 +1,141 @@
+"""
+Show query plans of referral lookups with and without lookup indexes.
+
+Seeds users, referrers and referral codes with generate_series,
+then runs EXPLAIN ANALYZE for each lookup twice:
+with the indexes dropped inside a rolled back transaction
+and with the indexes in place.
+
+Requires postgres from docker compose migrated to head.
+Run from the project root:
+python -m benchmarks.explain_indexes [--users N] [--cleanup]
+"""
+import argparse
+import asyncio
+
+from sqlalchemy import text
+
+from app.core.database import engine
+
+BENCH_EMAIL = "bench-%@bench.example"
+
+INDEXES = (
+    "ix_referralcode_code",
+    "ix_referralcode_active_expiration_at",
+    "ix_user_referrer_id_id",
+)
+
+SEED = (
+    """
+    INSERT INTO "user" (id, email, hashed_password,
+                        is_active, is_superuser, is_verified)
+    SELECT gen_random_uuid(), 'bench-referrer-' || n || '@bench.example',
+           'bench', true, false, false
+    FROM generate_series(1, :referrers) AS n
+    """,
+    """
+    WITH referrers AS (
+        SELECT array_agg(id) AS ids FROM "user"
+        WHERE email LIKE 'bench-referrer-%'
+    )
+    INSERT INTO "user" (id, email, hashed_password,
+                        is_active, is_superuser, is_verified, referrer_id)
+    SELECT gen_random_uuid(), 'bench-user-' || n || '@bench.example',
+           'bench', true, false, false,
+           ids[1 + floor(random() * array_length(ids, 1))::int]
+    FROM generate_series(1, :users) AS n, referrers
+    """,
+    """
+    INSERT INTO referralcode (referrer_id, code, created_at, expiration_at)
+    SELECT id, md5(id::text), now(),
+           now() + (random() * 60 - 30) * interval '1 day'
+    FROM "user"
+    WHERE email LIKE :email
+    """,
+    'ANALYZE "user"',
+    "ANALYZE referralcode",
+)
+
+QUERIES = {
+    "code lookup": (
+        "SELECT * FROM referralcode WHERE code = "
+        "(SELECT md5(id::text) FROM \"user\" "
+        "WHERE email = 'bench-user-1@bench.example')"
+    ),
+    "referrals by referrer": (
+        'SELECT * FROM "user" WHERE referrer_id = '
+        "(SELECT id FROM \"user\" "
+        "WHERE email = 'bench-referrer-1@bench.example')"
+    ),
+    "active codes expiring today": (
+        "SELECT count(*) FROM referralcode "
+        "WHERE code IS NOT NULL "
+        "AND expiration_at BETWEEN now() AND now() + interval '1 day'"
+    ),
+}
+
+CLEANUP = (
+    """
+    DELETE FROM referralcode WHERE referrer_id IN
+    (SELECT id FROM "user" WHERE email LIKE :email)
+    """,
+    'DELETE FROM "user" WHERE email LIKE :email AND referrer_id IS NOT NULL',
+    'DELETE FROM "user" WHERE email LIKE :email',
+)
+
+
+async def explain(connection, title: str):
+    """Print plans of all lookups."""
+    for name, query in QUERIES.items():
+        plan = await connection.execute(
+            text(f"EXPLAIN (ANALYZE, BUFFERS) {query}"),
+        )
+        print(f"--- {name}: {title}")
+        print("\n".join(row[0] for row in plan))
+
+
+async def main():
+    """Seed the database and print plans."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--referrers", type=int, default=10_000)
+    parser.add_argument(
+        "--no-seed",
+        action="store_true",
+        help="reuse data seeded by a previous run",
+    )
+    parser.add_argument(
+        "--cleanup",
+        action="store_true",
+        help="delete seeded data afterwards",
+    )
+    args = parser.parse_args()
+    params = {
+        "users": args.users,
+        "referrers": args.referrers,
+        "email": BENCH_EMAIL,
+    }
+
+    if not args.no_seed:
+        async with engine.begin() as connection:
+            for statement in SEED:
+                await connection.execute(text(statement), params)
+
+    async with engine.connect() as connection:
+        transaction = await connection.begin()
+        for index in INDEXES:
+            await connection.execute(text(f"DROP INDEX {index}"))
+        await explain(connection, "without indexes")
+        await transaction.rollback()
+
+        await explain(connection, "with indexes")
+
+    if args.cleanup:
+        async with engine.begin() as connection:
+            for statement in CLEANUP:
+                await connection.execute(text(statement), params)
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
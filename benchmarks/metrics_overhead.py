@@ -0,0 +1,95 @@
+"""
+Measure overhead of metrics per request.
+
+A bare FastAPI app is called through httpx ASGI transport
+with and without MetricsMiddleware, the difference of mean request time
+is the overhead of timing a request.
+Observing a histogram, timing a block and rendering the registry
+are timed on their own.
+
+Requires no services.
+Run from the project root:
+python -m benchmarks.metrics_overhead [--requests N] [--rounds N]
+"""
+import argparse
+import asyncio
+import time
+import timeit
+
+import httpx
+from fastapi import FastAPI
+
+from app.core.metrics import Histogram, render
+from app.core.middleware import MetricsMiddleware
+
+
+def build_app(metrics: bool) -> FastAPI:
+    """Return an app with one route doing nothing."""
+    app = FastAPI()
+
+    @app.get("/items/{item_id}")
+    async def get_item(item_id: int) -> dict:
+        return {"id": item_id}
+
+    if metrics:
+        app.add_middleware(MetricsMiddleware)
+    return app
+
+
+async def request_time(app: FastAPI, requests: int) -> float:
+    """Return a mean request time in microseconds."""
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app),
+        base_url="http://bench",
+    ) as client:
+        await client.get("/items/0")
+        start = time.perf_counter()
+        for item_id in range(requests):
+            await client.get(f"/items/{item_id}")
+    return (time.perf_counter() - start) / requests * 1e6
+
+
+def call_time(statement, number: int) -> float:
+    """Return a mean time of a call in nanoseconds."""
+    best = min(timeit.repeat(statement, number=number, repeat=5))
+    return best / number * 1e9
+
+
+def time_block(histogram: Histogram) -> None:
+    """Time an empty block."""
+    with histogram.time("bench"):
+        pass
+
+
+async def main():
+    """Print request times with and without metrics and costs of calls."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    apps = {metrics: build_app(metrics) for metrics in (False, True)}
+    times = {False: [], True: []}
+    for _ in range(args.rounds):
+        for metrics, app in apps.items():
+            times[metrics].append(await request_time(app, args.requests))
+    bare, timed = min(times[False]), min(times[True])
+    print(f"request without metrics  {bare:>9.1f} us")
+    print(f"request with metrics     {timed:>9.1f} us")
+    print(f"overhead per request     {timed - bare:>9.1f} us")
+
+    histogram = Histogram("bench_seconds", "Benchmark timings.", ("label",))
+    print(
+        "histogram observe        "
+        f"{call_time(lambda: histogram.observe(0.01, 'bench'), 100_000):>9.0f}"
+        " ns",
+    )
+    print(
+        "timed block              "
+        f"{call_time(lambda: time_block(histogram), 100_000):>9.0f} ns",
+    )
+    print(f"render registry          {call_time(render, 100) / 1000:>9.1f} us")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,103 @@
+"""
+Micro-benchmarks of hot functions emitting a report for comparison.
+
+code_<strategy>: generation of a code by each strategy
+generate_referral_code: generation by settings, with the pool if enabled
+cache_encode, cache_decode: app.core.cache_codec of a ReferralCode obj
+code_read: ReferralCodeRead of a cached code dumped to JSON
+listing_orm, listing_rows: a page of referrals serialized
+through the response model and from column tuples
+Results are the best time per call in nanoseconds of several rounds.
+A previous report given as --baseline is compared on stderr.
+
+Requires no services.
+Run from the project root:
+python -m benchmarks.micro [--number N] [--output new.json]
+python -m benchmarks.micro --baseline old.json
+"""
+import argparse
+import timeit
+from typing import Callable, Dict
+
+from app.core.cache_codec import (CachedReferralCode, decode_referral,
+                                  encode_referral)
+from app.core.config import settings
+from app.crud import crud_user
+from app.schemas import ReferralCodeRead
+from app.services.referral import CODE_GENERATORS, generate_referral_code
+from benchmarks.cache_codec import build_referral_code
+from benchmarks.referral_serialization import build_users, dump_orm, dump_rows
+from benchmarks.report import build_meta, compare_report, write_report
+
+
+def build_benchmarks(page_size: int) -> Dict[str, Callable]:
+    """Return calls to be timed by name."""
+    calls = {
+        f"code_{strategy}": CODE_GENERATORS[strategy](
+            settings.referral_link_length,
+        )
+        for strategy in CODE_GENERATORS
+    }
+    db_obj = build_referral_code()
+    payload = encode_referral(db_obj)
+    cached = CachedReferralCode.from_model(db_obj)
+    users = build_users(page_size)
+    rows = [
+        tuple(getattr(user, field) for field in crud_user.referral_fields)
+        for user in users
+    ]
+    calls.update(
+        {
+            "generate_referral_code": generate_referral_code,
+            "cache_encode": lambda: encode_referral(db_obj),
+            "cache_decode": lambda: decode_referral(payload),
+            "code_read": lambda: ReferralCodeRead.model_validate(
+                cached,
+            ).model_dump_json(),
+            "listing_orm": lambda: dump_orm(users),
+            "listing_rows": lambda: dump_rows(rows),
+        },
+    )
+    return calls
+
+
+def call_time(call: Callable, number: int, rounds: int) -> float:
+    """Return the best time of a call in nanoseconds."""
+    best = min(timeit.repeat(call, number=number, repeat=rounds))
+    return best / number * 1e9
+
+
+def main():
+    """Time calls and print results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=10_000)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=settings.referral_page_size,
+    )
+    parser.add_argument("--output", help="file to write the report to")
+    parser.add_argument("--baseline", help="report to compare with")
+    args = parser.parse_args()
+
+    results = {}
+    for name, call in build_benchmarks(args.page_size).items():
+        number = args.number
+        if name.startswith("listing"):
+            number = max(args.number // args.page_size, 1)
+        results[name] = {"ns_per_call": call_time(call, number, args.rounds)}
+    meta = build_meta(
+        number=args.number,
+        rounds=args.rounds,
+        page_size=args.page_size,
+        code_strategy=settings.referral_code_strategy,
+        referral_link_length=settings.referral_link_length,
+    )
+    write_report(meta, results, args.output)
+    if args.baseline:
+        compare_report(results, args.baseline, ("ns_per_call",))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Measure event loop latency while logins verify passwords.
+
+inline: passwords verified on the event loop thread
+as the default password helper of fastapi-users does
+pool: passwords verified by app.core.password in the thread pool
+A probe standing for concurrent lookups sleeps for an interval
+in a loop, its lateness is the time other coroutines would wait.
+Logins are run at fixed concurrency, the probe lateness is reported
+as p50/p99/max along with logins per second.
+Hash time of schemes and rounds is reported as well.
+
+Requires no services.
+Run from the project root:
+python -m benchmarks.password_hashing [--logins N] [--concurrency N]
+"""
+import argparse
+import asyncio
+import time
+from typing import Awaitable, Callable, List
+
+from app.core.config import settings
+from app.core.password import (build_password_context, password_helper,
+                               verify_and_update_password)
+
+PASSWORD = "bench-password"
+COSTS = (
+    ("bcrypt", 10),
+    ("bcrypt", 12),
+    ("pbkdf2_sha256", 29000),
+)
+
+
+async def verify_inline(password: str, hashed_password: str):
+    """Verify a password on the event loop thread."""
+    return password_helper.verify_and_update(password, hashed_password)
+
+
+async def probe(interval: float, lateness: List[float], done: asyncio.Event):
+    """Sleep in a loop and record how late it wakes up."""
+    while not done.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lateness.append(time.perf_counter() - start - interval)
+
+
+async def run_logins(
+    verify: Callable[[str, str], Awaitable],
+    hashed_password: str,
+    logins: int,
+    concurrency: int,
+    interval: float,
+) -> dict:
+    """Verify passwords at fixed concurrency with the probe running."""
+    pending = iter(range(logins))
+    lateness: List[float] = []
+    done = asyncio.Event()
+
+    async def worker():
+        for _ in pending:
+            await verify(PASSWORD, hashed_password)
+
+    probe_task = asyncio.create_task(probe(interval, lateness, done))
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+    done.set()
+    await probe_task
+    lateness.sort()
+    return {
+        "logins_per_second": logins / seconds,
+        "p50_ms": lateness[int(0.5 * (len(lateness) - 1))] * 1000,
+        "p99_ms": lateness[int(0.99 * (len(lateness) - 1))] * 1000,
+        "max_ms": lateness[-1] * 1000,
+    }
+
+
+def hash_time(scheme: str, rounds: int, number: int) -> float:
+    """Return a mean hash time in milliseconds."""
+    context = build_password_context(scheme, rounds)
+    start = time.perf_counter()
+    for _ in range(number):
+        context.hash(PASSWORD)
+    return (time.perf_counter() - start) / number * 1000
+
+
+async def main():
+    """Print probe lateness of both ways and hash time of costs."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--logins", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=0.005)
+    parser.add_argument("--number", type=int, default=5)
+    args = parser.parse_args()
+
+    hashed_password = password_helper.hash(PASSWORD)
+    print(
+        f"{settings.password_hash_scheme}, "
+        f"{settings.password_hash_workers} workers, "
+        f"{args.logins} logins at concurrency {args.concurrency}",
+    )
+    print(
+        f"{'way':<8}{'logins/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}",
+    )
+    for name, verify in (
+        ("inline", verify_inline),
+        ("pool", verify_and_update_password),
+    ):
+        result = await run_logins(
+            verify,
+            hashed_password,
+            args.logins,
+            args.concurrency,
+            args.interval,
+        )
+        print(
+            f"{name:<8}{result['logins_per_second']:>10.1f}"
+            f"{result['p50_ms']:>9.1f}{result['p99_ms']:>9.1f}"
+            f"{result['max_ms']:>9.1f}",
+        )
+
+    print(f"\n{'scheme':<15}{'rounds':>8}{'hash ms':>10}")
+    for scheme, rounds in COSTS:
+        print(
+            f"{scheme:<15}{rounds:>8}"
+            f"{hash_time(scheme, rounds, args.number):>10.1f}",
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,114 @@
+"""
+Measure database load of guessing referral codes on registration.
+
+An attacker registers with random referral codes from one ip address,
+every guess misses the cache and is looked up in the database.
+Meanwhile clients each from its own ip address register the same way
+one at a time and their latency is measured,
+as the attacker slows down the event loop and the database shared with them.
+Both run with rate limits on and off, the ip address is sent
+in X-Forwarded-For header as if set by a proxy.
+Requests run in the app process through httpx ASGI transport.
+
+Requires postgres and redis from docker compose and a migrated database.
+Run from the project root:
+python -m benchmarks.referral_code_guessing [--seconds N] [--concurrency N]
+"""
+import argparse
+import asyncio
+import secrets
+import statistics
+import time
+import uuid
+from collections import Counter
+
+import httpx
+from sqlalchemy import event
+
+from app.core.config import settings
+from app.core.database import engine
+from app.core.redis import close_redis
+from app.main import app
+
+queries = {"count": 0}
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    """Count statements sent to the database."""
+    queries["count"] += 1
+
+
+async def register(client: httpx.AsyncClient, ip: str) -> httpx.Response:
+    """Register with a random referral code."""
+    return await client.post(
+        "/auth/register",
+        json={
+            "email": f"{uuid.uuid4().hex}@bench.example",
+            "password": "bench-password",
+            "referral_code": secrets.token_urlsafe(12),
+        },
+        headers={"X-Forwarded-For": ip},
+    )
+
+
+async def attack(client: httpx.AsyncClient, deadline: float, args) -> Counter:
+    """Guess codes from one ip address and count response statuses."""
+    statuses = []
+
+    async def guess():
+        while time.perf_counter() < deadline:
+            response = await register(client, "203.0.113.1")
+            statuses.append(int(response.status_code))
+
+    await asyncio.gather(*(guess() for _ in range(args.concurrency)))
+    return Counter(statuses)
+
+
+async def visit(client: httpx.AsyncClient, deadline: float) -> list:
+    """Register from new ip addresses and return sorted latencies in ms."""
+    latencies = []
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        await register(client, f"198.51.100.{len(latencies) % 250}")
+        latencies.append((time.perf_counter() - start) * 1000)
+    return sorted(latencies)
+
+
+async def main():
+    """Print database queries per second and latency of other clients."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    settings.rate_limit_client_ip_header = "X-Forwarded-For"
+    settings.rate_limits = {"register": (1, 10)}
+    transport = httpx.ASGITransport(app=app)
+    try:
+        async with httpx.AsyncClient(
+            transport=transport,
+            base_url="http://bench",
+        ) as client:
+            for limited in (False, True):
+                settings.rate_limit_enabled = limited
+                queries["count"] = 0
+                deadline = time.perf_counter() + args.seconds
+                latencies, statuses = await asyncio.gather(
+                    visit(client, deadline),
+                    attack(client, deadline, args),
+                )
+                print(
+                    f"rate_limit={limited!s:<6}"
+                    f"visitor_ms p50={statistics.median(latencies):<6.2f}"
+                    f"p95={latencies[int(len(latencies) * 0.95)]:<6.2f}"
+                    f"queries/s={queries['count'] / args.seconds:<7.0f}"
+                    f"statuses={dict(statuses)}",
+                )
+    finally:
+        await engine.dispose()
+        await close_redis()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
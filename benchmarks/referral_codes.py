@@ -0,0 +1,95 @@
+"""
+Compare referral code generator strategies.
+
+codes/s: codes generated per second
+collisions: share of new codes already taken in a table of a certain size
+measured and expected from the size of the code space
+typos: share of codes with one mistyped symbol caught by the check symbol
+
+Run from the project root:
+python -m benchmarks.referral_codes [--tables 10000 100000 1000000]
+"""
+import argparse
+import random
+import time
+
+from app.services.referral import CODE_GENERATORS, AlphabetCodeGenerator
+
+LENGTHS = {
+    "urlsafe": (4, 6, 16),
+    "base62": (5, 6, 8),
+    "crockford": (6, 8, 10),
+}
+
+
+def code_space(strategy: str, length: int) -> int:
+    """Return a number of distinct codes of a strategy."""
+    if strategy == "urlsafe":
+        return 256 ** length
+    generator = CODE_GENERATORS[strategy](length)
+    return len(generator.alphabet) ** length
+
+
+def codes_per_second(generator, count: int) -> float:
+    """Return a rate of code generation."""
+    start = time.perf_counter()
+    for _ in range(count):
+        generator()
+    return count / (time.perf_counter() - start)
+
+
+def collision_rate(generator, table: int, probes: int) -> float:
+    """Return a share of new codes already taken in a table."""
+    taken = {generator() for _ in range(table)}
+    return sum(generator() in taken for _ in range(probes)) / probes
+
+
+def typo_rate(generator, probes: int) -> str:
+    """Return a share of mistyped codes caught by the check symbol."""
+    if not isinstance(generator, AlphabetCodeGenerator):
+        return "-"
+    caught = 0
+    for _ in range(probes):
+        code = list(generator())
+        position = random.randrange(len(code))
+        code[position] = random.choice(
+            generator.alphabet.replace(code[position], ""),
+        )
+        caught += not generator.is_valid("".join(code))
+    return f"{caught / probes:.1%}"
+
+
+def main():
+    """Print rates for each strategy, length and table size."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--tables",
+        type=int,
+        nargs="+",
+        default=[10_000, 100_000, 1_000_000],
+    )
+    parser.add_argument("--count", type=int, default=100_000)
+    parser.add_argument("--probes", type=int, default=100_000)
+    args = parser.parse_args()
+
+    print(
+        f"{'strategy':<10}{'length':>7}{'codes/s':>11}{'table':>10}"
+        f"{'collisions':>12}{'expected':>12}{'typos':>7}",
+    )
+    for strategy, lengths in LENGTHS.items():
+        for length in lengths:
+            generator = CODE_GENERATORS[strategy](length)
+            rate = codes_per_second(generator, args.count)
+            typos = typo_rate(generator, args.probes)
+            space = code_space(strategy, length)
+            for table in args.tables:
+                collisions = collision_rate(generator, table, args.probes)
+                print(
+                    f"{strategy:<10}{length:>7}{rate:>11.0f}{table:>10}"
+                    f"{collisions:>12.2e}{table / space:>12.2e}"
+                    f"{typos:>7}",
+                )
+
+
+if __name__ == "__main__":
+    main()
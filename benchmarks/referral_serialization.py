@@ -0,0 +1,94 @@
+"""
+Compare serialization throughput of referral listings.
+
+orm: User ORM objs validated through List[UserRead] and dumped to JSON
+the way FastAPI serializes a response_model
+rows: selected column tuples dumped by app.services.referral
+
+Run from the project root:
+python -m benchmarks.referral_serialization [--sizes 10000 100000]
+"""
+import argparse
+import json
+import time
+import uuid
+from typing import List
+
+from pydantic import TypeAdapter
+
+from app.crud import crud_user
+from app.models import User
+from app.schemas import UserRead
+from app.services.referral import dump_referrals
+
+users_adapter = TypeAdapter(List[UserRead])
+
+
+def build_users(size: int) -> List[User]:
+    """Build referrals of one referrer as ORM objs."""
+    referrer_id = uuid.uuid4()
+    return [
+        User(
+            id=uuid.uuid4(),
+            email=f"referral{number}@example.com",
+            hashed_password="x" * 60,
+            is_active=True,
+            is_superuser=False,
+            is_verified=False,
+            referrer_id=referrer_id,
+        )
+        for number in range(size)
+    ]
+
+
+def dump_orm(users: List[User]) -> str:
+    """Serialize ORM objs through the response model."""
+    return json.dumps(
+        users_adapter.dump_python(
+            users_adapter.validate_python(users, from_attributes=True),
+            mode="json",
+        ),
+    )
+
+
+def dump_rows(rows: List[tuple]) -> str:
+    """Serialize column tuples."""
+    return dump_referrals(crud_user.referral_fields, rows)
+
+
+def rows_per_second(func, data, repeat: int) -> float:
+    """Return the best throughput of several runs."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(data)
+        best = min(best, time.perf_counter() - start)
+    return len(data) / best
+
+
+def main():
+    """Print rows per second for each listing size."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10_000, 100_000],
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'rows':>8}{'orm rows/s':>14}{'rows rows/s':>14}{'speedup':>10}")
+    for size in args.sizes:
+        users = build_users(size)
+        rows = [
+            tuple(getattr(user, field) for field in crud_user.referral_fields)
+            for user in users
+        ]
+        orm = rows_per_second(dump_orm, users, args.repeat)
+        plain = rows_per_second(dump_rows, rows, args.repeat)
+        print(f"{size:>8}{orm:>14.0f}{plain:>14.0f}{plain / orm:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Compare referral tree queries on the closure and with recursive CTEs.
+
+Two synthetic trees are seeded with their closure:
+a chain of users each referred by the previous one
+and a tree where every user has fanout referrals for a number of levels.
+Ancestors of the deepest user, the first page of descendants
+and descendant counts of the root are timed on both sources.
+
+Requires postgres from docker compose and a migrated database.
+Run from the project root:
+python -m benchmarks.referral_tree [--chain N] [--fanout N] [--levels N]
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+from sqlalchemy import delete, insert
+
+from app.core.database import AsyncSessionLocal, engine
+from app.crud import crud_user
+from app.models import ReferralClosure, User
+
+EMAIL_DOMAIN = "tree.bench.example"
+
+
+def build_chain(length: int) -> list:
+    """Return (id, referrer id) pairs of a chain of users."""
+    users, referrer_id = [], None
+    for _ in range(length):
+        user_id = uuid.uuid4()
+        users.append((user_id, referrer_id))
+        referrer_id = user_id
+    return users
+
+
+def build_fanout(fanout: int, levels: int) -> list:
+    """Return (id, referrer id) pairs of a tree of users."""
+    root = uuid.uuid4()
+    users, level = [(root, None)], [root]
+    for _ in range(levels):
+        level_users = [
+            (uuid.uuid4(), referrer_id)
+            for referrer_id in level
+            for _ in range(fanout)
+        ]
+        users += level_users
+        level = [user_id for user_id, _ in level_users]
+    return users
+
+
+async def seed(users: list, batch_size: int) -> None:
+    """Insert users ordered from the root and their closure."""
+    ancestors = {}
+    closure = []
+    for user_id, referrer_id in users:
+        chain = []
+        if referrer_id is not None:
+            chain = [referrer_id] + ancestors[referrer_id]
+        ancestors[user_id] = chain
+        closure += [
+            {
+                "ancestor_id": ancestor_id,
+                "descendant_id": user_id,
+                "depth": depth,
+            }
+            for depth, ancestor_id in enumerate(chain, 1)
+        ]
+    rows = [
+        {
+            "id": user_id,
+            "email": f"{user_id.hex}@{EMAIL_DOMAIN}",
+            "hashed_password": "bench",
+            "referrer_id": referrer_id,
+        }
+        for user_id, referrer_id in users
+    ]
+    async with AsyncSessionLocal() as session:
+        for start in range(0, len(rows), batch_size):
+            await session.execute(insert(User), rows[start:start + batch_size])
+        for start in range(0, len(closure), batch_size):
+            await session.execute(
+                insert(ReferralClosure),
+                closure[start:start + batch_size],
+            )
+        await session.commit()
+
+
+async def timed(query, repeats: int) -> float:
+    """Return the mean time of a query in ms."""
+    async with AsyncSessionLocal() as session:
+        await query(session)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            await query(session)
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+async def compare(name: str, users: list, args) -> None:
+    """Print query times of a tree on the closure and with CTEs."""
+    root, leaf = users[0][0], users[-1][0]
+    max_depth = len(users)
+    queries = {
+        "ancestors": lambda session, closure: crud_user.get_ancestors(
+            leaf, max_depth, session, closure,
+        ),
+        "descendants": lambda session, closure: crud_user.get_descendants(
+            root, max_depth, args.limit, session, closure,
+        ),
+        "count": lambda session, closure: crud_user.count_descendants(
+            root, max_depth, session, closure,
+        ),
+    }
+    for query_name, query in queries.items():
+        times = [
+            await timed(
+                lambda session: query(session, closure),
+                args.repeats,
+            )
+            for closure in (True, False)
+        ]
+        print(
+            f"{name:<8}{len(users):>8}{query_name:>13}"
+            f"{times[0]:>11.2f}{times[1]:>11.2f}",
+        )
+
+
+async def main():
+    """Seed trees, print query times and remove the trees."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chain", type=int, default=500)
+    parser.add_argument("--fanout", type=int, default=20)
+    parser.add_argument("--levels", type=int, default=3)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    trees = {
+        "chain": build_chain(args.chain),
+        "fanout": build_fanout(args.fanout, args.levels),
+    }
+    try:
+        for users in trees.values():
+            await seed(users, args.batch_size)
+        print(
+            f"{'tree':<8}{'users':>8}{'query':>13}"
+            f"{'closure ms':>11}{'cte ms':>11}",
+        )
+        for name, users in trees.items():
+            await compare(name, users, args)
+    finally:
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                delete(User).where(User.email.endswith(f"@{EMAIL_DOMAIN}")),
+            )
+            await session.commit()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,76 @@
+"""
+Machine-readable reports of benchmarks for regression comparison.
+
+A report is JSON with meta of the run and results by name,
+each result a dict of numbers.
+"""
+import json
+import platform
+import subprocess
+import sys
+from datetime import datetime
+from typing import Dict, Optional, Sequence
+
+
+def git_commit() -> str:
+    """Return the current commit or an empty string."""
+    result = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout.strip()
+
+
+def build_meta(**values) -> dict:
+    """Return meta of the run with certain values."""
+    return {
+        "commit": git_commit(),
+        "started_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        **values,
+    }
+
+
+def write_report(
+    meta: dict,
+    results: Dict[str, dict],
+    output: Optional[str] = None,
+) -> None:
+    """Print a report and write it to the output file."""
+    report = json.dumps({"meta": meta, "results": results}, indent=2)
+    if output:
+        with open(output, "w") as file:
+            file.write(report + "\n")
+    print(report)
+
+
+def compare_report(
+    results: Dict[str, dict],
+    baseline: str,
+    metrics: Sequence[str],
+) -> None:
+    """Print metrics of results and their change against a baseline file."""
+    with open(baseline) as file:
+        base_results = json.load(file)["results"]
+    widths = [max(len(metric), 10) + 2 for metric in metrics]
+    print(
+        f"{'name':<24}"
+        + "".join(
+            f"{metric:>{width}}{'change':>9}"
+            for metric, width in zip(metrics, widths)
+        ),
+        file=sys.stderr,
+    )
+    for name, result in results.items():
+        base = base_results.get(name)
+        if base is None:
+            continue
+        line = f"{name:<24}"
+        for metric, width in zip(metrics, widths):
+            change = (
+                f"{result[metric] / base[metric] - 1:+.1%}"
+                if base[metric] else "-"
+            )
+            line += f"{result[metric]:>{width}.2f}{change:>9}"
+        print(line, file=sys.stderr)
@@ -0,0 +1,131 @@
+"""
+Seed the database and redis cache for load tests.
+
+Referrers with referral codes are created along with their referrals
+and a superuser, all with emails at SEED_DOMAIN and one password.
+Codes are issued the way the bulk endpoint does and set to redis cache.
+Seeding again adds more users, --clean removes every seeded user.
+
+Requires postgres and redis from docker compose and a migrated database.
+Run from the project root:
+python -m benchmarks.seed [--referrers N] [--referrals N] [--clean]
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+from fastapi_users.password import PasswordHelper
+from sqlalchemy import delete, insert, select
+
+from app.core.database import AsyncSessionLocal, engine
+from app.core.redis import close_redis, delete_referral_redis
+from app.crud import crud_referral
+from app.models import ReferralClosure, ReferralCode, User
+
+SEED_DOMAIN = "seed.bench.example"
+SEED_PASSWORD = "bench-password"
+
+
+def build_user(hashed_password: str, **values) -> dict:
+    """Return column values of a seeded user."""
+    user_id = uuid.uuid4()
+    return {
+        "id": user_id,
+        "email": f"{user_id.hex}@{SEED_DOMAIN}",
+        "hashed_password": hashed_password,
+        **values,
+    }
+
+
+async def seed(referrers: int, referrals: int, batch_size: int) -> dict:
+    """
+    Create seeded users and referral codes.
+
+    return numbers of created rows
+    """
+    hashed_password = PasswordHelper().hash(SEED_PASSWORD)
+    referrer_rows = [build_user(hashed_password) for _ in range(referrers)]
+    referral_rows = [
+        build_user(hashed_password, referrer_id=referrer["id"])
+        for referrer in referrer_rows
+        for _ in range(referrals)
+    ]
+    superuser_row = build_user(hashed_password, is_superuser=True)
+    rows = [superuser_row] + referrer_rows + referral_rows
+    async with AsyncSessionLocal() as session:
+        for start in range(0, len(rows), batch_size):
+            await session.execute(insert(User), rows[start:start + batch_size])
+        for start in range(0, len(referral_rows), batch_size):
+            await session.execute(
+                insert(ReferralClosure),
+                [
+                    {
+                        "ancestor_id": referral["referrer_id"],
+                        "descendant_id": referral["id"],
+                        "depth": 1,
+                    }
+                    for referral in referral_rows[start:start + batch_size]
+                ],
+            )
+        await session.commit()
+        codes = 0
+        for start in range(0, len(referrer_rows), batch_size):
+            code_objs = await crud_referral.upsert_many(
+                [row["id"] for row in referrer_rows[start:start + batch_size]],
+                30,
+                session,
+            )
+            codes += len(code_objs)
+    return {"users": len(rows), "codes": codes}
+
+
+async def clean() -> int:
+    """Remove seeded users, their codes and cache entries."""
+    seeded = select(User.id).where(User.email.endswith(f"@{SEED_DOMAIN}"))
+    async with AsyncSessionLocal() as session:
+        code_objs = await session.scalars(
+            select(ReferralCode).where(ReferralCode.referrer_id.in_(seeded)),
+        )
+        for code_obj in code_objs:
+            await delete_referral_redis(code_obj)
+        await session.execute(
+            delete(ReferralCode).where(ReferralCode.referrer_id.in_(seeded)),
+        )
+        users = await session.execute(
+            delete(User).where(User.email.endswith(f"@{SEED_DOMAIN}")),
+        )
+        await session.commit()
+    return users.rowcount
+
+
+async def main():
+    """Seed or clean and print what is done."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--referrers", type=int, default=1000)
+    parser.add_argument("--referrals", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--clean", action="store_true")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        if args.clean:
+            print(f"{await clean()} seeded users are removed")
+        else:
+            counts = await seed(
+                args.referrers,
+                args.referrals,
+                args.batch_size,
+            )
+            print(
+                f"{counts['users']} users and {counts['codes']} codes "
+                f"are seeded in {time.perf_counter() - start:.1f} s",
+            )
+    finally:
+        await engine.dispose()
+        await close_redis()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())